@@ -35,10 +35,56 @@ int pinSet = 0;
 long odorTime = 0;
 long delayTime = 0;
 
-const byte numChars = 32;
-char receivedChars[numChars];
-char tempChars[numChars];        // temporary array for use when parsing
-boolean newData = false;
+// Messages to and from python are sent as binary frames, see
+// components/protocol.py: | 0xA5 | type | seq | len | payload | crc8 |
+const byte frameSync = 0xA5;
+const byte maxPayload = 255;
+const int trialSize = 9; //bytes per trial: solenoid (1), odor ms (4), time between odors ms (4)
+byte rxState = 0; //which part of the frame is being received
+byte rxType = 0;
+byte rxSeq = 0;
+byte rxLen = 0;
+byte rxIndex = 0;
+byte rxCrc = 0;
+byte rxPayload[maxPayload];
+int lastRxSeq = -1; //seq of the last command, to ignore resent duplicates
+byte txSeq = 0; //counts frames sent to python
+
+// Python says hello until the arduino answers with its firmware version.
+// After that the arduino only speaks when something happens, plus a status
+// message whenever it has been silent for the keepalive interval.
+const unsigned int firmwareVersion = 2; //must match FIRMWARE_VERSION in components/protocol.py
+unsigned long keepaliveInterval = 0; //ms, 0 = no keepalive, set by python's hello
+unsigned long lastSendMillis = 0; //when the last frame was sent to python
+
+// Whole-sequence upload: an "S" frame with the number of trials followed by
+// "Q" frames with the trials. The trials are stored and then run back to
+// back without waiting for python between trials.
+const int maxTrials = 200;
+byte schedulePins[maxTrials];
+long scheduleOdorTimes[maxTrials];
+long scheduleDelayTimes[maxTrials];
+int scheduleLength = 0; //number of trials stored
+int expectedTrials = 0; //number of trials python says it is sending
+boolean scheduleReady = false;
+
+// Trials sent one at a time with "T" wait in a small queue, so python can
+// send the next trial while the current one is still running and it starts
+// as soon as the current delay ends
+const int queueSize = 4;
+byte queuePins[queueSize];
+long queueOdorTimes[queueSize];
+long queueDelayTimes[queueSize];
+int queueHead = 0; //index of the next trial to run
+int queueCount = 0; //number of trials waiting
+
+unsigned int trialsCompleted = 0; //sent with the status message so python can recover lost events
+
+// Python and the arduino start at a safe baud rate and then negotiate up.
+// A new rate is kept only if python confirms it with pings in time.
+unsigned long baudRate = 9600;
+const unsigned long baudConfirmTime = 1000; //ms to wait for pings at a new baud rate
+const int baudConfirmPings = 3; //pings needed to confirm a new baud rate
 
 
 
@@ -63,8 +109,8 @@ void setup() {
   pinMode(solenoidPin8, OUTPUT);
   pinMode(microscopeTrigger, OUTPUT);
 
-  //start the serial with a baud rate of 9600--higher amounts receive data faster, but can cause back-up in the queue, so stick with 9600!
-  Serial.begin(9600);
+  //start the serial at 9600, python negotiates a faster baud rate once connected
+  Serial.begin(baudRate);
 }
 
 
@@ -94,6 +140,7 @@ void delayMillis(){
   startMillis = currentMillis; //set the millis() value and subtract this from each millis() to get an elapsed time value
   while (microscopeTriggerAlready == 0){
     currentMillis = millis();
+    serviceSerial();
     if (currentMillis-startMillis >= delayMicroscopeTrigger){
       microscopeTriggerAlready += 1;
     }
@@ -109,6 +156,7 @@ void odorOn(){ //turns on the solenoid for an odor
 
   while (odorAlready == 0){ //if the odor has not been turned on
     currentMillis = millis();
+    serviceSerial();
 
     digitalWrite(pinSet, HIGH); //turn the odor pin on to deliver odor
 
@@ -126,6 +174,7 @@ void delayOn() {//delay between odors
   startMillis = currentMillis;
   while (delayAlready == 0){
     currentMillis = millis();
+    serviceSerial();
     //Serial.println(currentMillis-startMillis);
     if (currentMillis-startMillis >= delayTime){
       delayAlready = 1;
@@ -135,83 +184,271 @@ void delayOn() {//delay between odors
 }
 
 //============
-// Based on Example 5 from https://forum.arduino.cc/t/serial-input-basics-updated/382007/3
-void recvWithStartEndMarkers() {
-    static boolean recvInProgress = false;
-    static byte ndx = 0;
-    char startMarker = '<';
-    char endMarker = '>';
-    char rc;
-
-    while (Serial.available() > 0 && newData == false) {
-        rc = Serial.read();
-
-        if (recvInProgress == true) {
-            if (rc != endMarker) {
-                receivedChars[ndx] = rc;
-                ndx++;
-                if (ndx >= numChars) {
-                    ndx = numChars - 1;
-                }
+
+//convert the time between odors (ms) to the delay after the odor (ms)
+long toDelayTime(long delayMs) {
+  return delayMs-(delayMicroscopeTrigger+100)-triggerTime; //subtract the time it needs to trigger the microscope (100 milliseconds) and establish the baseline (4000ms)
+}
+
+//============
+
+// Updates a CRC-8 (polynomial 0x07) with one more byte
+byte crc8Update(byte crc, byte data) {
+    crc ^= data;
+    for (byte i = 0; i < 8; i++) {
+        if (crc & 0x80) {
+            crc = (crc << 1) ^ 0x07;
+        }
+        else {
+            crc = crc << 1;
+        }
+    }
+    return crc;
+}
+
+// Sends one frame to python
+void sendFrame(char type, const byte *payload, byte len) {
+    byte header[4] = {frameSync, (byte)type, txSeq, len};
+    byte crc = 0;
+    for (byte i = 1; i < 4; i++) {
+        crc = crc8Update(crc, header[i]);
+    }
+    for (byte i = 0; i < len; i++) {
+        crc = crc8Update(crc, payload[i]);
+    }
+    Serial.write(header, 4);
+    Serial.write(payload, len);
+    Serial.write(crc);
+    txSeq++;
+    lastSendMillis = millis();
+}
+
+// Sends a frame carrying one 16-bit number, e.g. a count of trials
+void sendCount(char type, unsigned int count) {
+    sendFrame(type, (byte *)&count, 2);
+}
+
+// Sends an event type with the arduino's own millis() so python can
+// timestamp the event precisely
+void sendEvent(char type) {
+    unsigned long eventMillis = millis();
+    sendFrame(type, (byte *)&eventMillis, 4);
+}
+
+// Answers python's hello with the firmware version and the hello's seq,
+// followed by the number of trials completed
+void sendReady() {
+    byte reply[3];
+    memcpy(reply, &firmwareVersion, 2);
+    reply[2] = rxSeq;
+    sendFrame('r', reply, 3);
+    sendCount('y', trialsCompleted);
+}
+
+// Tells python the arduino is still running if nothing else has been sent
+// for the keepalive interval. Cheap enough to call inside the timing loops.
+void keepAlive() {
+    if (keepaliveInterval > 0 && millis() - lastSendMillis >= keepaliveInterval) {
+        sendCount('y', trialsCompleted);
+    }
+}
+
+// Handles frames and keepalives while a trial is running, so commands sent
+// during a trial are acknowledged without waiting for it to finish
+void serviceSerial() {
+    keepAlive();
+    if (recvFrame() == true) {
+        handleFrame();
+    }
+}
+
+// Answers python's ping with millis() and the ping's seq, so python can pair
+// each reply with its ping
+void sendPingReply() {
+    byte reply[5];
+    unsigned long eventMillis = millis();
+    memcpy(reply, &eventMillis, 4);
+    reply[4] = rxSeq;
+    sendFrame('p', reply, 5);
+}
+
+//============
+
+// Reads waiting bytes until a whole frame has arrived. Returns true when a
+// frame with a valid crc is in rxType, rxSeq, rxLen and rxPayload.
+boolean recvFrame() {
+    while (Serial.available() > 0) {
+        byte rb = Serial.read();
+
+        if (rxState == 0) {
+            if (rb == frameSync) {
+                rxCrc = 0;
+                rxState = 1;
+            }
+        }
+        else if (rxState == 1) {
+            rxType = rb;
+            rxCrc = crc8Update(rxCrc, rb);
+            rxState = 2;
+        }
+        else if (rxState == 2) {
+            rxSeq = rb;
+            rxCrc = crc8Update(rxCrc, rb);
+            rxState = 3;
+        }
+        else if (rxState == 3) {
+            rxLen = rb;
+            rxCrc = crc8Update(rxCrc, rb);
+            rxIndex = 0;
+            if (rxLen > 0) {
+                rxState = 4;
             }
             else {
-                receivedChars[ndx] = '\0'; // terminate the string
-                recvInProgress = false;
-                ndx = 0;
-                newData = true;
+                rxState = 5;
             }
         }
-
-        else if (rc == startMarker) {
-            recvInProgress = true;
+        else if (rxState == 4) {
+            rxPayload[rxIndex] = rb;
+            rxIndex++;
+            rxCrc = crc8Update(rxCrc, rb);
+            if (rxIndex >= rxLen) {
+                rxState = 5;
+            }
+        }
+        else {
+            rxState = 0;
+            if (rb == rxCrc) {
+                return true;
+            }
+            sendFrame('n', NULL, 0); //tells python the command was corrupted
         }
-
-        // Serial.print("newData ");
-        // Serial.println(newData);
     }
+    return false;
 }
 
 //============
 
-void parseData() {      // split the data into its parts
-
-    char * strtokIndx; // this is used by strtok() as an index
+unsigned int readUInt16(const byte *data) {
+    return data[0] | ((unsigned int)data[1] << 8);
+}
 
-    strtokIndx = strtok(tempChars,",");      // get the first part - the string
-    // strcpy(messageFromPC, strtokIndx); // copy it to messageFromPC
-    pinSet = atoi(strtokIndx) + 1;
- 
-    strtokIndx = strtok(NULL, ","); // this continues where the previous call left off
-    odorSec = atol(strtokIndx);     // convert this part to an integer
+unsigned long readUInt32(const byte *data) {
+    return readUInt16(data) | ((unsigned long)readUInt16(data + 2) << 16);
+}
 
-    strtokIndx = strtok(NULL, ",");
-    delaySec = atol(strtokIndx);     // convert this part to a float
+// Restarts the serial port at a new baud rate
+void beginSerial(unsigned long newBaudRate) {
+    Serial.flush(); //finish sending at the current baud rate
+    Serial.end();
+    Serial.begin(newBaudRate);
+    rxState = 0;
+}
 
-    odorTime = (odorSec)*1000L; //convert seconds to milliseconds, L after 1000 to indicate unsigned long and needed for delays longer than 30s because of the way arduino handles numbers in 8-bit
-    delayTime = (delaySec)*1000L-(delayMicroscopeTrigger+100)-triggerTime; //convert to milliseconds, but subtract the time it needs to trigger the microscope (100 milliseconds) and establish the baseline (4000ms)
-    
+// Waits for python to confirm a new baud rate by answering its pings.
+// Returns false if not enough valid pings arrived in time.
+boolean confirmBaudRate() {
+    int pings = 0;
+    unsigned long confirmStart = millis();
+    while (millis() - confirmStart < baudConfirmTime) {
+        if (recvFrame() == true && rxType == '?') {
+            sendPingReply();
+            pings++;
+            if (pings >= baudConfirmPings) {
+                return true;
+            }
+        }
+    }
+    return false;
+}
 
+// Stores one trial from a "T" or "Q" payload
+void readTrial(const byte *data, byte *pin, long *odor, long *delayAfter) {
+    *pin = data[0] + 1;
+    *odor = readUInt32(data + 1); //already in milliseconds, so each trial can have its own odor duration and jittered time between odors
+    *delayAfter = toDelayTime(readUInt32(data + 5));
 }
 
-//============
+// Acts on a received frame
+void handleFrame() {
+    if (rxType == '?') {
+        sendPingReply(); //answers python's clock sync ping with millis()
+        return;
+    }
 
-void showParsedData() {
-    Serial.print("pinSet ");
-    Serial.println(pinSet);
-    Serial.print("odorTime ");
-    Serial.println(odorTime);
-    Serial.print("delayTime ");
-    Serial.println(delayTime);
+    if (rxType == 'H' && rxLen == 2) {
+        keepaliveInterval = readUInt16(rxPayload);
+        sendReady(); //python is connected and asking for the arduino's status
+        return;
+    }
+
+    if (rxType == 'T' && queueCount >= queueSize) {
+        return; //no ack, so python resends the trial once there is room
+    }
+
+    sendFrame('a', &rxSeq, 1); //tells python the command was received
+
+    if (rxSeq == lastRxSeq) {
+        return; //python resent a command whose ack was lost
+    }
+    lastRxSeq = rxSeq;
+
+    if (rxType == 'T' && rxLen == trialSize) {
+        int tail = (queueHead + queueCount) % queueSize;
+        readTrial(
+            rxPayload,
+            &queuePins[tail],
+            &queueOdorTimes[tail],
+            &queueDelayTimes[tail]
+        );
+        queueCount++;
+    }
+    else if (rxType == 'C') {
+        queueCount = 0; //python aborted, drop the trials that haven't started
+        scheduleLength = 0;
+    }
+    else if (rxType == 'B' && rxLen == 4) {
+        unsigned long newBaudRate = readUInt32(rxPayload);
+        beginSerial(newBaudRate);
+        if (confirmBaudRate() == true) {
+            baudRate = newBaudRate;
+        }
+        else {
+            beginSerial(baudRate); //fall back to the last rate that worked
+        }
+    }
+    else if (rxType == 'S' && rxLen == 2) {
+        expectedTrials = readUInt16(rxPayload);
+        scheduleLength = 0;
+        if (expectedTrials > maxTrials) {
+            expectedTrials = 0; //store nothing from the "Q" frames that follow
+            sendCount('8', 0); //the sequence doesn't fit
+        }
+    }
+    else if (rxType == 'Q') {
+        for (int i = 0; i + trialSize <= rxLen && scheduleLength < expectedTrials && scheduleLength < maxTrials; i += trialSize) {
+            readTrial(
+                rxPayload + i,
+                &schedulePins[scheduleLength],
+                &scheduleOdorTimes[scheduleLength],
+                &scheduleDelayTimes[scheduleLength]
+            );
+            scheduleLength++;
+        }
+        if (expectedTrials > 0 && scheduleLength == expectedTrials) {
+            scheduleReady = true;
+            sendCount('8', scheduleLength); //tells python how many trials were stored
+        }
+    }
 }
 
 //============
 
 void checkTrigger() {
   ardTrigger = 0; //reset checkTrigger -- should wait for a trigger before each odor delivery
-  Serial.println("in check trigger");
   if (ardTrigger == 0){
     while (ardTrigger == 0){
       delay(10); //100 ms delay between reading trigger
+      serviceSerial();
       receivedSignal = digitalRead(analogInPin);
 
      
@@ -225,40 +462,64 @@ void checkTrigger() {
     }
 
 
+//============
+
+void runTrial() {
+    checkTrigger(); //wait for microscope trigger
+    sendEvent('9'); //tells python when the microscope has been triggered
+    digitalWrite(microscopeTrigger, HIGH); //trigger the microscope
+    delay(100);
+    digitalWrite(microscopeTrigger, LOW); 
+    delayMillis(); //wait 4 seconds after the microscope has been triggered to establish baseline
+    sendEvent('1'); //tells python the odor has been released
+    odorOn(); //releases the odor for a certain time
+    sendEvent('2'); //tells python the odor has been stopped
+    delayOn(); //delay occurs after the odor
+    sendEvent('3'); //tells python the delay has been finished, to send the next set of numbers
+    trialsCompleted++;
+}
+
+//============
+
+// Runs every trial of an uploaded sequence, timed only by the arduino clock
+void runSchedule() {
+    for (int i = 0; i < scheduleLength; i++) {
+        pinSet = schedulePins[i];
+        odorTime = scheduleOdorTimes[i];
+        delayTime = scheduleDelayTimes[i];
+        runTrial();
+    }
+    scheduleLength = 0;
+    scheduleReady = false;
+    resetFunction();
+}
+
 //============
 
 void executeSolenoid() {
 
-    recvWithStartEndMarkers();
+    if (recvFrame() == true) {
+        handleFrame();
+    }
 
-    if (newData == true) {
-        strcpy(tempChars, receivedChars);
-            // this temporary copy is necessary to protect the original data
-            //   because strtok() used in parseData() replaces the commas with \0
-        parseData();
-        showParsedData();
-        
-    
+    if (scheduleReady == true) {
+        runSchedule();
+    }
+
+    if (queueCount > 0) {
+        pinSet = queuePins[queueHead];
+        odorTime = queueOdorTimes[queueHead];
+        delayTime = queueDelayTimes[queueHead];
+        queueHead = (queueHead + 1) % queueSize;
+        queueCount--;
 
         if (pinSet > 1){
-            checkTrigger(); //wait for microscope trigger
-            Serial.println("9"); //tells python when the microscope has been triggered
-            digitalWrite(microscopeTrigger, HIGH); //trigger the microscope
-            delay(100);
-            digitalWrite(microscopeTrigger, LOW); 
-            delayMillis(); //wait 4 seconds after the microscope has been triggered to establish baseline
-            Serial.println("1"); //tells python the odor has been released
-            odorOn(); //releases the odor for a certain time
-            Serial.println("2"); //tells python the odor has been stopped
-            delayOn(); //delay occurs after the odor
-            Serial.println("3"); //tells python the delay has been finished, to send the next set of numbers
+            runTrial();
         }
   
         else {
             ardTrigger = 0;
         }
-
-        newData = false;
     }
 }
 
@@ -266,6 +527,6 @@ void executeSolenoid() {
 //============
 
 void loop() {
-  Serial.println("y"); //tells python that the arduino is connected and running
+  keepAlive(); //tells python that the arduino is still running
   executeSolenoid(); //run the code
 }
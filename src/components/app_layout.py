@@ -18,12 +18,21 @@ from datetime import datetime
 
 from components.settings_layout import SettingsLayout
 from components.trial_order import TrialOrderTable
+from components.trial_constraints import TrialConstraints, schedule_from_settings
+from components.trial_schedule import TrialSchedule, TrialTimings
+from components.counterbalance import DesignAssignments
 from components.arduino_functions import ArduinoSession
-from components.utils import resolve_path
+from components.protocol import MAX_SEQUENCE_TRIALS
+from components.io_worker import IOWorker
+from components.experiment_index import DEFAULT_INDEX_PATH
+from components.session_archive import DEFAULT_ARCHIVE_PATH
+from components.session_journal import find_unfinished_journals, mark_journal_resolved
+from components.timings_writer import TimingsWriter, timings_columns
+from components.utils import parse_folder_name, resolve_path
 
 import pyduinocli
-from threading import Thread
 import re
+import asyncio
 
 
 class OdorDeliveryApp(UserControl):
@@ -110,6 +119,23 @@ class OdorDeliveryApp(UserControl):
         # and all relevant experiment displays
         self.arduino_session = None
 
+        #: str: Port to use instead of COM7/COM8, e.g. a VirtualArduino's
+        # pseudo-terminal. No sketches are uploaded when it is set.
+        self.arduino_port = None
+
+        #: str: Root directory of the Parquet archive every session is added
+        # to, or None to only save csv files. Needs pyarrow.
+        self.archive_path = DEFAULT_ARCHIVE_PATH
+
+        #: str: Path of the SQLite index every session is added to when it
+        # ends, or None to leave sessions out of the index
+        self.index_path = DEFAULT_INDEX_PATH
+
+        #: IOWorker: Writes experiment files in the background for every
+        # session
+        self.io_worker = IOWorker()
+        self.io_worker.start()
+
         self.make_app_layout()
         self.page.update()
 
@@ -194,6 +220,14 @@ class OdorDeliveryApp(UserControl):
             ]
         )
 
+        #: ft.ResponsiveRow: Layout containing how to talk to the arduino
+        self.connection_options = ft.ResponsiveRow(
+            [
+                self.sequence_upload_option,
+                self.serial_engine_option,
+            ]
+        )
+
         #: ft.Row: Layout containing buttons
         self.randomize_start_buttons = ft.Row()
 
@@ -206,6 +240,7 @@ class OdorDeliveryApp(UserControl):
                 self.pick_directory_layout,
                 self.settings_fields,
                 self.save_reset_buttons,
+                self.connection_options,
                 # self.experiment_info_layout,
                 # self.randomize_start_buttons,
             ],
@@ -233,6 +268,7 @@ class OdorDeliveryApp(UserControl):
         try:
             self.get_session_info()
             self.page.banner.open = False
+            self.check_unfinished_sessions()
         except TypeError:
             self.directory_path.value = "Cancelled!"
             self.page.banner.open = False
@@ -253,15 +289,16 @@ class OdorDeliveryApp(UserControl):
         """Parses the directory folder for experiment session info."""
 
         folder = os.path.basename(self.directory_path.value)
+        date, animal_id, roi = parse_folder_name(folder)
 
         #: str: Date of the experiment
-        self.date = folder.split("--")[0]
+        self.date = date
 
         #: str: Animal ID of the experiment
-        self.animal_id = folder.split("--")[1].split("_")[0]
+        self.animal_id = animal_id
 
         #: str: ROI of the experiment
-        self.roi = folder.split("_")[1]
+        self.roi = roi
 
     def save_settings(self):
         """Saves the user-input experiment settings to a dict."""
@@ -310,9 +347,64 @@ class OdorDeliveryApp(UserControl):
                     )
                 ]
 
+        #: str: Latin square or Williams design to order trials by, or None
+        # to shuffle them
+        self.design = None
+
+        #: int: The row of the design this animal and ROI start at
+        self.design_row = None
+
+        if self.trial_type != "Single" and self.settings_fields.design.value in [
+            "Latin square",
+            "Williams",
+        ]:
+            self.design = self.settings_fields.design.value
+            odors = self.specf_odors or list(range(1, self.num_odors + 1))
+            self.design_row = DesignAssignments(self.index_path).assign(
+                self.design, odors, self.animal_id, self.roi
+            )
+
+            # The design sets the order, so it isn't shuffled
+            self.randomize_option.value = False
+
+        seed = self.settings_fields.seed.text_field.value
+
+        #: int: Seed entered to repeat a past session's shuffled order, or
+        # None for a new one
+        self.seed = int(seed) if seed else None
+
+        max_run = self.settings_fields.max_run.text_field.value
+        min_gap = self.settings_fields.min_gap.text_field.value
+
+        #: TrialConstraints: Constraints the shuffled trial order has to meet
+        self.trial_constraints = TrialConstraints(
+            no_repeats=self.settings_fields.no_repeats.value,
+            max_run=int(max_run) if max_run else None,
+            min_gap=int(min_gap) if min_gap else 0,
+            balanced_blocks=self.settings_fields.balanced_blocks.value,
+        )
+
+        iti_jitter = self.settings_fields.iti_jitter.text_field.value
+        duration_series = self.settings_fields.duration_series.text_field.value
+
+        #: TrialTimings: How long each trial's odor and time between odors
+        # last
+        self.trial_timings = TrialTimings(
+            self.odor_duration,
+            self.time_btw_odors,
+            iti_jitter=float(iti_jitter) if iti_jitter else 0,
+            jitter_distribution=self.settings_fields.jitter_distribution.value,
+            duration_series=(
+                [float(duration) for duration in duration_series.split(",")]
+                if duration_series
+                else None
+            ),
+        )
+
         #: dict: All experiment settings entered from settings fields
         self.settings_dict = {
             "dir_path": self.directory_path.value,
+            "trial_type": self.trial_type,
             "mouse": self.animal_id,
             "roi": self.roi,
             "date": self.date,
@@ -324,6 +416,16 @@ class OdorDeliveryApp(UserControl):
             "odor_duration": self.odor_duration,
             "time_btw_odors": self.time_btw_odors,
             "randomize_trials": self.randomize_option.value,
+            "no_repeats": self.trial_constraints.no_repeats,
+            "max_run": self.trial_constraints.max_run,
+            "min_gap": self.trial_constraints.min_gap,
+            "balanced_blocks": self.trial_constraints.balanced_blocks,
+            "design": self.design,
+            "design_row": self.design_row,
+            "seed": self.seed,
+            "iti_jitter": self.trial_timings.iti_jitter,
+            "jitter_distribution": self.trial_timings.jitter_distribution,
+            "odor_duration_series": self.trial_timings.duration_series,
         }
 
     def check_specf_odors_format(self):
@@ -351,6 +453,45 @@ class OdorDeliveryApp(UserControl):
 
         return correct_format
 
+    def check_timing_format(self):
+        """Checks whether the ITI jitter and odor durations are entered as
+        numbers, since their input filters still allow e.g. "1..5".
+
+        Returns:
+            Bool of whether both are formatted correctly
+        """
+
+        # Single trials don't show the timing fields, which keep their
+        # defaults
+        if self.settings_fields.trial_type.value == "Single":
+            return True
+
+        number = r"(\d+(\.\d*)?|\.\d+)"
+        correct_format = True
+
+        for field, pattern, error_text in [
+            (
+                self.settings_fields.iti_jitter,
+                re.compile(f"^{number}$"),
+                "Check jitter input",
+            ),
+            (
+                self.settings_fields.duration_series,
+                re.compile(f"^{number}(,{number})*$"),
+                "Check durations input",
+            ),
+        ]:
+            value = field.text_field.value
+            if value and pattern.match(value) is None:
+                field.text_field.error_text = error_text
+                correct_format = False
+            else:
+                field.text_field.error_text = ""
+
+            field.text_field.update()
+
+        return correct_format
+
     def save_clicked(self, e):
         """Saves settings and populates app layout after clicking Save button.
 
@@ -361,52 +502,207 @@ class OdorDeliveryApp(UserControl):
         if self.settings_fields.trial_type.value == "Limited Multiple":
             specf_format = self.check_specf_odors_format()
 
-        if self.settings_fields.trial_type.value != "Limited Multiple" or (
-            self.settings_fields.trial_type.value == "Limited Multiple"
-            and specf_format is True
+        timing_format = self.check_timing_format()
+
+        if timing_format and (
+            self.settings_fields.trial_type.value != "Limited Multiple"
+            or (
+                self.settings_fields.trial_type.value == "Limited Multiple"
+                and specf_format is True
+            )
         ):
             self.get_session_info()
             self.save_settings()
 
-            self.save_settings_btn.disabled = True
-            self.pick_directory_btn.disabled = True
-            self.randomize_option.disabled = True
-            self.settings_fields.disable_settings_fields(disable=True)
-
-            self.trial_table = TrialOrderTable(
-                self.page,
-                self.trial_type,
-                self.single_odor,
-                self.randomize_option.value,
-                self.num_trials,
-                self.num_odors,
-                self.specf_odors
-                # reset=False,
-            )
+            try:
+                self.trial_table = TrialOrderTable(
+                    self.page,
+                    self.trial_type,
+                    self.single_odor,
+                    self.randomize_option.value,
+                    self.num_trials,
+                    self.num_odors,
+                    self.specf_odors,
+                    self.trial_constraints,
+                    self.design,
+                    self.design_row,
+                    self.seed,
+                    self.trial_timings,
+                    # reset=False,
+                )
+            except ValueError as error:
+                self.show_constraints_error(error)
+            else:
+                self.show_trial_table()
 
-            self.make_rand_start_buttons()
+        self.update()
 
-            if self.randomize_option.value is True:
-                self.randomize_start_buttons.controls = [
-                    self.randomize_button,
-                    self.start_button,
-                ]
-            else:
-                self.randomize_start_buttons.controls = [
-                    self.start_button,
-                ]
+    def show_trial_table(self):
+        """Locks the settings and shows the trial order with the buttons to
+        start the experiment."""
 
-            self.app_layout.controls.extend(
-                [
-                    self.divider1,
-                    self.trials_title,
-                    self.trial_table,
-                    self.randomize_start_buttons,
-                ]
-            )
+        self.save_settings_btn.disabled = True
+        self.pick_directory_btn.disabled = True
+        self.randomize_option.disabled = True
+        self.sequence_upload_option.disabled = True
+        self.serial_engine_option.disabled = True
+        self.settings_fields.disable_settings_fields(disable=True)
+
+        self.make_rand_start_buttons()
+
+        if self.randomize_option.value is True:
+            self.randomize_start_buttons.controls = [
+                self.randomize_button,
+                self.start_button,
+            ]
+        else:
+            self.randomize_start_buttons.controls = [
+                self.start_button,
+            ]
+
+        self.app_layout.controls.extend(
+            [
+                self.divider1,
+                self.trials_title,
+                self.trial_table,
+                self.randomize_start_buttons,
+            ]
+        )
 
         self.update()
 
+    def check_unfinished_sessions(self):
+        """Looks for a session in the experiment folder that stopped before it
+        ended, e.g. because the app crashed, and offers to resume its
+        remaining trials."""
+
+        unfinished = find_unfinished_journals(self.directory_path.value)
+        if not unfinished:
+            return
+
+        #: tuple: Journal path and replayed state of an unfinished session
+        self.unfinished_session = unfinished[0]
+        session = self.unfinished_session[1]
+        metadata = session["metadata"]
+
+        timings_name = os.path.basename(metadata["timings_path"])
+
+        stopped_text = (
+            f"Session {metadata['csv_time']} stopped after "
+            f"{session['delivered']} of {len(metadata['solenoid_order'])} trials"
+        )
+        if session["in_progress"] is not None:
+            stopped_text += f", during trial {session['in_progress'] + 1}"
+
+        #: ft.AlertDialog: Alert dialog offering to resume a session
+        self.resume_dlg = ft.AlertDialog(
+            modal=True,
+            title=Text("Unfinished session found"),
+            content=Text(
+                f"{stopped_text}. Load the remaining "
+                f"{len(session['remaining'])} trials? Either way, trials missing "
+                f"from {timings_name} are recovered from the session's journal."
+            ),
+            actions=[
+                ft.TextButton("Resume", on_click=self.resume_clicked),
+                ft.TextButton("Discard", on_click=self.discard_clicked),
+            ],
+        )
+        self.page.dialog = self.resume_dlg
+        self.resume_dlg.open = True
+        self.page.update()
+
+    def recover_timings(self):
+        """Adds the trials the unfinished session's journal holds but its
+        solenoid timings csv doesn't, keeping every row already in the csv.
+        """
+
+        session = self.unfinished_session[1]
+        metadata = session["metadata"]
+
+        timings_writer = TimingsWriter(
+            os.path.join(
+                self.directory_path.value,
+                os.path.basename(metadata["timings_path"]),
+            ),
+            timings_columns(metadata["panel_type"]),
+        )
+        timings_writer.merge(session["timings"])
+
+    def resume_clicked(self, e):
+        """Loads the settings and remaining trials of the unfinished session,
+        ready to start.
+
+        Args:
+            e (event): on_click event from clicking Resume on the dialog
+            offering to resume a session.
+        """
+
+        path, session = self.unfinished_session
+        self.recover_timings()
+        mark_journal_resolved(path, "resumed")
+        self.resume_dlg.open = False
+
+        metadata = session["metadata"]
+        self.settings_dict = dict(
+            metadata["settings"], dir_path=self.directory_path.value
+        )
+
+        # The seeds give back the original session's whole order, not the
+        # remaining trials, so record where the order came from instead
+        self.settings_dict["resumed_from"] = metadata["csv_time"]
+        self.settings_dict["resumed_first_trial"] = session["delivered"] + 1
+        self.panel_type = metadata["panel_type"]
+        self.trial_type = self.settings_dict["trial_type"]
+
+        # The remaining trials keep their order, so they aren't shuffled again
+        self.randomize_option.value = False
+        self.trial_table = TrialOrderTable(
+            self.page,
+            self.trial_type,
+            self.settings_dict["single_odor"],
+            False,
+            self.settings_dict["num_trials"],
+            self.settings_dict["num_odors"],
+            self.settings_dict["specific_odors"],
+        )
+        self.trial_table.schedule = TrialSchedule(
+            session["remaining"],
+            session["remaining_odor_ms"],
+            session["remaining_btw_ms"],
+        )
+
+        # Journals without each trial's timings get them back from the seed
+        if not self.trial_table.schedule.is_timed():
+            schedule = schedule_from_settings(metadata["settings"])
+            if schedule.is_timed():
+                delivered = session["delivered"]
+                self.trial_table.schedule = TrialSchedule(
+                    session["remaining"],
+                    schedule.odor_ms[delivered:],
+                    schedule.btw_ms[delivered:],
+                )
+        self.trial_table.seed = None
+        self.trial_table.timing_seed = None
+        self.trial_table.display_trial_order()
+
+        self.show_trial_table()
+        self.page.update()
+
+    def discard_clicked(self, e):
+        """Closes the dialog offering to resume a session and stops offering
+        it.
+
+        Args:
+            e (event): on_click event from clicking Discard on the dialog
+            offering to resume a session.
+        """
+
+        self.recover_timings()
+        mark_journal_resolved(self.unfinished_session[0], "discarded")
+        self.resume_dlg.open = False
+        self.page.update()
+
     def reset_clicked(self, e):
         """Resets settings and resets button/input states, as well as clearing
         outdated information from app layout.
@@ -419,6 +715,8 @@ class OdorDeliveryApp(UserControl):
         self.settings_dict = None
         self.randomize_option.value = True
         self.randomize_option.disabled = False
+        self.sequence_upload_option.disabled = False
+        self.serial_engine_option.disabled = False
         self.settings_fields.reset_settings_clicked(e)
         self.check_settings_complete(e)
         self.pick_directory_btn.disabled = False
@@ -450,6 +748,8 @@ class OdorDeliveryApp(UserControl):
         self.settings_fields.controls[0].controls = [
             self.settings_fields.row1,
             self.settings_fields.row2,
+            self.settings_fields.row3,
+            self.settings_fields.row4,
         ]
 
         self.settings_fields.update()
@@ -520,9 +820,24 @@ class OdorDeliveryApp(UserControl):
             e (event): on_result event from clicking Randomize Again button.
         """
 
-        self.trial_table.randomize_trials(repeat=True, e=None)
+        try:
+            self.trial_table.randomize_trials(repeat=True, e=None)
+        except ValueError as error:
+            self.show_constraints_error(error)
         self.update()
 
+    def show_constraints_error(self, error: ValueError):
+        """Shows snack bar message explaining why the trials couldn't be
+        shuffled or timed.
+
+        Args:
+            error: The error from shuffling or timing the trials.
+        """
+
+        self.page.snack_bar.content.value = f"Could not order trials: {error}"
+        self.page.snack_bar.open = True
+        self.page.update()
+
     def start_clicked(self, e):
         """Uploads arduino sketch and retrieves arduino session layout for app.
         Also saves the solenoid info to csv file.
@@ -536,11 +851,27 @@ class OdorDeliveryApp(UserControl):
         if self.randomize_option.value is True:
             self.randomize_button.disabled = True
         self.abort_btn.disabled = False
-        self.upload_arduino()
+        if self.arduino_port is None:
+            self.upload_arduino()
         self.csv_time = datetime.now().strftime("%y%m%d-%H%M%S")
 
+        # Randomize Again draws a new seed, so the one saved is the one the
+        # order shown was shuffled and jittered with
+        self.settings_dict["seed"] = self.trial_table.seed
+        self.settings_dict["timing_seed"] = self.trial_table.timing_seed
+
         self.save_solenoid_info()
 
+        sequence_upload = self.sequence_upload_option.value
+        if sequence_upload and len(self.trial_table.trials) > MAX_SEQUENCE_TRIALS:
+            sequence_upload = False
+            self.page.snack_bar.content.value = (
+                f"The arduino can store at most {MAX_SEQUENCE_TRIALS} trials, "
+                "so they are sent one at a time instead"
+            )
+            self.page.snack_bar.open = True
+            self.page.update()
+
         for control in [
             self.divider2,
             self.progress_title,
@@ -555,6 +886,14 @@ class OdorDeliveryApp(UserControl):
             self.page,
             self.settings_dict,
             self.trial_table.trials,
+            odor_ms=self.trial_table.schedule.odor_ms,
+            btw_ms=self.trial_table.schedule.btw_ms,
+            engine=self.serial_engine_option.value,
+            sequence_upload=sequence_upload,
+            port=self.arduino_port,
+            io_worker=self.io_worker,
+            archive_path=self.archive_path,
+            index_path=self.index_path,
         )
 
         self.app_layout.controls.extend(
@@ -575,38 +914,18 @@ class OdorDeliveryApp(UserControl):
         self.start_arduino_session()
 
     def start_arduino_session(self):
-        """Starts the arduino session and sends signals to the arduino board
-        in a threaded process.
+        """Starts the arduino session and sends signals to the arduino board,
+        with messages read in a background thread, or on an event loop for
+        the asyncio engine.
         """
 
-        if self.arduino_session.trig_signal is False:
-            while (
-                self.arduino_session.trig_signal is False
-                and self.arduino_session.sequence_complete is False
-                and not self.arduino_session.stop_threads.is_set()
-            ):
-                arduino_msg = self.arduino_session.get_arduino_msg()
-                if "y" in arduino_msg:
-                    self.arduino_session.trig_signal = True
-
-                    thread = Thread(target=self.arduino_session.generate_arduino_str)
-                    thread.start()
-                    thread.join()
-
-                    self.arduino_session.trig_signal = False
-
-                    if not self.arduino_session.stop_threads.is_set():
-                        self.prompt_new_exp()
-
-                else:
-                    pass
+        if self.arduino_session.engine == "asyncio":
+            asyncio.run(self.arduino_session.run_async())
+        else:
+            self.arduino_session.run()
 
-        if (
-            self.arduino_session.trig_signal is False
-            and self.arduino_session.sequence_complete is True
-        ):
-            self.arduino_session.close_port()
-            # self.port = None
+        if self.arduino_session.sequence_complete is True:
+            self.prompt_new_exp()
 
         self.abort_btn.disabled = True
         self.arduino_session.update()  # to show disabled button
@@ -701,13 +1020,19 @@ class OdorDeliveryApp(UserControl):
         path = os.path.join(self.directory_path.value, csv_name)
 
         # sort trial order info by odor #
-        sorted_df = self.trial_table.trials_df.copy()
-        sorted_df["Trial"] = range(1, len(sorted_df) + 1)
-        sorted_df.columns = sorted_df.columns.astype(str)
-        sorted_df.rename(columns={"0": f"Odor {self.panel_type}"}, inplace=True)
-        sorted_df.sort_values(by=[f"Odor {self.panel_type}"], inplace=True)
+        sorted_df = self.trial_table.schedule.to_dataframe(
+            self.panel_type, self.trial_table.seed, self.trial_table.timing_seed
+        )
+
+        self.io_worker.submit(sorted_df.to_csv, path, index=False)
+        self.io_worker.submit(self.show_solenoid_info_saved, csv_name)
+
+    def show_solenoid_info_saved(self, csv_name: str):
+        """Shows snack bar message with the name of the solenoid order file.
 
-        sorted_df.to_csv(path, index=False)
+        Args:
+            csv_name: Name of the solenoid order file.
+        """
 
         self.page.snack_bar.content.value = (
             f"Solenoid info saved to {csv_name} in experiment directory."
@@ -735,6 +1060,28 @@ class OdorDeliveryApp(UserControl):
             label="Shuffle trials", value=True, col={"sm": 4}
         )
 
+        #: ft.Switch: Whether to upload the whole odor sequence to the arduino
+        # at once instead of sending one trial at a time
+        self.sequence_upload_option = ft.Switch(
+            label="Upload whole sequence", value=False, col={"sm": 4}
+        )
+
+        #: ft.Dropdown: Whether the serial conversation runs with the
+        # arduino's messages read in a "thread" or on an "asyncio" event loop
+        self.serial_engine_option = ft.Dropdown(
+            value="thread",
+            label="Serial engine",
+            options=[
+                ft.dropdown.Option(key="thread", text="Reader thread"),
+                ft.dropdown.Option(key="asyncio", text="Asyncio event loop"),
+            ],
+            col={"sm": 4},
+            border_color=ft.colors.SECONDARY_CONTAINER,
+            border_width=1,
+            focused_border_color=ft.colors.SURFACE_TINT,
+            focused_border_width=2,
+        )
+
         #: ft.ElevatedButton: Save Settings button
         self.save_settings_btn = ElevatedButton(
             "Save Settings",
@@ -795,7 +1142,7 @@ class OdorDeliveryApp(UserControl):
 
         self.abort_exp_dlg.open = False
         self.page.update()
-        self.arduino_session.stop_threads.set()
+        self.arduino_session.abort()
         self.abort_btn.disabled = True
         self.reset_settings_btn.disabled = False
         self.start_button.disabled = False
@@ -8,11 +8,42 @@ import datetime
 import serial
 import pdb
 import time
+import numpy as np
 import pandas as pd
 import os
+import asyncio
+from collections import deque
 
 from threading import Thread, Event
 
+from components.serial_reader import ArduinoEvent
+from components.serial_transport import SerialTransport
+from components.async_transport import AsyncArduinoTransport
+from components.sequencer import (
+    ReadEvent,
+    SetBaudRate,
+    Sleep,
+    Write,
+    run_steps,
+    run_steps_async,
+)
+from components.clock_sync import ClockSync
+from components.event_store import EventStore, clock_time, iso_time
+from components.predicted_schedule import PredictedSchedule
+from components.session_clock import SessionClock
+from components.timings_writer import TimingsWriter, timings_columns
+from components.io_worker import IOWorker
+from components.session_journal import SessionJournal
+from components.session_archive import ARCHIVE_AVAILABLE, write_session_archive
+from components.experiment_index import ExperimentIndex, session_entry
+from components.protocol import (
+    FIRMWARE_VERSION,
+    MAX_SEQUENCE_TRIALS,
+    MAX_TRIALS_PER_FRAME,
+    encode_frame,
+    encode_trial,
+)
+
 
 class ArduinoSession(UserControl):
     """Controls communication with the Arduino board and contains layout
@@ -25,6 +56,14 @@ class ArduinoSession(UserControl):
         page: ft.Page,
         settings: dict,
         odor_sequence: list,
+        odor_ms=None,
+        btw_ms=None,
+        engine: str = "thread",
+        sequence_upload: bool = False,
+        port: str = None,
+        io_worker: IOWorker = None,
+        archive_path: str = None,
+        index_path: str = None,
     ):
         """Initializes an instance for holding signals sent to the arduino per
         session.
@@ -35,10 +74,38 @@ class ArduinoSession(UserControl):
             page: The page that OdorDeliveryApp will be added to.
             settings: All experiment settings entered from settings fields.
             odor_sequence: The order of odor delivery, by odor number.
+            odor_ms: Odor duration of each trial in ms, or None to use the
+                odor duration setting for every trial.
+            btw_ms: Time between odors of each trial in ms, or None to use the
+                time between odors setting for every trial.
+            engine: Whether the serial conversation runs in a "thread" or on
+                an "asyncio" event loop.
+            sequence_upload: Whether to upload the whole odor sequence at once
+                and let the arduino run it without waiting for python between
+                trials. The sequence can hold at most MAX_SEQUENCE_TRIALS
+                trials.
+            port: The port to open instead of the panel's COM port, e.g. a
+                VirtualArduino's pseudo-terminal.
+            io_worker: The running worker that session output is written on,
+                or None to start one for this session.
+            archive_path: Root directory of the Parquet session archive, or
+                None to only save csv files.
+            index_path: Path of the SQLite experiment index the session is
+                added to when it ends, or None to leave it out.
+
+        Raises:
+            ValueError: The sequence upload holds more trials than the arduino
+                can store.
         """
 
         super().__init__()
 
+        if sequence_upload and len(odor_sequence) > MAX_SEQUENCE_TRIALS:
+            raise ValueError(
+                f"The arduino can store at most {MAX_SEQUENCE_TRIALS} trials "
+                f"from a sequence upload, but there are {len(odor_sequence)}"
+            )
+
         #: str: Whether odor panel is 1% or 10%
         self.panel_type = panel_type
 
@@ -54,18 +121,80 @@ class ArduinoSession(UserControl):
         #: list: The order of odor delivery, by odor (solenoid) number
         self.solenoid_order = odor_sequence
 
+        if odor_ms is None:
+            odor_ms = round(settings["odor_duration"] * 1000)
+        if btw_ms is None:
+            btw_ms = round(settings["time_btw_odors"] * 1000)
+
+        #: np.ndarray: Odor duration of each trial in ms
+        self.odor_ms = np.broadcast_to(
+            np.asarray(odor_ms, dtype=np.uint32), (len(odor_sequence),)
+        )
+
+        #: np.ndarray: Time between odors of each trial in ms
+        self.btw_ms = np.broadcast_to(
+            np.asarray(btw_ms, dtype=np.uint32), (len(odor_sequence),)
+        )
+
         #: str: The date of the experiment
         self.date = settings["date"]
 
         #: str: The animal ID of the experiment
         self.animal_id = settings["mouse"]
 
+        #: str: The port the arduino is connected to, or None to pick the
+        # panel's COM port
+        self.port = port
+
         #: roi: The ROI of the experiment
         self.roi = settings["roi"]
 
         #: str: The directory for saving solenoid info and timing files
         self.directory_path = settings["dir_path"]
 
+        #: str: Root directory of the Parquet session archive, or None
+        self.archive_path = archive_path
+
+        #: str: Path of the SQLite experiment index, or None
+        self.index_path = index_path
+
+        #: bool: Whether the session started its own I/O worker and has to
+        # stop it at the end
+        self.owns_io_worker = io_worker is None
+
+        if io_worker is None:
+            io_worker = IOWorker()
+            io_worker.start()
+
+        #: IOWorker: Writes files and logs so the serial loop never waits on
+        # the disk
+        self.io_worker = io_worker
+
+        #: int: Number of trials queued to be written to the timings csv
+        self.trials_saved = 0
+
+        #: TimingsWriter: Streams the solenoid timings csv one trial at a time
+        self.timings_writer = TimingsWriter(
+            self.output_path("solenoid_timings"), timings_columns(self.panel_type)
+        )
+
+        #: SessionJournal: Crash-safe record of every command and event, kept
+        # next to the solenoid order csv
+        self.journal = SessionJournal(
+            self.output_path("session_journal", "bin"), self.io_worker
+        )
+        self.journal.start(
+            {
+                "settings": self.acq_params,
+                "panel_type": self.panel_type,
+                "csv_time": self.csv_time,
+                "solenoid_order": self.solenoid_order,
+                "odor_ms": self.odor_ms.tolist(),
+                "btw_ms": self.btw_ms.tolist(),
+                "timings_path": self.timings_writer.path,
+            }
+        )
+
         #: ft.ProgressBar: Progress bar for experiment progress
         self.progress_bar = ft.ProgressBar(width=600)
 
@@ -110,26 +239,119 @@ class ArduinoSession(UserControl):
         #: bool: Whether odor delivery sequence has finished
         self.sequence_complete = False
 
-        # Keep track of when the solenoids were activated
+        #: bool: Whether finish_sequence has recorded how the session ended
+        self.finished = False
 
-        #: list: Contains times that solenoids were activated
-        self.time_solenoid_on = []
+        #: PredictedSchedule: When every event of the session should happen,
+        # worked out before it starts
+        self.schedule = PredictedSchedule(
+            self.solenoid_order, self.odor_ms, self.btw_ms
+        )
 
-        #: list: Contains times that solenoids were closed
-        self.time_solenoid_off = []
+        #: EventStore: When the microscope was triggered and the solenoids
+        # were opened and closed in each trial, with the arduino's millis()
+        # for each event so the times can be remapped once the clock drift is
+        # known at the end, and each event's delta from the schedule
+        self.event_store = EventStore(self.solenoid_order, self.schedule)
+        self.save_schedule()
 
         #: int: Whether a string has been sent to the arduino
         # If sent = 1, then that means a string has been sent to the arduino
         # and we need to wait for it to be done
         self.sent = 0
 
-        #: list: List of times when microscope has been triggered via TTL
-        self.time_scope_TTL = []
-        self.open_port()
+        #: SessionClock: Maps the host's perf_counter onto the wall clock,
+        # which is read only once so clock adjustments during the session
+        # can't move event times
+        self.clock = SessionClock()
+
+        #: ClockSync: Maps arduino millis() onto the host's perf_counter
+        self.clock_sync = ClockSync()
+
+        #: int: Sequence number of the next frame sent to the arduino
+        self.tx_seq = 0
+
+        #: deque: Command frames waiting to be sent, as (seq, frame)
+        self.commands = deque()
+
+        #: list: The command frame waiting to be acknowledged, as
+        # [seq, frame, time sent, number of resends]
+        self.pending_command = None
+
+        #: bool: Whether the arduino asked for the pending command again
+        self.resend_now = False
+
+        #: float: How long in s to wait for the arduino to acknowledge a command
+        self.ack_timeout = 0.5
+
+        #: int: How many times a command is resent before giving up
+        self.max_resends = 5
+
+        #: int: Number of frames that were corrupted, lost or resent
+        self.protocol_errors = 0
+
+        #: int: The arduino's count of completed trials when the session started
+        self.trials_base = None
+
+        #: int: Baud rate currently used by the host and the arduino. Both
+        # start at 9600 and negotiate up from there.
+        self.baud_rate = 9600
+
+        #: list: Faster baud rates to try, in increasing order
+        self.baud_rates = [115200, 500000, 1000000]
+
+        #: float: How long in s the arduino waits for pings at a new baud
+        # rate before falling back to the previous one
+        self.baud_confirm_time = 1.0
+
+        #: int: Number of pings that must be answered to confirm a baud rate
+        self.baud_confirm_pings = 3
+
+        #: float: How long in s the arduino may stay silent before sending a
+        # status message to show it is still running, or 0 to stay silent
+        # until an event happens
+        self.keepalive_interval = 1.0
+
+        #: int: Number of trials sent ahead of the one running, so the arduino
+        # can start the next trial as soon as the current delay ends. 0 sends
+        # each trial only after the previous one has finished.
+        self.pipeline_depth = 1
+
+        #: int: Number of trials queued to be sent to the arduino so far
+        self.trials_queued = 0
+
+        #: int: Firmware version reported by the arduino's ready reply
+        self.firmware_version = None
+
+        #: bool: Whether to ask the arduino for its status, e.g. after a lost
+        # frame
+        self.status_requested = False
+
+        #: float: Host time in s when the last message from the arduino arrived
+        self.last_msg_time = None
+
+        #: bool: Whether the user has been told the arduino went silent
+        self.silence_reported = False
+
+        #: str: Whether the serial conversation runs in a thread or on asyncio
+        self.engine = engine
+
+        #: bool: Whether the whole odor sequence is uploaded at once
+        self.sequence_upload = sequence_upload
+
+        self.configure_port()
+
+        #: SerialTransport or AsyncArduinoTransport: Carries out the
+        # conversation's requests on the port for the chosen engine
+        if self.engine == "asyncio":
+            self.transport = AsyncArduinoTransport(self.arduino)
+        else:
+            self.transport = SerialTransport(self.arduino)
+
         self.update()
 
-    def open_port(self):
-        """Opens arduino port.
+    def configure_port(self):
+        """Sets up the arduino port without opening it.
 
         As of Nov 16, 2023, the Arduino board controlling 1% odor valves is
         connected via COM8, and the board controlling 10% odor valves is
@@ -139,40 +361,370 @@ class ArduinoSession(UserControl):
         #: serial.Serial: The Serial instance used in this session
         self.arduino = serial.Serial()
 
-        if self.panel_type == "1%":
-            #: str: The port to activate, depending on which panel to deliver.
+        if self.port is not None:
+            pass
+        elif self.panel_type == "1%":
             self.port = "COM8"
         elif self.panel_type == "10%":
             self.port = "COM7"
 
         # self.arduino.port = "COM8"  # Change COM PORT if COMPort error occurs
         self.arduino.port = self.port
-        self.arduino.baudrate = 9600
+        self.arduino.baudrate = self.baud_rate
         self.arduino.timeout = 2
         self.arduino.setRTS(False)
 
-        self.arduino.open()
+    def show_port_opened(self):
+        """Shows that the arduino port has been opened."""
+
         self.port_opened = True
         self.progress_bar_text.value = f"Arduino port {self.port} opened."
+        self.update()
 
-    def close_port(self):
-        """Closes arduino port."""
+    def abort(self):
+        """Stops the experiment. Wakes the transport immediately if it is
+        waiting on the arduino."""
 
-        self.arduino.close()
-        self.port_opened = False
+        self.stop_threads.set()
+        self.transport.abort()
+
+    def log(self, text: str):
+        """Prints experiment progress on the I/O worker.
+
+        Args:
+            text: The text to print.
+        """
+
+        self.io_worker.submit(print, text)
+
+    def make_frame(self, msg_type: str, payload: bytes = b""):
+        """Packs a message to the arduino into a frame with the next sequence
+        number.
+
+        Args:
+            msg_type: The single character message type.
+            payload: The message contents.
+
+        Returns:
+            The frame's sequence number and the frame as bytes.
+        """
+
+        seq = self.tx_seq
+        self.tx_seq = (self.tx_seq + 1) & 0xFF
+        self.journal.log_command(msg_type, payload)
+
+        return seq, encode_frame(msg_type, seq, payload)
+
+    def queue_command(self, msg_type: str, payload: bytes = b""):
+        """Queues a command frame to be sent once the previous command has been
+        acknowledged.
+
+        Args:
+            msg_type: The single character message type.
+            payload: The message contents.
+        """
+
+        self.commands.append(self.make_frame(msg_type, payload))
+
+    def frames_to_send(self):
+        """Gets the command frames that should be written to the arduino now.
+
+        Commands are sent one at a time. The next queued command is sent once
+        the previous one has been acknowledged, and a command that hasn't been
+        acknowledged in time is sent again.
+
+        Returns:
+            List of frames to write.
+        """
+
+        now = time.perf_counter()
+        frames = []
+
+        if self.status_requested:
+            self.status_requested = False
+            frames.append(self.make_hello()[1])
+
+        if self.pending_command is None:
+            if not self.commands:
+                return frames
+
+            seq, frame = self.commands.popleft()
+            self.pending_command = [seq, frame, now, 0]
+            return frames + [frame]
+
+        seq, frame, sent, resends = self.pending_command
+
+        if self.resend_now or now - sent > self.ack_timeout:
+            self.resend_now = False
+
+            if resends >= self.max_resends:
+                self.arduino_step_text.value = "Arduino is not responding."
+                self.log(self.arduino_step_text.value)
+                self.abort()
+                return []
+
+            self.pending_command = [seq, frame, now, resends + 1]
+            self.protocol_errors += 1
+            return frames + [frame]
+
+        return frames
+
+    def make_hello(self):
+        """Packs a hello frame asking the arduino for its version and status.
+
+        Returns:
+            The frame's sequence number and the frame as bytes.
+        """
+
+        keepalive_ms = round(self.keepalive_interval * 1000)
+
+        return self.make_frame("H", keepalive_ms.to_bytes(2, "little"))
+
+    def check_version(self, event: ArduinoEvent):
+        """Checks the firmware version in the arduino's ready reply.
+
+        Args:
+            event: The ready reply, or None if the hello wasn't answered.
+
+        Returns:
+            Whether the arduino answered and runs the expected firmware.
+        """
+
+        if event is None:
+            return False
+
+        self.firmware_version = event.value
+        self.log(f"Arduino firmware version {self.firmware_version}")
+
+        if self.firmware_version != FIRMWARE_VERSION:
+            self.arduino_step_text.value = (
+                f"Arduino runs firmware version {self.firmware_version}, "
+                f"expected {FIRMWARE_VERSION}. Upload arduino_sketch again."
+            )
+            self.log(self.arduino_step_text.value)
+            self.abort()
+            return False
+
+        return True
+
+    def check_ready(self, event: ArduinoEvent):
+        """Checks whether a message shows that the arduino is running.
+
+        Args:
+            event: The message received from the arduino.
+
+        Returns:
+            Whether the message is a status message.
+        """
+
+        if event is None or event.msg != "y":
+            return False
+
+        self.trials_base = event.value
+        self.last_msg_time = time.perf_counter()
+
+        return True
+
+    def handshake(self):
+        """Sends a hello and waits for the arduino's ready reply and status.
+
+        The arduino resets when the port is opened, so the hello goes
+        unanswered until it has booted. The conversation keeps trying until
+        it succeeds or the experiment is aborted.
+
+        Like every step of the conversation, this yields requests to the
+        transport (see components.sequencer) instead of using the port.
+
+        Returns:
+            Whether the arduino is ready.
+        """
+
+        seq, frame = self.make_hello()
+        yield Write(frame)
+
+        event = yield from self.wait_for_msg("r", self.ack_timeout, seq)
+        if not self.check_version(event):
+            return False
+
+        event = yield from self.wait_for_msg("y", self.ack_timeout)
+
+        return self.check_ready(event)
+
+    def check_alive(self):
+        """Warns once when the arduino has missed several keepalives."""
+
+        if not self.keepalive_interval or self.last_msg_time is None:
+            return
+
+        silent_time = time.perf_counter() - self.last_msg_time
+
+        if silent_time > 5 * self.keepalive_interval and not self.silence_reported:
+            self.silence_reported = True
+            self.arduino_step_text.value = (
+                f"No message from Arduino for {silent_time:.0f} s, check that "
+                "it is still connected."
+            )
+            self.log(self.arduino_step_text.value)
+            self.update()
+
+    def wait_for_msg(self, msg: str, timeout: float, reply_seq: int = None):
+        """Waits for a message of one type from the arduino, discarding any
+        other messages received in the meantime.
+
+        Args:
+            msg: The message type to wait for.
+            timeout: How long in s to wait.
+            reply_seq: If given, only accept a reply to the command with this
+                seq, so that late replies to earlier commands are skipped.
+
+        Returns:
+            The ArduinoEvent, or None if it didn't arrive in time.
+        """
+
+        deadline = time.perf_counter() + timeout
+
+        while not self.stop_threads.is_set():
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+
+            event = yield ReadEvent(remaining)
+            if (
+                event is not None
+                and event.msg == msg
+                and (reply_seq is None or event.reply_seq == reply_seq)
+            ):
+                return event
+
+        return None
+
+    def check_baud_rate(self, num_pings: int):
+        """Checks that pings are answered at the host's current baud rate.
+
+        Args:
+            num_pings: Number of pings that must all be answered.
+
+        Returns:
+            Whether every ping was answered with a valid frame.
+        """
+
+        for ping in range(num_pings):
+            seq, frame = self.make_frame("?")
+            yield Write(frame)
+            if (yield from self.wait_for_msg("p", self.ack_timeout, seq)) is None:
+                return False
+
+        return True
+
+    def negotiate_baud(self):
+        """Steps the baud rate up through baud_rates, falling back to the last
+        rate that worked as soon as one fails.
+
+        For each rate, a "B" command asks the arduino to switch. Both sides
+        then switch, and the rate is kept only if the arduino receives and
+        answers baud_confirm_pings pings without errors. Otherwise the arduino
+        returns to the previous rate after baud_confirm_time.
+        """
+
+        for baud_rate in self.baud_rates:
+            if self.stop_threads.is_set():
+                break
+
+            seq, frame = self.make_frame("B", baud_rate.to_bytes(4, "little"))
+            yield Write(frame)
+            reply = yield from self.wait_for_msg("a", self.ack_timeout, seq)
+
+            if reply is not None:
+                yield SetBaudRate(baud_rate)
+                if (yield from self.check_baud_rate(self.baud_confirm_pings)):
+                    self.baud_rate = baud_rate
+                    continue
+
+            # Wait for the arduino to give up on the new rate, then make sure
+            # which rate it ended up on
+            yield SetBaudRate(self.baud_rate)
+            yield Sleep(self.baud_confirm_time)
+            for fallback_rate in [self.baud_rate, baud_rate]:
+                yield SetBaudRate(fallback_rate)
+                if (yield from self.check_baud_rate(1)):
+                    self.baud_rate = fallback_rate
+                    break
+            break
+
+        yield SetBaudRate(self.baud_rate)
+        self.log(f"Arduino baud rate {self.baud_rate}")
+
+    def sync_clock(self, num_pings: int = 5, timeout: float = 0.5):
+        """Pings the arduino to estimate the offset and drift of its clock.
+
+        Called once when the session starts and once when it ends. Other
+        messages received while waiting for a ping reply are discarded.
+
+        Args:
+            num_pings: Number of round-trip pings to send.
+            timeout: How long in s to wait for each ping reply.
+        """
+
+        self.clock_sync.new_batch()
 
-    def get_arduino_msg(self):
-        """Gets message back from arduino after sending it a string."""
+        for ping in range(num_pings):
+            seq, frame = self.make_frame("?")
+            sent = time.perf_counter_ns()
+            yield Write(frame)
 
-        if self.arduino.isOpen():
-            sent_info = self.arduino.readline().strip()
-            arduino_msg = sent_info.decode("utf-8")
+            event = yield from self.wait_for_msg("p", timeout, seq)
+            if event is not None:
+                self.clock_sync.add_sample(sent / 1e9, event.value, event.time / 1e9)
+
+        self.print_clock_sync()
+
+    def print_clock_sync(self):
+        """Prints the current estimate of the arduino clock offset and drift."""
+
+        if self.clock_sync.is_synced():
+            self.log(
+                f"Arduino clock offset {self.clock_offset():.3f} s, drift "
+                f"{(self.clock_sync.drift - 1) * 1e6:.1f} ppm, best round trip "
+                f"{self.clock_sync.best_round_trip() * 1000:.1f} ms"
+            )
         else:
-            arduino_msg = None
+            self.log("Arduino did not answer clock sync pings, using host times")
+
+    def clock_offset(self):
+        """Returns the wall-clock time in s since the epoch at arduino time 0,
+        from the current clock fit."""
 
-        return arduino_msg
+        return self.clock.to_wall_ns(self.clock_sync.offset * 1e9) / 1e9
+
+    def event_time(self, event: ArduinoEvent):
+        """Gets the time an event happened on the arduino.
+
+        Args:
+            event: The message received from the arduino.
+
+        Returns:
+            The arduino's timestamp mapped onto the host's wall clock in ns
+            since the epoch, or the time the message was received if the
+            clock hasn't been synced.
+        """
 
-    def parse_arduino_msg(self, trial: int, solenoid: int):
+        if event.value is not None and self.clock_sync.is_synced():
+            return self.clock.to_wall_ns(self.clock_sync.to_ns(event.value))
+
+        return self.clock.to_wall_ns(event.time)
+
+    def remap_timings(self):
+        """Recomputes the solenoid timings with the final clock fit and
+        rewrites the timings csv."""
+
+        if not self.clock_sync.is_synced() or not self.trials_saved:
+            return
+
+        self.event_store.remap(self.clock_sync, self.clock)
+
+        self.io_worker.submit(self.rewrite_timings, self.trials_saved)
+
+    def parse_arduino_msg(self, trial: int, solenoid: int, event: ArduinoEvent):
         """Translates the message sent back from arduino into informative
         timestamps.
 
@@ -181,15 +733,51 @@ class ArduinoSession(UserControl):
         Args:
             trial: The trial currently being sent to the Arduino board.
             solenoid: The solenoid to activate for the current trial.
+            event: The message and the time it was received from the arduino.
         """
 
-        arduino_msg = self.get_arduino_msg()
-        print(arduino_msg)
+        arduino_msg = event.msg
+        self.log(arduino_msg)
 
-        # Update: check if y is anywhere in the messageReceived in case
-        # arduino sends too many at once
-        if arduino_msg is None or "y" in arduino_msg:
-            pass
+        if arduino_msg in "9123":
+            time_ns = self.event_time(event)
+            self.event_store.record(trial, arduino_msg, time_ns, event.value)
+        else:
+            time_ns = self.clock.to_wall_ns(event.time)
+        self.journal.log_event(trial, event, time_ns)
+
+        self.last_msg_time = time.perf_counter()
+        self.silence_reported = False
+
+        if arduino_msg == "y":
+            # Status messages carry the arduino's count of completed trials,
+            # which shows whether a "3" was lost
+            if (
+                self.sent == 1
+                and event.value is not None
+                and self.trials_base is not None
+                and event.value - self.trials_base >= trial + 1
+            ):
+                self.log(f"Trial {trial+1} finished but its events were lost")
+                self.save_solenoid_timings(trial)
+                self.sent = 0
+
+        elif arduino_msg == "a":
+            if self.pending_command is not None and (
+                event.reply_seq == self.pending_command[0]
+            ):
+                self.pending_command = None
+
+        elif arduino_msg == "n":
+            self.resend_now = True
+
+        elif arduino_msg == "e":
+            self.protocol_errors += event.value
+            self.log(f"{event.value} messages from Arduino were corrupted or lost")
+
+            # The arduino only speaks when something happens, so ask for its
+            # count of completed trials in case the lost message was a "3"
+            self.status_requested = True
 
         else:
             if arduino_msg == "9":
@@ -197,92 +785,97 @@ class ArduinoSession(UserControl):
                     f"Executing Trial {trial+1}/" f"{len(self.solenoid_order)}"
                 )
                 # Time when microscope has been triggered via TTL
-                time_TTL = datetime.datetime.now().isoformat(
-                    "|", timespec="milliseconds"
-                )
-                self.time_scope_TTL.append(time_TTL)
+                time_TTL = clock_time(time_ns)
 
                 self.arduino_step_text.value = (
                     f"Trial {trial+1}, Odor "
                     f"{solenoid} microscope triggered at {time_TTL}"
                 )
 
-                print(
+                self.log(
                     f"Trial {trial+1}, Odor {solenoid} microscope triggered at "
                     f"{time_TTL}"
                 )
 
-                self.update_log(trial + 1, solenoid, "9", time_TTL)
+                self.update_log(trial + 1, solenoid, "9", time_ns)
 
             elif arduino_msg == "1":
-                time_solenoid_on = datetime.datetime.now().isoformat(
-                    "|", timespec="milliseconds"
-                )
-                self.time_solenoid_on.append(time_solenoid_on)
+                time_solenoid_on = clock_time(time_ns)
                 self.arduino_step_text.value = (
                     f"Trial {trial+1}, Odor "
                     f"{solenoid} released at {time_solenoid_on}"
                 )
 
-                print(
+                self.log(
                     f"Trial {trial+1}, Odor {solenoid} released at "
                     f"{time_solenoid_on}"
                 )
 
-                self.update_log(trial + 1, solenoid, "1", time_solenoid_on)
+                self.update_log(trial + 1, solenoid, "1", time_ns)
 
             elif arduino_msg == "2":
-                time_solenoid_off = datetime.datetime.now().isoformat(
-                    "|", timespec="milliseconds"
-                )
-                self.time_solenoid_off.append(time_solenoid_off)
+                time_solenoid_off = clock_time(time_ns)
                 self.arduino_step_text.value = (
                     f"Trial {trial+1}, Odor "
                     f"{solenoid} stopped. Delay started at {time_solenoid_off}"
                 )
 
-                print(
+                self.log(
                     f"Trial {trial+1}, Odor {solenoid} stopped at "
                     f"{time_solenoid_off}"
                 )
 
-                self.update_log(trial + 1, solenoid, "2", time_solenoid_off)
+                self.update_log(trial + 1, solenoid, "2", time_ns)
                 self.save_solenoid_timings(trial)
 
+            elif arduino_msg == "8":
+                # Number of trials the arduino stored from the sequence upload
+                stored_trials = event.value
+
+                if stored_trials == len(self.solenoid_order):
+                    self.arduino_step_text.value = (
+                        f"Sequence of {stored_trials} trials uploaded to Arduino"
+                    )
+                else:
+                    self.arduino_step_text.value = (
+                        f"Arduino stored {stored_trials} of "
+                        f"{len(self.solenoid_order)} trials, upload failed"
+                    )
+                    self.abort()
+
+                self.log(self.arduino_step_text.value)
+
             elif arduino_msg == "3":
                 self.arduino_step_text.value = (
                     f"Trial {trial+1}, Odor "
                     f"{solenoid} delay finished, send next solenoid info"
                 )
 
-                print(
+                self.log(
                     f"Trial {trial+1}, Odor {solenoid} delay stopped, send next "
                     "solenoid info"
                 )
 
-                self.update_log(trial + 1, solenoid, "3", None)
+                self.update_log(trial + 1, solenoid, "3", time_ns)
 
-                self.sent = 0
+                if self.trials_saved < trial + 1:
+                    self.save_solenoid_timings(trial)
 
-            # self.update()
+                self.sent = 0
 
-        self.update()
+            self.update()
 
-    def update_log(self, trial: int, odor: int, step: str, isotime: str):
+    def update_log(self, trial: int, odor: int, step: str, time_ns: int):
         """Updates the app's output log with Arduino's experiment progress.
 
         Args:
             trial: The trial currently being sent to the Arduino board.
             odor: The odor being delivered in the current trial.
             step: Integer representing the current step of the delivery process
-            isotime: The time of the current step
+            time_ns: The time of the current step in ns since the epoch
         """
 
-        if step != "3":
-            time_obj = datetime.datetime.fromisoformat(isotime)
-            time = time_obj.strftime("%H:%M:%S")
-        else:
-            time = datetime.datetime.now().strftime("%H:%M:%S")
+        time = clock_time(time_ns)[:8]
         step_text_dict = {
             "9": f"microscope triggered",
             "1": f"released",
@@ -298,115 +891,418 @@ class ArduinoSession(UserControl):
 
         self.update
 
-    def generate_arduino_str(self):
-        """Generates arduino execution strings in format "x, y, z".
+    def queue_trial(self, trial: int):
+        """Queues the "T" command for one trial.
+
+        Args:
+            trial: The trial to send to the Arduino board.
+        """
+
+        self.queue_command(
+            "T",
+            encode_trial(
+                self.solenoid_order[trial],
+                int(self.odor_ms[trial]),
+                int(self.btw_ms[trial]),
+            ),
+        )
+        self.log(f"to be sent is trial {trial+1}, odor {self.solenoid_order[trial]}")
+
+    def queue_trials_ahead(self, trial: int):
+        """Queues the "T" commands for a trial and for up to pipeline_depth
+        trials after it that haven't been queued yet.
 
-        x = solenoid number
-        y = odor duration (s)
-        z = time between odors (s)
+        Args:
+            trial: The trial about to run.
         """
 
-        if self.trig_signal == True:
+        last_trial = min(trial + self.pipeline_depth, len(self.solenoid_order) - 1)
+
+        while self.trials_queued <= last_trial:
+            self.queue_trial(self.trials_queued)
+            self.trials_queued += 1
+
+    def cancel_trials(self):
+        """Tells the arduino to drop the trials it has queued but not started,
+        so that nothing runs after an abort."""
+
+        self.commands.clear()
+        self.pending_command = None
+        yield Write(self.make_frame("C")[1])
+
+    def queue_sequence(self):
+        """Queues the whole odor sequence as an "S" command with the number of
+        trials, followed by "Q" commands holding the trials."""
+
+        trials = [
+            encode_trial(solenoid, odor_ms, btw_ms)
+            for solenoid, odor_ms, btw_ms in zip(
+                self.solenoid_order, self.odor_ms.tolist(), self.btw_ms.tolist()
+            )
+        ]
+
+        self.queue_command("S", len(trials).to_bytes(2, "little"))
+        for start in range(0, len(trials), MAX_TRIALS_PER_FRAME):
+            self.queue_command(
+                "Q", b"".join(trials[start : start + MAX_TRIALS_PER_FRAME])
+            )
+        self.log(f"to be sent is sequence of {len(trials)} trials")
+
+    def start_trial(self, trial: int):
+        """Updates the progress bar before a trial is sent to the arduino.
+
+        Args:
+            trial: The trial about to be sent to the Arduino board.
+        """
+
+        self.progress_bar.value = trial * (1 / len(self.solenoid_order))
+        self.update()
+        self.log(f"doing trial {trial+1}")
+
+    def finish_sequence(self):
+        """Displays whether the odor sequence completed or was aborted, and
+        saves the session info."""
+
+        outcome = "aborted" if self.stop_threads.is_set() else "complete"
+        self.finished = True
+
+        self.io_worker.submit(self.timings_writer.close)
+        self.save_session_info()
+        self.archive_session(outcome)
+        self.journal.finish(outcome)
+
+        if self.index_path is not None:
+            self.io_worker.submit(self.index_session, outcome)
+
+        if self.stop_threads.is_set():
             self.progress_bar_text.value = (
-                f"Press Start/Run on Thor Images to start odor delivery"
+                "Experiment aborted. Press "
+                "Reset Settings to start a new experiment, or Start "
+                "Experiment to redo the same odor sequence."
             )
-            for trial in range(len(self.solenoid_order)):
-                self.progress_bar.value = trial * (1 / len(self.solenoid_order))
-                self.update()
-                print(f"doing trial {trial+1}")
-
-                to_be_sent = (
-                    f"<{self.solenoid_order[trial]},{self.acq_params['odor_duration']},"
-                    f"{self.acq_params['time_btw_odors']}>"
-                )
 
-                self.sent = 1
+        else:
+            self.sequence_complete = True
+            self.trig_signal = False
+            self.progress_bar.value = len(self.solenoid_order) * (
+                1 / len(self.solenoid_order)
+            )
+
+            self.progress_bar_text.value = "Odor delivery sequence complete."
+
+    def end_session(self):
+        """Finishes the journal as not started if the odor sequence never
+        started, then waits for the session's output. Called once the port is
+        closed on every exit path of both engines, so a session aborted
+        before the arduino answered the hello isn't offered for resuming
+        later."""
+
+        if not self.finished:
+            self.finished = True
+            self.journal.finish("not started")
+            self.io_worker.submit(self.timings_writer.close)
+
+        self.finish_output()
+
+    def finish_output(self):
+        """Waits until every file and log of the session has been written."""
+
+        if self.owns_io_worker:
+            self.io_worker.stop()
+        else:
+            self.io_worker.flush()
 
-                # Send the information to arduino and wait for something to come back
-                self.arduino.write(to_be_sent.encode())
-                print(f"to be sent is {to_be_sent}")
+    def show_timings_saved(self):
+        """Shows snack bar message with the name of the solenoid timings file."""
 
-                while not self.stop_threads.is_set() and self.sent == 1:
-                    # while self.sent == 1:
+        timings_name = (
+            f"{self.date}_{self.animal_id}_"
+            f"{self.roi}_solenoid_timings_{self.csv_time}.csv"
+        )
+
+        self.page.snack_bar.content.value = (
+            f"Solenoid timings "
+            f"saved to "
+            f"{timings_name} in "
+            f"experiment "
+            f"directory."
+        )
+        self.page.snack_bar.open = True
+        self.page.update()
+
+    def generate_arduino_str(self):
+        """Sends the execution string for each trial to the arduino and waits
+        for the trial to finish before sending the next one."""
+
+        yield from self.negotiate_baud()
+        yield from self.sync_clock()
+
+        self.progress_bar_text.value = (
+            f"Press Start/Run on Thor Images to start odor delivery"
+        )
+
+        if self.sequence_upload:
+            self.queue_sequence()
+
+        for trial in range(len(self.solenoid_order)):
+            self.start_trial(trial)
+
+            self.sent = 1
+
+            # Send the information to arduino and wait for something to come
+            # back. Uploaded sequences run without being sent again.
+            if not self.sequence_upload:
+                self.queue_trials_ahead(trial)
+
+            while not self.stop_threads.is_set() and self.sent == 1:
+                for frame in self.frames_to_send():
+                    yield Write(frame)
+
+                # Only wake up without a message to resend unacknowledged
+                # commands or to notice a silent arduino. Aborting wakes the
+                # transport right away.
+                if self.pending_command:
+                    timeout = self.ack_timeout
+                else:
+                    timeout = self.keepalive_interval or None
+
+                event = yield ReadEvent(timeout)
+                if event is not None:
                     self.parse_arduino_msg(
                         trial,
                         self.solenoid_order[trial],
+                        event,
                     )
+                else:
+                    self.check_alive()
 
-                    self.update()
+            if self.stop_threads.is_set():
+                break
 
-                if self.stop_threads.is_set():
-                    break
+        # The arduino is busy mid-trial after an abort, so only sync again
+        # once every trial has finished
+        if not self.stop_threads.is_set():
+            yield from self.sync_clock()
+            self.remap_timings()
+        else:
+            yield from self.cancel_trials()
 
-            if self.stop_threads.is_set():
-                self.progress_bar_text.value = (
-                    "Experiment aborted. Press "
-                    "Reset Settings to start a new experiment, or Start "
-                    "Experiment to redo the same odor sequence."
-                )
+        self.finish_sequence()
+        self.update()
+        self.io_worker.submit(self.show_timings_saved)
 
-            else:
-                self.sequence_complete = True
+    def conversation(self):
+        """Says hello until the arduino is ready, then delivers the odor
+        sequence. The same steps run on both engines."""
+
+        while not self.stop_threads.is_set():
+            if (yield from self.handshake()):
+                self.trig_signal = True
+                yield from self.generate_arduino_str()
                 self.trig_signal = False
-                self.progress_bar.value = len(self.solenoid_order) * (
-                    1 / len(self.solenoid_order)
-                )
+                break
 
-                self.progress_bar_text.value = "Odor delivery sequence complete."
+    def run(self):
+        """Runs the whole serial conversation in the calling thread, with
+        messages read by the serial reader thread."""
 
-            self.close_port()
-            self.update()
+        try:
+            self.transport.open()
+            self.show_port_opened()
+            run_steps(self.conversation(), self.transport)
+        finally:
+            self.transport.close()
+            self.port_opened = False
+            self.end_session()
+
+    async def run_async(self):
+        """Runs the whole serial conversation on one asyncio event loop.
+
+        Aborting wakes the loop right away instead of after the next read
+        timeout.
+        """
 
-            timings_name = (
-                f"{self.date}_{self.animal_id}_"
-                f"{self.roi}_solenoid_timings_{self.csv_time}.csv"
-            )
+        try:
+            await self.transport.open()
+            self.show_port_opened()
+            await run_steps_async(self.conversation(), self.transport)
+        finally:
+            await self.transport.close()
+            self.port_opened = False
+            await asyncio.to_thread(self.end_session)
 
-            self.page.snack_bar.content.value = (
-                f"Solenoid timings "
-                f"saved to "
-                f"{timings_name} in "
-                f"experiment "
-                f"directory."
-            )
-            self.page.snack_bar.open = True
-            self.page.update()
+    def timings_row(self, trial: int):
+        """Gets one trial's row of the solenoid timings csv.
+
+        Args:
+            trial: The trial, counting from 0.
+
+        Returns:
+            List of the trial number, odor, the times the microscope was
+            triggered and the solenoid was opened and closed, and the seeds
+            the trials were shuffled and timed with.
+        """
+
+        return self.event_store.timings_row(trial) + [
+            self.acq_params.get("seed"),
+            self.acq_params.get("timing_seed"),
+        ]
+
+    def write_timings_row(self, trial: int):
+        """Formats one trial's times and appends them to the timings csv.
+        Runs on the I/O worker, so the times are formatted off the serial
+        loop.
+
+        Args:
+            trial: The trial, counting from 0.
+        """
+
+        self.timings_writer.write_row(self.timings_row(trial))
+
+    def rewrite_timings(self, num_trials: int):
+        """Formats every saved trial's times and rewrites the timings csv.
+        Runs on the I/O worker.
+
+        Args:
+            num_trials: Number of trials saved so far.
+        """
+
+        self.timings_writer.rewrite(
+            [self.timings_row(trial) for trial in range(num_trials)]
+        )
 
     def save_solenoid_timings(self, trial: int):
         """Saves the timestamps for when each solenoid was triggered, opened,
         and closed to a .csv file.
 
-        Entries for each trials are added to the csv after each trial has
-        been completed, so the file is updated in real-time.
+        Entries for each trials are appended to the csv after each trial has
+        been completed, so the file is updated in real-time. Trials already
+        in the file aren't written again. The rows are written on the I/O
+        worker.
 
         Args:
             trial: The current trial of the timings being written to the file.
         """
-        csv_name = (
-            f"{self.date}_{self.animal_id}_{self.roi}_solenoid_timings_"
-            f"{self.csv_time}.csv"
+
+        for row_trial in range(self.trials_saved, trial + 1):
+            self.io_worker.submit(self.write_timings_row, row_trial)
+        self.trials_saved = max(self.trials_saved, trial + 1)
+
+    def archive_session(self, outcome: str):
+        """Adds the session's settings, trial order and event times to the
+        Parquet archive, if one is set.
+
+        Args:
+            outcome: How the session ended, e.g. "complete" or "aborted".
+        """
+
+        if self.archive_path is None:
+            return
+
+        if not ARCHIVE_AVAILABLE:
+            self.log("pyarrow is not installed, session not archived")
+            return
+
+        self.io_worker.submit(
+            write_session_archive,
+            self.archive_path,
+            self.acq_params,
+            self.panel_type,
+            self.csv_time,
+            self.event_store,
+            outcome,
         )
-        path = os.path.join(self.directory_path, csv_name)
 
-        if trial == 0:
-            trial_labels = [trial + 1]
-        else:
-            trial_labels = list(range(1, trial + 2))
+    def output_path(self, kind: str, extension: str = "csv"):
+        """Gets the path of one of the session's files.
 
-        try:
-            timings_df = pd.DataFrame(
+        Args:
+            kind: What the file holds, e.g. "solenoid_timings".
+            extension: The file extension.
+
+        Returns:
+            Path of the file in the experiment directory.
+        """
+
+        return os.path.join(
+            self.directory_path,
+            f"{self.date}_{self.animal_id}_{self.roi}_{kind}_{self.csv_time}"
+            f".{extension}",
+        )
+
+    def index_session(self, outcome: str):
+        """Adds the session to the experiment index with its files, status and
+        timing stats, in one transaction. Runs on the I/O worker once the
+        session has ended.
+
+        Args:
+            outcome: How the session ended, e.g. "complete" or "aborted".
+        """
+
+        ExperimentIndex(self.index_path).add_session(
+            session_entry(
+                self.acq_params,
+                self.panel_type,
+                self.csv_time,
+                self.event_store,
+                outcome,
                 {
-                    "Trial": trial_labels,
-                    f"Odor {self.panel_type}": self.solenoid_order[: trial + 1],
-                    "Microscope Triggered": self.time_scope_TTL,
-                    "Solenoid opened": self.time_solenoid_on,
-                    "Solenoid closed": self.time_solenoid_off,
-                }
+                    "order_path": self.output_path("solenoid_order"),
+                    "timings_path": self.timings_writer.path,
+                    "info_path": self.output_path("session_info"),
+                    "journal_path": self.journal.path,
+                },
+                self.protocol_errors,
             )
-        except ValueError:
-            pdb.set_trace()
+        )
+
+    def save_schedule(self):
+        """Saves the predicted schedule next to the solenoid order csv, as
+        offsets in ms from the first microscope trigger."""
 
-        timings_df.to_csv(path, index=False)
+        schedule_df = self.schedule.to_dataframe(self.panel_type)
+        self.io_worker.submit(
+            schedule_df.to_csv, self.output_path("solenoid_schedule"), index=False
+        )
+
+    def save_session_info(self):
+        """Saves how the serial link performed during the session to a .csv
+        file next to the solenoid timings."""
+
+        path = self.output_path("session_info")
+
+        session_info = {
+            "Firmware version": self.firmware_version,
+            "Keepalive interval (s)": self.keepalive_interval,
+            "Baud rate": self.baud_rate,
+            "Protocol errors": self.protocol_errors,
+            "Output jobs backlogged": self.io_worker.backlogged_jobs,
+            "Longest output wait (s)": self.io_worker.max_delay,
+            "Most output jobs waiting": self.io_worker.max_waiting,
+            "Wall clock read at": iso_time(self.clock.wall_anchor_ns),
+            "Wall clock read within (us)": self.clock.anchor_uncertainty_ns / 1000,
+            "Largest drift from schedule (ms)": self.event_store.largest_delta_ms(),
+            "Trial order seed": self.acq_params.get("seed"),
+            "Trial timing seed": self.acq_params.get("timing_seed"),
+        }
+
+        if self.acq_params.get("resumed_from") is not None:
+            session_info["Resumed from session"] = self.acq_params["resumed_from"]
+            session_info["Resumed from trial"] = self.acq_params[
+                "resumed_first_trial"
+            ]
+
+        if self.clock_sync.is_synced():
+            session_info["Clock offset (s)"] = self.clock_offset()
+            session_info["Clock drift (ppm)"] = (self.clock_sync.drift - 1) * 1e6
+            session_info["Sync round trip (ms)"] = (
+                self.clock_sync.best_round_trip() * 1000
+            )
+
+        info_df = pd.DataFrame(
+            list(session_info.items()), columns=["Setting", "Value"], dtype=object
+        )
+        self.io_worker.submit(info_df.to_csv, path, index=False)
 
     def show_output_log(self, e):
         """Enable or disable display of experiment output log.
@@ -0,0 +1,173 @@
+"""Contains the AsyncArduinoTransport class to open, read from and write to
+the Arduino port from an asyncio event loop."""
+
+import asyncio
+
+import serial
+
+from components.serial_reader import ArduinoEvent, SerialReader
+
+
+class LoopQueue:
+    """Lets the SerialReader thread push events into an asyncio.Queue that
+    belongs to another thread's event loop."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, events: asyncio.Queue):
+        """Initializes the thread-safe wrapper.
+
+        Args:
+            loop: The event loop that owns the queue.
+            events: The asyncio queue that events are pushed into.
+        """
+
+        #: asyncio.AbstractEventLoop: The event loop that owns the queue
+        self.loop = loop
+
+        #: asyncio.Queue: The queue that events are pushed into
+        self.events = events
+
+    def put(self, event: ArduinoEvent):
+        """Schedules the event to be added to the queue on the loop's thread.
+
+        Args:
+            event: The message received from the arduino.
+        """
+
+        self.loop.call_soon_threadsafe(self.events.put_nowait, event)
+
+
+class AsyncArduinoTransport:
+    """Async layer over the Arduino serial port.
+
+    Windows COM ports can't be watched by the event loop directly, so lines
+    are still read by a SerialReader thread. Each line wakes the loop as soon
+    as it lands, so nothing on the loop polls the port.
+    """
+
+    def __init__(self, arduino: serial.Serial):
+        """Initializes the transport for a configured but unopened port.
+
+        Args:
+            arduino: The Serial instance to open.
+        """
+
+        #: serial.Serial: The Serial instance used in this session
+        self.arduino = arduino
+
+        #: asyncio.Queue: ArduinoEvents received from the reader thread
+        self.events = None
+
+        #: SerialReader: Background thread reading messages from the arduino
+        self.reader = None
+
+        #: asyncio.AbstractEventLoop: The loop the transport was opened on
+        self.loop = None
+
+        #: asyncio.Event: Set on the loop when the session is aborted
+        self.abort_event = None
+
+        #: bool: Whether the session has been aborted, even before the
+        # transport was opened
+        self.aborted = False
+
+    async def open(self):
+        """Opens the port and starts feeding events into the loop."""
+
+        loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        self.abort_event = asyncio.Event()
+        self.loop = loop
+        if self.aborted:
+            self.abort_event.set()
+
+        await asyncio.to_thread(self.arduino.open)
+
+        self.reader = SerialReader(self.arduino, LoopQueue(loop, self.events))
+        self.reader.start()
+
+    async def write(self, data: bytes):
+        """Writes data to the arduino without blocking the loop.
+
+        Args:
+            data: The frame to send.
+        """
+
+        await asyncio.to_thread(self.arduino.write, data)
+
+    async def read_event(self, timeout: float = None):
+        """Waits for the next message from the arduino or for an abort.
+
+        Args:
+            timeout: How long in s to wait, or None to wait until a message
+                arrives.
+
+        Returns:
+            The next ArduinoEvent, or None if the wait was aborted or timed
+            out.
+        """
+
+        if self.abort_event.is_set():
+            return None
+
+        get_event = asyncio.ensure_future(self.events.get())
+        wait_abort = asyncio.ensure_future(self.abort_event.wait())
+
+        done, pending = await asyncio.wait(
+            {get_event, wait_abort},
+            timeout=timeout,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for task in pending:
+            task.cancel()
+
+        if get_event in done:
+            return get_event.result()
+
+        return None
+
+    async def set_baud_rate(self, baud_rate: int):
+        """Switches the host side of the port to a new baud rate without
+        blocking the loop.
+
+        Args:
+            baud_rate: The new baud rate.
+        """
+
+        def switch():
+            self.arduino.flush()
+            self.arduino.baudrate = baud_rate
+            self.arduino.reset_input_buffer()
+
+        await asyncio.to_thread(switch)
+
+    async def sleep(self, seconds: float):
+        """Waits without reading, unless aborted first.
+
+        Args:
+            seconds: How long in s to wait.
+        """
+
+        try:
+            await asyncio.wait_for(self.abort_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def abort(self):
+        """Wakes a pending read_event or sleep. Can be called from any
+        thread."""
+
+        self.aborted = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.abort_event.set)
+
+    async def close(self):
+        """Stops the reader thread and closes the port."""
+
+        # The loop may be gone by the time a late abort arrives
+        self.loop = None
+
+        if self.reader is not None:
+            await asyncio.to_thread(self.reader.stop)
+            self.reader = None
+
+        self.arduino.close()
@@ -0,0 +1,111 @@
+"""Contains the ClockSync class to map Arduino millis() timestamps onto the
+host's perf_counter clock."""
+
+import numpy as np
+
+
+class ClockSync:
+    """Estimates the offset and drift between the Arduino clock and the host
+    clock from round-trip pings.
+
+    Each ping records when the host sent it, the arduino's millis() when it
+    answered, and when the host received the answer. The arduino's time is
+    assumed to fall halfway through the round trip, so the pings with the
+    shortest round trip give the best estimates.
+    """
+
+    def __init__(self, min_drift_span: float = 60):
+        """Initializes an empty set of ping samples.
+
+        Args:
+            min_drift_span: Shortest time in s between the first and last
+                batch of pings for the drift to be fitted. Over shorter spans
+                the 1 ms resolution of millis() outweighs any real drift.
+        """
+
+        #: list: Ping samples as (batch, device_ms, host_s, round_trip_s)
+        self.samples = []
+
+        #: int: Index of the current batch of pings, e.g. 0 at session start
+        self.batch = 0
+
+        #: float: Host perf_counter time in s at device time 0
+        self.offset = None
+
+        #: float: Host s elapsed per device s
+        self.drift = None
+
+        #: float: Shortest time in s between batches for fitting the drift
+        self.min_drift_span = min_drift_span
+
+    def new_batch(self):
+        """Starts a new batch of pings, e.g. at the end of the session."""
+
+        if any(sample[0] == self.batch for sample in self.samples):
+            self.batch += 1
+
+    def add_sample(self, sent: float, device_ms: int, received: float):
+        """Adds one round-trip ping and refits the clock mapping.
+
+        Args:
+            sent: Host perf_counter time in s when the ping was sent.
+            device_ms: The arduino's millis() when it answered the ping.
+            received: Host perf_counter time in s when the answer was
+                received.
+        """
+
+        round_trip = received - sent
+        self.samples.append((self.batch, device_ms, sent + round_trip / 2, round_trip))
+        self.fit()
+
+    def fit(self):
+        """Fits host time = offset + drift * device time using the ping with
+        the shortest round trip from the first and last batch."""
+
+        batches = sorted({sample[0] for sample in self.samples})
+        if not batches:
+            return
+
+        first = min(
+            (sample for sample in self.samples if sample[0] == batches[0]),
+            key=lambda sample: sample[3],
+        )
+        last = min(
+            (sample for sample in self.samples if sample[0] == batches[-1]),
+            key=lambda sample: sample[3],
+        )
+
+        if (last[1] - first[1]) / 1000 >= self.min_drift_span:
+            self.drift = (last[2] - first[2]) / ((last[1] - first[1]) / 1000)
+        else:
+            self.drift = 1.0
+
+        self.offset = first[2] - self.drift * first[1] / 1000
+
+    def is_synced(self):
+        """Returns whether at least one ping has been answered."""
+
+        return self.offset is not None
+
+    def to_ns(self, device_ms):
+        """Maps arduino millis() timestamps onto the host's perf_counter
+        clock in ns.
+
+        Args:
+            device_ms: The arduino's millis() for one event, or an array of
+                them.
+
+        Returns:
+            The time.perf_counter_ns() time, as an int or an int64 array.
+        """
+
+        time_ns = np.round(
+            (self.offset + self.drift * np.asarray(device_ms) / 1000) * 1e9
+        ).astype(np.int64)
+
+        return time_ns if time_ns.ndim else int(time_ns)
+
+    def best_round_trip(self):
+        """Returns the shortest round trip in s, as a measure of sync error."""
+
+        return min(sample[3] for sample in self.samples)
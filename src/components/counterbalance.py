@@ -0,0 +1,162 @@
+"""Contains functions to build Latin square and Williams design trial
+orders, and the DesignAssignments class to give each animal and ROI its own
+row of a design.
+
+Each row of a design is one block of trials delivering every odor once. A
+session starts at its assigned row and takes the following rows for its
+next blocks, so every odor is delivered as often in each position of a
+block. In a Latin square every odor takes every position once across the
+rows. A Williams design is a Latin square in which every odor also follows
+every other odor equally often, so carryover from one odor to the next is
+balanced too.
+"""
+
+import sqlite3
+from contextlib import closing
+from functools import lru_cache
+
+import numpy as np
+
+from components.experiment_index import DEFAULT_INDEX_PATH
+
+#: list: Designs that can be chosen in the settings, besides shuffling
+DESIGNS = ["Latin square", "Williams"]
+
+
+@lru_cache(maxsize=None)
+def design_rows(design: str, num_odors: int):
+    """Builds the rows of a design, as positions in the odor list.
+
+    Designs are built once per session of the app and then reused.
+
+    Args:
+        design: "Latin square" or "Williams".
+        num_odors: Number of odors in each row.
+
+    Returns:
+        Read-only array of odor indices with one row per row of the design.
+        Latin squares have num_odors rows, Williams designs 2 * num_odors for
+        an odd number of odors.
+    """
+
+    shifts = np.arange(num_odors)[:, np.newaxis]
+    columns = np.arange(num_odors)
+
+    if design == "Latin square":
+        rows = (shifts + columns) % num_odors
+
+    elif design == "Williams":
+        # First row 0, 1, n-1, 2, n-2, ..., each following row shifted by one
+        first = np.where(columns % 2, (columns + 1) // 2, num_odors - columns // 2)
+        first[0] = 0
+        rows = (shifts + first) % num_odors
+
+        # With an odd number of odors the mirror images are needed to balance
+        # carryover
+        if num_odors % 2:
+            rows = np.concatenate([rows, rows[:, ::-1]])
+
+    else:
+        raise ValueError(f"No trial order design called {design}")
+
+    # The cached rows are shared by every caller
+    rows.flags.writeable = False
+    return rows
+
+
+def counterbalanced_trials(odors: list, num_trials: int, design: str, row: int):
+    """Gets a session's trial order from its row of a design.
+
+    Args:
+        odors: The odors of the session, e.g. [1, 2, 3, 4].
+        num_trials: Number of trials to run per odor, one per block.
+        design: "Latin square" or "Williams".
+        row: The session's first row of the design.
+
+    Returns:
+        The odor of each trial.
+    """
+
+    rows = design_rows(design, len(odors))
+    blocks = rows[(row + np.arange(num_trials)) % len(rows)]
+
+    return np.asarray(odors)[blocks].ravel().tolist()
+
+
+class DesignAssignments:
+    """Which row of a design each animal and ROI starts at, kept in the
+    SQLite experiment index so every animal and ROI gets a different row
+    across sessions of the app."""
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH):
+        """Initializes the assignments, creating their table if needed.
+
+        Args:
+            path: Path of the SQLite database file.
+        """
+
+        #: str: Path of the SQLite database file
+        self.path = path
+
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS design_assignments (design TEXT, "
+                "odors TEXT, animal TEXT, roi TEXT, design_row INTEGER, "
+                "PRIMARY KEY (design, odors, animal, roi))"
+            )
+
+    def connect(self):
+        """Opens a connection to the database.
+
+        Returns:
+            The sqlite3.Connection.
+        """
+
+        return sqlite3.connect(self.path, timeout=10)
+
+    def assign(self, design: str, odors: list, animal: str, roi: str):
+        """Gets the row of a design an animal and ROI starts at.
+
+        An animal and ROI keeps the row it was first given. A new one gets
+        the row used least for the same design and odors, avoiding rows its
+        animal already has for other ROIs where possible.
+
+        Args:
+            design: "Latin square" or "Williams".
+            odors: The odors of the session.
+            animal: Animal ID of the experiment.
+            roi: ROI of the experiment.
+
+        Returns:
+            Index of the row.
+        """
+
+        key = (design, ",".join(str(odor) for odor in odors))
+        num_rows = len(design_rows(design, len(odors)))
+
+        with closing(self.connect()) as connection, connection:
+            assigned = connection.execute(
+                "SELECT animal, roi, design_row FROM design_assignments "
+                "WHERE design = ? AND odors = ?",
+                key,
+            ).fetchall()
+
+            uses = [0] * num_rows
+            animal_rows = set()
+            for assigned_animal, assigned_roi, row in assigned:
+                if (assigned_animal, assigned_roi) == (animal, roi):
+                    return row
+                uses[row] += 1
+                if assigned_animal == animal:
+                    animal_rows.add(row)
+
+            row = min(
+                range(num_rows),
+                key=lambda row: (row in animal_rows, uses[row], row),
+            )
+            connection.execute(
+                "INSERT INTO design_assignments VALUES (?, ?, ?, ?, ?)",
+                key + (animal, roi, row),
+            )
+
+        return row
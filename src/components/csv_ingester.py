@@ -0,0 +1,430 @@
+"""Finds the solenoid order and timings csv files of past sessions and adds
+them to the Parquet session archive, so years of sessions can be queried
+with load_archive.
+
+Run it from the src directory, e.g.
+
+    python -m components.csv_ingester D:/ThorImage D:/session_archive
+
+Each order file is paired with the timings file that has the same csv_time
+stamp, and the session's date, animal and ROI come from its folder name, as
+in OdorDeliveryApp.get_session_info. Sessions are parsed and written by a
+pool of processes. Sizes and modification times of the files already
+ingested are kept in ingest_state.sqlite in the archive, so later runs only
+read new or changed files. Sessions the app archived itself aren't replaced.
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+
+import pandas as pd
+
+from components.event_store import MISSING, EventStore
+from components.predicted_schedule import PredictedSchedule
+from components.session_archive import (
+    ARCHIVE_AVAILABLE,
+    DEFAULT_ARCHIVE_PATH,
+    partition_dir,
+    sessions_table,
+    trials_table,
+    write_partition,
+)
+from components.utils import parse_folder_name
+
+#: re.Pattern: Matches the name of an order or timings csv file
+SESSION_FILE_PATTERN = re.compile(
+    r"^(?P<date>\d{6})_(?P<animal>.+)_(?P<roi>[^_]+)_"
+    r"(?P<kind>solenoid_order|solenoid_timings)_(?P<csv_time>\d{6}-\d{6})\.csv$"
+)
+
+#: re.Pattern: Matches the odor column of an order or timings csv, named
+# after the panel type, and not the timing columns that also start with Odor
+ODOR_COLUMN_PATTERN = re.compile(r"^Odor (?P<panel_type>\d+%)$")
+
+#: dict: Timings csv columns holding times, by the event type they record
+TIME_COLUMNS = {
+    "Microscope Triggered": "9",
+    "Solenoid opened": "1",
+    "Solenoid closed": "2",
+}
+
+
+def scan_files(root: str):
+    """Finds every order and timings csv file under a directory.
+
+    Args:
+        root: The directory to search, e.g. the acquisition drive.
+
+    Returns:
+        List of (path, size, modification time in ns) of each file.
+    """
+
+    files = []
+    directories = [root]
+
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif SESSION_FILE_PATTERN.match(entry.name):
+                stat = entry.stat()
+                files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+
+    return files
+
+
+def session_key(path: str):
+    """Gets the session a csv file belongs to.
+
+    Args:
+        path: Path of an order or timings csv file.
+
+    Returns:
+        The session as (date, animal, roi, csv_time), and which file it is,
+        "solenoid_order" or "solenoid_timings".
+    """
+
+    match = SESSION_FILE_PATTERN.match(os.path.basename(path))
+
+    try:
+        date, animal, roi = parse_folder_name(os.path.basename(os.path.dirname(path)))
+    except IndexError:
+        # Files copied out of their experiment folder still carry the same
+        # names in their own
+        date, animal, roi = match["date"], match["animal"], match["roi"]
+
+    return (date, animal, roi, match["csv_time"]), match["kind"]
+
+
+def group_sessions(files: list):
+    """Pairs each order file with its timings file.
+
+    When copies of a session are found in several places, the copy with the
+    most recently modified files is kept.
+
+    Args:
+        files: List of (path, size, modification time in ns) of each file.
+
+    Returns:
+        Dict of session key to its files, as {kind: (path, size, mtime)}.
+    """
+
+    copies = {}
+    for file_info in files:
+        key, kind = session_key(file_info[0])
+        folder = os.path.dirname(file_info[0])
+        copies.setdefault(key, {}).setdefault(folder, {})[kind] = file_info
+
+    sessions = {}
+    for key, folders in copies.items():
+        sessions[key] = max(
+            folders.values(),
+            key=lambda session_files: max(
+                file_info[2] for file_info in session_files.values()
+            ),
+        )
+
+    return sessions
+
+
+def local_time_ns(values: pd.Series):
+    """Converts times as saved in the timings csv to ns since the epoch.
+
+    Args:
+        values: Times as e.g. "2023-11-16|14:03:27.125" in the local time of
+            the computer running the ingester, or empty.
+
+    Returns:
+        List of times in ns, or MISSING for empty or unreadable times.
+    """
+
+    parsed = pd.to_datetime(
+        values.astype(str).str.replace("|", " ", regex=False), errors="coerce"
+    )
+
+    return [
+        MISSING if pd.isna(value) else round(value.to_pydatetime().timestamp() * 1e9)
+        for value in parsed
+    ]
+
+
+def read_session(order_path: str, timings_path: str):
+    """Reads a session's csv files into an EventStore.
+
+    Args:
+        order_path: Path of the order csv, or None if it is missing.
+        timings_path: Path of the timings csv, or None if it is missing.
+
+    Returns:
+        The EventStore, the panel type, and whether the session was
+        "complete", "incomplete" or "not started".
+    """
+
+    order_df = pd.read_csv(order_path) if order_path else None
+    timings_df = pd.read_csv(timings_path) if timings_path else None
+
+    source_df = order_df if order_df is not None else timings_df
+    odor_column, panel_type = next(
+        (match.string, match["panel_type"])
+        for match in map(ODOR_COLUMN_PATTERN.match, source_df.columns)
+        if match
+    )
+
+    # The order csv is sorted by odor, its Trial column holds the order
+    source_df = source_df.sort_values("Trial")
+    odors = source_df[odor_column].astype(int).tolist()
+
+    # Order csvs of timed sessions hold what was scheduled for each trial
+    schedule = None
+    if {"Odor duration (ms)", "Time btw odors (ms)"} <= set(source_df.columns):
+        schedule = PredictedSchedule(
+            odors,
+            source_df["Odor duration (ms)"].to_numpy(),
+            source_df["Time btw odors (ms)"].to_numpy(),
+        )
+    event_store = EventStore(odors, schedule)
+
+    if timings_df is None or timings_df.empty:
+        return event_store, panel_type, "not started"
+
+    trials = timings_df["Trial"].astype(int).to_numpy() - 1
+    for column, msg in TIME_COLUMNS.items():
+        if column not in timings_df:
+            continue
+        for trial, time_ns in zip(trials, local_time_ns(timings_df[column])):
+            if time_ns != MISSING and trial < event_store.num_trials:
+                event_store.record(int(trial), msg, time_ns)
+
+    outcome = "complete" if len(timings_df) >= len(odors) else "incomplete"
+
+    return event_store, panel_type, outcome
+
+
+def ingest_session(archive_path: str, key: tuple, session_files: dict):
+    """Adds one session to the archive. Runs in a worker process.
+
+    Args:
+        archive_path: The archive's root directory.
+        key: The session as (date, animal, roi, csv_time).
+        session_files: The session's files, as {kind: (path, size, mtime)}.
+
+    Returns:
+        Number of trials in the session.
+    """
+
+    date, animal, roi, csv_time = key
+    order_path = session_files.get("solenoid_order", (None,))[0]
+    timings_path = session_files.get("solenoid_timings", (None,))[0]
+
+    event_store, panel_type, outcome = read_session(order_path, timings_path)
+
+    settings = {
+        "dir_path": os.path.dirname(order_path or timings_path),
+        "date": date,
+        "mouse": animal,
+        "roi": roi,
+        "panel_type": panel_type,
+        "order_path": order_path,
+        "timings_path": timings_path,
+        "source": "csv",
+    }
+
+    name = f"{roi}_{csv_time}"
+    write_partition(
+        archive_path,
+        "sessions",
+        date,
+        animal,
+        name,
+        sessions_table(settings, panel_type, csv_time, outcome),
+    )
+    write_partition(
+        archive_path,
+        "trials",
+        date,
+        animal,
+        name,
+        trials_table(roi, csv_time, event_store),
+    )
+
+    return event_store.num_trials
+
+
+class IngestState:
+    """The sizes and modification times of the csv files already ingested,
+    kept in a SQLite database in the archive."""
+
+    def __init__(self, path: str):
+        """Initializes the state, creating the database if needed.
+
+        Args:
+            path: Path of the SQLite database file.
+        """
+
+        #: str: Path of the SQLite database file
+        self.path = path
+
+        with closing(sqlite3.connect(self.path)) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, "
+                "size INTEGER, mtime_ns INTEGER, session TEXT)"
+            )
+
+        #: dict: (size, mtime_ns) of each ingested file by path
+        self.files = {}
+
+        #: set: Sessions added by the ingester, as JSON session keys
+        self.sessions = set()
+
+        with closing(sqlite3.connect(self.path)) as connection:
+            for path, size, mtime_ns, session in connection.execute(
+                "SELECT path, size, mtime_ns, session FROM files"
+            ):
+                self.files[path] = (size, mtime_ns)
+                self.sessions.add(session)
+
+    def is_current(self, session_files: dict):
+        """Returns whether none of a session's files changed since they were
+        ingested."""
+
+        return all(
+            self.files.get(path) == (size, mtime_ns)
+            for path, size, mtime_ns in session_files.values()
+        )
+
+    def record(self, key: tuple, session_files: dict):
+        """Records that a session's files were ingested, in one transaction.
+
+        Args:
+            key: The session as (date, animal, roi, csv_time).
+            session_files: The session's files, as {kind: (path, size, mtime)}.
+        """
+
+        session = json.dumps(key)
+
+        with closing(sqlite3.connect(self.path)) as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                [
+                    (path, size, mtime_ns, session)
+                    for path, size, mtime_ns in session_files.values()
+                ],
+            )
+
+        for path, size, mtime_ns in session_files.values():
+            self.files[path] = (size, mtime_ns)
+        self.sessions.add(session)
+
+
+def ingest(root: str, archive_path: str, workers: int = None, force: bool = False):
+    """Adds every new or changed session under a directory to the archive.
+
+    Args:
+        root: The directory to search, e.g. the acquisition drive.
+        archive_path: The archive's root directory.
+        workers: Number of processes, or None for one per CPU.
+        force: Whether to read every file again, even unchanged ones.
+
+    Returns:
+        Dict counting the files found and the sessions ingested, unchanged,
+        archived by the app, and failed.
+    """
+
+    if not ARCHIVE_AVAILABLE:
+        raise ImportError("pyarrow is needed to ingest sessions into the archive")
+
+    os.makedirs(archive_path, exist_ok=True)
+    state = IngestState(os.path.join(archive_path, "ingest_state.sqlite"))
+
+    files = scan_files(root)
+    sessions = group_sessions(files)
+
+    summary = {
+        "files": len(files),
+        "ingested": 0,
+        "unchanged": 0,
+        "archived by app": 0,
+        "failed": 0,
+    }
+
+    to_ingest = {}
+    for key, session_files in sessions.items():
+        date, animal, roi, csv_time = key
+        archived = os.path.exists(
+            os.path.join(
+                partition_dir(archive_path, "sessions", date, animal),
+                f"{roi}_{csv_time}.parquet",
+            )
+        )
+
+        if archived and json.dumps(key) not in state.sessions:
+            # The app archived it with its full event times
+            summary["archived by app"] += 1
+        elif not force and state.is_current(session_files):
+            summary["unchanged"] += 1
+        else:
+            to_ingest[key] = session_files
+
+    if not to_ingest:
+        return summary
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(ingest_session, archive_path, key, session_files): key
+            for key, session_files in to_ingest.items()
+        }
+
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                future.result()
+            except Exception as error:
+                summary["failed"] += 1
+                print(f"Could not ingest {to_ingest[key]}: {error!r}")
+            else:
+                state.record(key, to_ingest[key])
+                summary["ingested"] += 1
+
+    return summary
+
+
+def main():
+    """Ingests the sessions under a directory and prints a summary."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", help="directory to search for csv files")
+    parser.add_argument(
+        "archive",
+        nargs="?",
+        default=DEFAULT_ARCHIVE_PATH,
+        help="root directory of the session archive, by default the app's",
+    )
+    parser.add_argument("--workers", type=int, help="processes, default one per CPU")
+    parser.add_argument(
+        "--force", action="store_true", help="read every file again, even unchanged"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    summary = ingest(args.root, args.archive, args.workers, args.force)
+
+    print(
+        ", ".join(f"{count} {name}" for name, count in summary.items())
+        + f" in {time.perf_counter() - start:.1f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Contains the EventStore class to keep the timed events of a session in
+preallocated NumPy arrays."""
+
+import datetime
+import time
+
+import numpy as np
+import pandas as pd
+
+#: str: The timed event types, in the order they happen within a trial
+EVENT_TYPES = "9123"
+
+#: int: Marks a time that wasn't recorded
+MISSING = np.iinfo(np.int64).min
+
+
+def iso_time(time_ns: int):
+    """Formats a time the way the timings csv stores it.
+
+    Args:
+        time_ns: Wall-clock time in ns since the epoch, or MISSING.
+
+    Returns:
+        The time as e.g. "2023-11-16|14:03:27.125", or "" if it is missing.
+    """
+
+    if time_ns == MISSING:
+        return ""
+
+    seconds, remainder = divmod(int(time_ns), 10**9)
+    return (
+        datetime.datetime.fromtimestamp(seconds)
+        .replace(microsecond=remainder // 1000)
+        .isoformat("|", timespec="milliseconds")
+    )
+
+
+def clock_time(time_ns: int):
+    """Formats a time for the app's progress text.
+
+    Args:
+        time_ns: Wall-clock time in ns since the epoch.
+
+    Returns:
+        The time of day as e.g. "14:03:27.125".
+    """
+
+    seconds, remainder = divmod(int(time_ns), 10**9)
+    return (
+        time.strftime("%H:%M:%S", time.localtime(seconds))
+        + f".{remainder // 10**6:03d}"
+    )
+
+
+class EventStore:
+    """Holds every timed event of a session as int64 ns timestamps.
+
+    Each event is one row of the trial, odor, event type, host time and
+    arduino millis() columns. The columns are sized for four events per trial
+    when the session starts, so recording an event only writes into them.
+    Times become strings only when they are exported.
+
+    With a PredictedSchedule, each event's time is also stored as its delta
+    from the predicted time, so checking for drift needs no parsing.
+    """
+
+    def __init__(self, odor_sequence: list, schedule=None):
+        """Allocates the columns for a session.
+
+        Args:
+            odor_sequence: The order of odor delivery, by odor number.
+            schedule: The session's PredictedSchedule, or None.
+        """
+
+        #: np.ndarray: The odor of each trial
+        self.odors = np.asarray(odor_sequence, dtype=np.int16)
+
+        #: int: Number of trials in the session
+        self.num_trials = len(self.odors)
+
+        capacity = max(self.num_trials, 1) * len(EVENT_TYPES)
+
+        #: np.ndarray: Trial of each event, counting from 0
+        self.trial = np.zeros(capacity, dtype=np.int32)
+
+        #: np.ndarray: Odor delivered in each event's trial
+        self.odor = np.zeros(capacity, dtype=np.int16)
+
+        #: np.ndarray: Index of each event's type in EVENT_TYPES
+        self.event_type = np.zeros(capacity, dtype=np.uint8)
+
+        #: np.ndarray: Wall-clock time of each event in ns since the epoch
+        self.time_ns = np.zeros(capacity, dtype=np.int64)
+
+        #: np.ndarray: The arduino's millis() for each event, or -1 for none
+        self.device_ms = np.zeros(capacity, dtype=np.int64)
+
+        #: PredictedSchedule: When each event should happen, or None
+        self.schedule = schedule
+
+        #: np.ndarray: Time in ns each event happened after its predicted
+        # time, or MISSING without a schedule
+        self.delta_ns = np.full(capacity, MISSING, dtype=np.int64)
+
+        #: int: Number of events recorded
+        self.num_events = 0
+
+        #: np.ndarray: Row of each trial's event of each type, or -1 for none
+        self.event_rows = np.full(
+            (self.num_trials, len(EVENT_TYPES)), -1, dtype=np.int32
+        )
+
+    def grow(self):
+        """Doubles the columns, e.g. when lost frames were recovered and a
+        trial reported an event twice."""
+
+        for name in ["trial", "odor", "event_type", "time_ns", "device_ms"]:
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate([column, np.zeros_like(column)]))
+
+        self.delta_ns = np.concatenate(
+            [self.delta_ns, np.full_like(self.delta_ns, MISSING)]
+        )
+
+    def record(self, trial: int, msg: str, time_ns: int, device_ms: int = None):
+        """Records one event.
+
+        Args:
+            trial: The trial the event belongs to, counting from 0.
+            msg: The event type, "9", "1", "2" or "3".
+            time_ns: Wall-clock time of the event in ns since the epoch.
+            device_ms: The arduino's millis() for the event, if it sent one.
+        """
+
+        if self.num_events == len(self.time_ns):
+            self.grow()
+
+        row = self.num_events
+        type_index = EVENT_TYPES.index(msg)
+
+        self.trial[row] = trial
+        self.odor[row] = self.odors[trial]
+        self.event_type[row] = type_index
+        self.time_ns[row] = time_ns
+        self.device_ms[row] = -1 if device_ms is None else device_ms
+        self.event_rows[trial, type_index] = row
+        self.num_events += 1
+
+        if self.schedule is not None:
+            # The first event anchors the schedule, later ones drift from it
+            if self.schedule.anchor_ns is None:
+                self.schedule.anchor(trial, msg, time_ns)
+            self.delta_ns[row] = time_ns - self.schedule.predicted(trial, msg)
+
+    def has(self, trial: int, msg: str):
+        """Returns whether a trial has an event of one type."""
+
+        return self.event_rows[trial, EVENT_TYPES.index(msg)] >= 0
+
+    def time(self, trial: int, msg: str):
+        """Gets the time of one trial's event.
+
+        Args:
+            trial: The trial, counting from 0.
+            msg: The event type.
+
+        Returns:
+            The time in ns since the epoch, or MISSING.
+        """
+
+        row = self.event_rows[trial, EVENT_TYPES.index(msg)]
+        return int(self.time_ns[row]) if row >= 0 else MISSING
+
+    def remap(self, clock_sync, clock):
+        """Recomputes the time of every event the arduino timestamped.
+
+        Args:
+            clock_sync: The ClockSync with the final clock fit.
+            clock: The SessionClock mapping perf_counter onto the wall clock.
+        """
+
+        events = slice(0, self.num_events)
+        timestamped = self.device_ms[events] >= 0
+        self.time_ns[events][timestamped] = clock.to_wall_ns(
+            clock_sync.to_ns(self.device_ms[events][timestamped])
+        )
+
+        if self.schedule is not None and self.num_events:
+            first = self.schedule.offsets_ns[self.trial[0], self.event_type[0]]
+            self.schedule.anchor_ns = int(self.time_ns[0] - first)
+            self.delta_ns[events] = self.time_ns[events] - (
+                self.schedule.anchor_ns
+                + self.schedule.offsets_ns[
+                    self.trial[events], self.event_type[events]
+                ]
+            )
+
+    def largest_delta_ms(self):
+        """Returns the largest difference in ms between an event and its
+        predicted time, or None without a schedule or events."""
+
+        deltas = self.delta_ns[: self.num_events]
+        deltas = deltas[deltas != MISSING]
+
+        if not len(deltas):
+            return None
+
+        return float(np.abs(deltas).max() / 1e6)
+
+    def timings_row(self, trial: int):
+        """Gets one trial's row of the solenoid timings csv.
+
+        Args:
+            trial: The trial, counting from 0.
+
+        Returns:
+            List of the trial number, odor and the times the microscope was
+            triggered and the solenoid was opened and closed, or "" for times
+            that weren't recorded.
+        """
+
+        return [
+            trial + 1,
+            int(self.odors[trial]),
+            iso_time(self.time(trial, "9")),
+            iso_time(self.time(trial, "1")),
+            iso_time(self.time(trial, "2")),
+        ]
+
+    def to_dataframe(self):
+        """Gets every recorded event as a DataFrame.
+
+        Returns:
+            DataFrame with one row per event and columns "trial" (counting
+            from 1), "odor", "event", "time" and "device_ms".
+        """
+
+        events = slice(0, self.num_events)
+        event_types = np.array(list(EVENT_TYPES))
+
+        # Shift to local time as the timings csv does, following any daylight
+        # saving change within the session
+        utc_offsets_ns = np.array(
+            [
+                time.localtime(time_ns // 10**9).tm_gmtoff * 10**9
+                for time_ns in self.time_ns[events].tolist()
+            ],
+            dtype=np.int64,
+        )
+
+        return pd.DataFrame(
+            {
+                "trial": self.trial[events] + 1,
+                "odor": self.odor[events],
+                "event": event_types[self.event_type[events]],
+                "time": pd.to_datetime(self.time_ns[events] + utc_offsets_ns),
+                "device_ms": self.device_ms[events],
+            }
+        )
@@ -0,0 +1,274 @@
+"""Contains the ExperimentIndex class to keep a local SQLite index of every
+session the app has run, so sessions can be found without walking the
+acquisition drive.
+
+Query it from the src directory, e.g.
+
+    python -m components.experiment_index --animal 123456-7-8 --panel 10%
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from components.event_store import EVENT_TYPES, EventStore
+
+#: str: Default location of the index, in the user's home directory
+DEFAULT_INDEX_PATH = os.path.join(
+    os.path.expanduser("~"), "odor_delivery_index.sqlite"
+)
+
+#: list: Columns of the sessions table, as (name, SQL type)
+SESSION_COLUMNS = [
+    ("folder", "TEXT NOT NULL"),
+    ("session", "TEXT NOT NULL"),
+    ("date", "TEXT"),
+    ("animal", "TEXT"),
+    ("roi", "TEXT"),
+    ("panel_type", "TEXT"),
+    ("trial_type", "TEXT"),
+    ("settings", "TEXT"),
+    ("order_path", "TEXT"),
+    ("timings_path", "TEXT"),
+    ("info_path", "TEXT"),
+    ("journal_path", "TEXT"),
+    ("num_trials", "INTEGER"),
+    ("trials_delivered", "INTEGER"),
+    ("outcome", "TEXT"),
+    ("finished_at", "TEXT"),
+    ("missing_events", "INTEGER"),
+    ("odor_duration_mean_ms", "REAL"),
+    ("odor_duration_max_error_ms", "REAL"),
+    ("onset_interval_mean_s", "REAL"),
+    ("onset_interval_sd_ms", "REAL"),
+    ("protocol_errors", "INTEGER"),
+]
+
+
+def timing_stats(event_store: EventStore, odor_duration: float):
+    """Summarizes how closely a session's odor deliveries kept to time.
+
+    Args:
+        event_store: The session's events.
+        odor_duration: The odor duration setting in s, used when the event
+            store has no schedule with each trial's odor duration.
+
+    Returns:
+        Dict of the number of trials delivered, events missing from those
+        trials, the mean odor duration and its largest error from the
+        scheduled duration in ms, and the mean and standard deviation of the
+        interval between odor onsets in s and ms. Stats without enough trials
+        are None.
+    """
+
+    rows = event_store.event_rows
+    delivered = rows[:, EVENT_TYPES.index("2")] >= 0
+    trials_delivered = int(np.flatnonzero(delivered)[-1] + 1) if delivered.any() else 0
+
+    stats = {
+        "trials_delivered": trials_delivered,
+        "missing_events": int((rows[:trials_delivered, :3] < 0).sum()),
+        "odor_duration_mean_ms": None,
+        "odor_duration_max_error_ms": None,
+        "onset_interval_mean_s": None,
+        "onset_interval_sd_ms": None,
+    }
+
+    opened_rows = rows[:trials_delivered, EVENT_TYPES.index("1")]
+    closed_rows = rows[:trials_delivered, EVENT_TYPES.index("2")]
+    complete = (opened_rows >= 0) & (closed_rows >= 0)
+
+    if complete.any():
+        durations_ms = (
+            event_store.time_ns[closed_rows[complete]]
+            - event_store.time_ns[opened_rows[complete]]
+        ) / 1e6
+        if event_store.schedule is not None:
+            scheduled_ms = event_store.schedule.odor_ms[:trials_delivered][complete]
+        else:
+            scheduled_ms = odor_duration * 1000
+        stats["odor_duration_mean_ms"] = float(durations_ms.mean())
+        stats["odor_duration_max_error_ms"] = float(
+            np.abs(durations_ms - scheduled_ms).max()
+        )
+
+    onsets = event_store.time_ns[opened_rows[opened_rows >= 0]]
+    if len(onsets) > 1:
+        intervals_ns = np.diff(onsets)
+        stats["onset_interval_mean_s"] = float(intervals_ns.mean() / 1e9)
+        stats["onset_interval_sd_ms"] = float(intervals_ns.std() / 1e6)
+
+    return stats
+
+
+class ExperimentIndex:
+    """A SQLite database with one row per session, keyed by experiment folder
+    and session timestamp.
+
+    A connection is opened for each call, so the index can be written from
+    the I/O worker and read from anywhere else.
+    """
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH):
+        """Initializes the index, creating the database if needed.
+
+        Args:
+            path: Path of the SQLite database file.
+        """
+
+        #: str: Path of the SQLite database file
+        self.path = path
+
+        self.create()
+
+    def connect(self):
+        """Opens a connection to the database.
+
+        Returns:
+            The sqlite3.Connection.
+        """
+
+        return sqlite3.connect(self.path, timeout=10)
+
+    def create(self):
+        """Creates the sessions table and the indexes used by find_sessions,
+        if they don't exist yet."""
+
+        columns = ",\n".join(f"{name} {sql_type}" for name, sql_type in SESSION_COLUMNS)
+
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS sessions (\n{columns},\n"
+                "PRIMARY KEY (folder, session))"
+            )
+            for index_columns in ["animal, panel_type", "date", "roi"]:
+                name = "sessions_" + index_columns.replace(", ", "_")
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS {name} ON sessions "
+                    f"({index_columns})"
+                )
+
+    def add_session(self, session: dict):
+        """Adds or replaces one session's row in a single transaction.
+
+        Args:
+            session: Values of the row by column name. Missing columns are
+                left empty.
+        """
+
+        names = [name for name, sql_type in SESSION_COLUMNS]
+        values = [session.get(name) for name in names]
+
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO sessions ({', '.join(names)}) "
+                f"VALUES ({', '.join('?' * len(names))})",
+                values,
+            )
+
+    def find_sessions(self, **filters):
+        """Finds the sessions matching every filter.
+
+        Args:
+            **filters: Values to match by column name, e.g.
+                animal="123456-7-8", panel_type="10%".
+
+        Returns:
+            DataFrame with one row per matching session, oldest first.
+        """
+
+        names = [name for name, sql_type in SESSION_COLUMNS]
+        for name in filters:
+            if name not in names:
+                raise ValueError(f"No column {name} in the experiment index")
+
+        query = "SELECT * FROM sessions"
+        if filters:
+            query += " WHERE " + " AND ".join(f"{name} = ?" for name in filters)
+        query += " ORDER BY date, session"
+
+        with closing(self.connect()) as connection:
+            return pd.read_sql_query(query, connection, params=list(filters.values()))
+
+
+def session_entry(
+    settings: dict,
+    panel_type: str,
+    csv_time: str,
+    event_store: EventStore,
+    outcome: str,
+    paths: dict,
+    protocol_errors: int,
+):
+    """Gets a finished session's row of the experiment index.
+
+    Args:
+        settings: All experiment settings entered from settings fields.
+        panel_type: Whether odor panel is 1% or 10%.
+        csv_time: Timestamp the session's csv files are named with.
+        event_store: The session's events.
+        outcome: How the session ended, e.g. "complete" or "aborted".
+        paths: Paths of the session's files, by index column, e.g.
+            "timings_path".
+        protocol_errors: Number of frames that were corrupted, lost or
+            resent.
+
+    Returns:
+        Dict of values by column name.
+    """
+
+    entry = {
+        "folder": settings["dir_path"],
+        "session": csv_time,
+        "date": settings["date"],
+        "animal": settings["mouse"],
+        "roi": settings["roi"],
+        "panel_type": panel_type,
+        "trial_type": settings.get("trial_type"),
+        "settings": json.dumps(settings),
+        "num_trials": event_store.num_trials,
+        "outcome": outcome,
+        "finished_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "protocol_errors": protocol_errors,
+    }
+    entry.update(paths)
+    entry.update(timing_stats(event_store, settings["odor_duration"]))
+
+    return entry
+
+
+def main():
+    """Prints the indexed sessions matching the filters given."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="index file")
+    parser.add_argument("--date", help="experiment date, e.g. 231116")
+    parser.add_argument("--animal", help="animal ID")
+    parser.add_argument("--roi", help="ROI, e.g. ROI1")
+    parser.add_argument("--panel", dest="panel_type", help="1%% or 10%%")
+    parser.add_argument("--outcome", help="complete or aborted")
+    args = parser.parse_args()
+
+    filters = {
+        name: value
+        for name, value in vars(args).items()
+        if name != "index" and value is not None
+    }
+    sessions = ExperimentIndex(args.index).find_sessions(**filters)
+
+    print(
+        sessions[
+            ["date", "animal", "roi", "panel_type", "session", "outcome"]
+            + ["trials_delivered", "num_trials", "folder"]
+        ].to_string(index=False)
+    )
+
+
+if __name__ == "__main__":
+    main()
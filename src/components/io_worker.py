@@ -0,0 +1,111 @@
+"""Contains the IOWorker class to run file writes and other slow output in a
+background thread."""
+
+import queue
+import time
+import traceback
+from threading import Thread
+
+
+class IOWorker(Thread):
+    """Runs output jobs, e.g. csv writes and log prints, one at a time in the
+    order they were submitted, so the thread talking to the arduino only has
+    to queue them.
+
+    Submitting never blocks, so a stalled disk, e.g. an experiment directory
+    on a slow network share, can't delay the arduino's events. Jobs queue up
+    instead, and the backlog is counted as backpressure for the session info.
+    """
+
+    def __init__(self, max_jobs: int = 1000):
+        """Initializes the worker thread.
+
+        Args:
+            max_jobs: Number of jobs waiting above which the output counts as
+                backlogged.
+        """
+
+        super().__init__(daemon=True)
+
+        #: queue.Queue: Jobs waiting to run, as (function, args, kwargs,
+        # perf_counter time submitted), or None to stop the worker
+        self.jobs = queue.Queue()
+
+        #: int: Number of jobs waiting above which the output is backlogged
+        self.max_jobs = max_jobs
+
+        #: int: Largest number of jobs that were waiting at once
+        self.max_waiting = 0
+
+        #: int: Number of jobs submitted while the output was backlogged
+        self.backlogged_jobs = 0
+
+        #: float: Longest time in s a job waited in the queue before running
+        self.max_delay = 0
+
+        #: int: Number of jobs that raised an exception
+        self.failed_jobs = 0
+
+    def submit(self, function, *args, **kwargs):
+        """Queues a job to run on the worker thread. Runs it right away if
+        the worker isn't running.
+
+        Args:
+            function: The function to call.
+            *args: Arguments to call it with.
+            **kwargs: Keyword arguments to call it with.
+        """
+
+        if not self.is_alive():
+            self.run_job(function, args, kwargs)
+            return
+
+        self.jobs.put((function, args, kwargs, time.perf_counter()))
+
+        waiting = self.jobs.qsize()
+        self.max_waiting = max(self.max_waiting, waiting)
+        if waiting > self.max_jobs:
+            self.backlogged_jobs += 1
+
+    def run_job(self, function, args: tuple, kwargs: dict):
+        """Runs one job, printing any exception instead of stopping.
+
+        Args:
+            function: The function to call.
+            args: Arguments to call it with.
+            kwargs: Keyword arguments to call it with.
+        """
+
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            self.failed_jobs += 1
+            traceback.print_exc()
+
+    def run(self):
+        """Runs jobs until stopped."""
+
+        while True:
+            job = self.jobs.get()
+
+            if job is None:
+                self.jobs.task_done()
+                break
+
+            function, args, kwargs, submitted = job
+            self.max_delay = max(self.max_delay, time.perf_counter() - submitted)
+            self.run_job(function, args, kwargs)
+            self.jobs.task_done()
+
+    def flush(self):
+        """Waits until every job submitted so far has run."""
+
+        if self.is_alive():
+            self.jobs.join()
+
+    def stop(self):
+        """Runs the remaining jobs, then stops the worker thread."""
+
+        if self.is_alive():
+            self.jobs.put(None)
+            self.join()
@@ -0,0 +1,412 @@
+"""Measures how long Arduino events take to travel through ArduinoSession,
+stage by stage, by running whole sessions against a VirtualArduino.
+
+Run it from the src directory to compare serial engines:
+
+    python -m components.latency_benchmark --engine thread asyncio
+
+Each event from the virtual arduino is followed through these stages:
+
+    device -> read       the arduino writes the frame until the reader's
+                         read() returns it
+    read -> parse        read() returns until the frame is parsed. The
+                         reader timestamps the frame before parsing it, so
+                         this is parse time, not timestamp delay
+    parse -> dispatch    the event waits in the queue until
+                         parse_arduino_msg picks it up
+    dispatch -> log      parse_arduino_msg starts until update_log returns
+    device -> csv        the arduino writes the frame until the timings csv
+                         holding it has been written
+    device -> handled    the arduino writes the frame until
+                         parse_arduino_msg returns
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import serial
+
+from components.arduino_functions import ArduinoSession
+from components.protocol import FrameParser, decode_payload
+from components.serial_reader import SerialReader
+from components.virtual_arduino import VirtualArduino
+
+
+class TimedVirtualArduino(VirtualArduino):
+    """VirtualArduino that records when each event frame was written and how
+    much CPU time its own thread used."""
+
+    def __init__(self, probe: "LatencyProbe", *args, **kwargs):
+        """Initializes the emulator.
+
+        Args:
+            probe: The probe collecting the stage times.
+            *args: Passed on to VirtualArduino.
+            **kwargs: Passed on to VirtualArduino.
+        """
+
+        super().__init__(*args, **kwargs)
+
+        #: LatencyProbe: The probe collecting the stage times
+        self.probe = probe
+
+        #: float: CPU time in s used by the emulator thread
+        self.cpu_time = 0
+
+    def send_event(self, msg_type: str):
+        """Sends an event and records when it was written.
+
+        Args:
+            msg_type: The event type, "9", "1", "2" or "3".
+        """
+
+        device_ms = self.millis()
+        self.probe.mark((msg_type, device_ms), "device")
+        self.send_frame(msg_type, struct.pack("<I", device_ms))
+
+    def run(self):
+        """Runs the emulator and records its CPU time."""
+
+        start = time.thread_time()
+        try:
+            super().run()
+        finally:
+            self.cpu_time = time.thread_time() - start
+
+
+class BenchmarkSession(ArduinoSession):
+    """ArduinoSession that runs without a page and reports the times it
+    dispatches, logs and saves each event."""
+
+    def __init__(self, probe: "LatencyProbe", *args, **kwargs):
+        """Initializes the session.
+
+        Args:
+            probe: The probe collecting the stage times.
+            *args: Passed on to ArduinoSession.
+            **kwargs: Passed on to ArduinoSession.
+        """
+
+        #: LatencyProbe: The probe collecting the stage times
+        self.probe = probe
+
+        #: tuple: Key of the event being handled, as (msg_type, device_ms)
+        self.current_key = None
+
+        super().__init__(*args, **kwargs)
+
+    def update(self):
+        """Does nothing, the session isn't shown on a page."""
+
+    def show_timings_saved(self):
+        """Does nothing, the session isn't shown on a page."""
+
+    def parse_arduino_msg(self, trial, solenoid, event):
+        """Handles the event and records when it started and finished."""
+
+        self.current_key = (event.msg, event.value)
+        self.probe.mark(self.current_key, "dispatch")
+        super().parse_arduino_msg(trial, solenoid, event)
+        self.probe.mark(self.current_key, "handled")
+        self.current_key = None
+
+    def update_log(self, *args, **kwargs):
+        """Updates the log and records when it finished."""
+
+        super().update_log(*args, **kwargs)
+        self.probe.mark(self.current_key, "log")
+
+    def save_solenoid_timings(self, trial):
+        """Saves the timings csv and records when the I/O worker has written
+        it for every event that the csv now holds."""
+
+        super().save_solenoid_timings(trial)
+        self.io_worker.submit(self.probe.mark_saved, self.probe.take_unsaved())
+
+
+class LatencyProbe:
+    """Collects the time each event reaches each stage, keyed by the event's
+    type and the arduino's millis()."""
+
+    def __init__(self):
+        """Initializes an empty probe."""
+
+        #: dict: Stage times in s by event key, as {key: {stage: time}}
+        self.times = {}
+
+        #: list: Keys of events that haven't been written to the csv yet
+        self.unsaved = []
+
+        #: float: When the reader's last read() returned
+        self.last_read = None
+
+        #: threading.Lock: Guards times, which several threads write
+        self.lock = threading.Lock()
+
+    def mark(self, key: tuple, stage: str, when: float = None):
+        """Records when an event reached a stage.
+
+        Args:
+            key: The event as (msg_type, device_ms).
+            stage: Name of the stage.
+            when: The perf_counter time, or None for now.
+        """
+
+        if key is None or key[1] is None:
+            return
+
+        when = time.perf_counter() if when is None else when
+
+        with self.lock:
+            stages = self.times.setdefault(key, {})
+            stages.setdefault(stage, when)
+
+            # "3" times aren't saved in the timings csv
+            if stage == "dispatch" and key[0] in "912":
+                self.unsaved.append(key)
+
+    def take_unsaved(self):
+        """Gets the keys of the events dispatched since the last csv write.
+
+        Returns:
+            List of event keys.
+        """
+
+        with self.lock:
+            unsaved, self.unsaved = self.unsaved, []
+
+        return unsaved
+
+    def mark_saved(self, keys: list):
+        """Records that the csv holding some events was written.
+
+        Args:
+            keys: The keys of the events the csv now holds.
+        """
+
+        when = time.perf_counter()
+
+        with self.lock:
+            for key in keys:
+                self.times[key].setdefault("csv", when)
+
+    @contextlib.contextmanager
+    def reader_probes(self):
+        """Times the serial reader thread's read() and frame parsing while
+        the context is active."""
+
+        serial_class = serial.Serial
+        original_read = serial_class.read
+        original_feed = FrameParser.feed
+        probe = self
+
+        def read(port, size=1):
+            data = original_read(port, size)
+            if data and isinstance(threading.current_thread(), SerialReader):
+                probe.last_read = time.perf_counter()
+            return data
+
+        def feed(parser, data):
+            frames, errors = original_feed(parser, data)
+            if isinstance(threading.current_thread(), SerialReader):
+                parsed = time.perf_counter()
+                for msg_type, seq, payload in frames:
+                    key = (msg_type, decode_payload(msg_type, payload)[0])
+                    probe.mark(key, "read", probe.last_read)
+                    probe.mark(key, "parse", parsed)
+            return frames, errors
+
+        serial_class.read = read
+        FrameParser.feed = feed
+        try:
+            yield
+        finally:
+            serial_class.read = original_read
+            FrameParser.feed = original_feed
+
+    def stage_latencies(self):
+        """Gets the latency of each stage for every event that reached it.
+
+        Returns:
+            Dict of stage name to an array of latencies in ms.
+        """
+
+        stages = {
+            "device -> read": ("device", "read"),
+            "read -> parse": ("read", "parse"),
+            "parse -> dispatch": ("parse", "dispatch"),
+            "dispatch -> log": ("dispatch", "log"),
+            "device -> csv": ("device", "csv"),
+            "device -> handled": ("device", "handled"),
+        }
+
+        latencies = {}
+        for name, (start, end) in stages.items():
+            latencies[name] = np.array(
+                [
+                    (times[end] - times[start]) * 1000
+                    for times in self.times.values()
+                    if start in times and end in times
+                ]
+            )
+
+        return latencies
+
+
+def run_session(
+    engine: str,
+    num_trials: int,
+    speed: float,
+    odor_duration: int,
+    time_btw_odors: int,
+    sequence_upload: bool,
+):
+    """Runs one whole session against a virtual arduino.
+
+    Args:
+        engine: Whether the serial conversation runs in a "thread" or on
+            "asyncio".
+        num_trials: Number of trials in the session.
+        speed: How many times faster than real time the arduino runs.
+        odor_duration: Odor duration in s.
+        time_btw_odors: Time between odors in s.
+        sequence_upload: Whether to upload the whole sequence at once.
+
+    Returns:
+        Dict of results: per-stage percentiles, events/s and CPU time.
+    """
+
+    probe = LatencyProbe()
+    arduino = TimedVirtualArduino(probe, speed=speed)
+    arduino.start()
+
+    settings = {
+        "date": "benchmark",
+        "mouse": "virtual",
+        "roi": "ROI1",
+        "dir_path": tempfile.mkdtemp(),
+        "odor_duration": odor_duration,
+        "time_btw_odors": time_btw_odors,
+    }
+    odor_sequence = [trial % 8 + 1 for trial in range(num_trials)]
+
+    # The session prints every event, which is part of the cost being
+    # measured, but not worth reading
+    with probe.reader_probes(), contextlib.redirect_stdout(io.StringIO()):
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+
+        session = BenchmarkSession(
+            probe,
+            "1%",
+            "benchmark",
+            None,
+            settings,
+            odor_sequence,
+            engine=engine,
+            sequence_upload=sequence_upload,
+            port=arduino.port,
+        )
+
+        if engine == "asyncio":
+            asyncio.run(session.run_async())
+        else:
+            session.run()
+
+        wall_time = time.perf_counter() - wall_start
+        arduino.stop()
+        cpu_time = time.process_time() - cpu_start - arduino.cpu_time
+
+    events = sum(1 for key in probe.times if key[0] in "9123")
+    results = {
+        "engine": engine,
+        "complete": session.sequence_complete,
+        "events": events,
+        "events/s": events / wall_time,
+        "host CPU (s)": cpu_time,
+        "CPU per event (ms)": cpu_time / max(events, 1) * 1000,
+    }
+
+    for stage, latencies in probe.stage_latencies().items():
+        if len(latencies):
+            for percentile in [50, 95, 99]:
+                results[f"{stage} p{percentile} (ms)"] = np.percentile(
+                    latencies, percentile
+                )
+
+    for path in os.listdir(settings["dir_path"]):
+        os.remove(os.path.join(settings["dir_path"], path))
+    os.rmdir(settings["dir_path"])
+
+    return results
+
+
+def main():
+    """Benchmarks each requested engine and prints the results side by
+    side."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--engine",
+        nargs="+",
+        default=["thread", "asyncio"],
+        choices=["thread", "asyncio"],
+        help="serial engines to compare",
+    )
+    parser.add_argument("--trials", type=int, default=80, help="trials per session")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1000,
+        help="how many times faster than real time the arduino runs",
+    )
+    parser.add_argument("--odor-duration", type=int, default=10, help="odor s")
+    parser.add_argument(
+        "--time-btw-odors", type=int, default=30, help="time between odors in s"
+    )
+    parser.add_argument(
+        "--sequence-upload",
+        action="store_true",
+        help="upload the whole sequence instead of one trial at a time",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="sessions to run per engine"
+    )
+    parser.add_argument("--csv", help="also save the results to this csv file")
+    args = parser.parse_args()
+
+    results = []
+    for engine in args.engine:
+        for repeat in range(args.repeat):
+            results.append(
+                run_session(
+                    engine,
+                    args.trials,
+                    args.speed,
+                    args.odor_duration,
+                    args.time_btw_odors,
+                    args.sequence_upload,
+                )
+            )
+
+    results_df = pd.DataFrame(results)
+    print(
+        results_df.set_index("engine")
+        .T.to_string(float_format=lambda value: f"{value:.3f}")
+    )
+
+    if args.csv:
+        results_df.to_csv(args.csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""Converts the .txt timing files written by the old pyzo app
+(old_beichen_code/pyzo_code.py) into solenoid order and timings csv files
+like the ones the app saves, so old and new sessions can be analysed
+together.
+
+Run it from the src directory, e.g.
+
+    python -m components.legacy_converter D:/old_experiments
+
+The pyzo app wrote two files per session, both starting with a
+"Solenoid Order: [...]" line:
+
+    <name>.txt                  written by writeTextPerOdor with the actual
+                                times, e.g. "Odor 3 triggered at:
+                                11/16 14:3:27:125000"
+    <name>(InitialGuess).txt    written by writeToInitialText with the
+                                times predicted at the start, e.g.
+                                "* 3 released at: 11/16 14:3:27:225.0"
+
+The times carry no year, which is taken from the folder name, the file's
+default M-D-YYYY-H-M name or its modification date. Files are read one line
+at a time and each trial is written as soon as its solenoid closes, so
+memory stays bounded however large the tree is.
+
+The converted files are written next to the .txt files by default, named
+as the app names its own. Predicted times go to a
+*_solenoid_predicted_timings_* file with the same columns as the timings.
+"""
+
+import argparse
+import ast
+import datetime
+import os
+import re
+
+from components.timings_writer import TimingsWriter, timings_columns
+from components.trial_schedule import TrialSchedule
+from components.utils import parse_folder_name
+
+#: str: Suffix of the files holding the predicted times
+INITIAL_GUESS_SUFFIX = "(InitialGuess)"
+
+#: str: Start of the first line of every legacy timing file
+ORDER_PREFIX = "Solenoid Order:"
+
+#: re.Pattern: Matches one event line of a legacy timing file
+EVENT_PATTERN = re.compile(
+    r"^\*?\s*(?P<odor>.*?) (?P<event>triggered|released|was stopped) at: "
+    r"(?P<time>.+?)\s*$"
+)
+
+#: re.Pattern: Matches a legacy time, e.g. "11/16 14:3:27:125000"
+TIME_PATTERN = re.compile(
+    r"^(?P<month>\d+)/(?P<day>\d+) (?P<hour>\d+):(?P<minute>\d+):"
+    r"(?P<second>\d+):(?P<fraction>[\d.]+)$"
+)
+
+#: re.Pattern: Matches the pyzo app's default file name, M-D-YYYY-H-M
+DEFAULT_NAME_PATTERN = re.compile(r"^\d+-\d+-(?P<year>\d{4})-\d+-\d+")
+
+#: dict: Index of each event's time in a timings row
+EVENT_COLUMNS = {"triggered": 2, "released": 3, "was stopped": 4}
+
+
+def legacy_year(path: str):
+    """Works out the year of a legacy file's times.
+
+    Args:
+        path: Path of the legacy .txt file.
+
+    Returns:
+        The year, from the YYMMDD--animal_ROIX folder name, the default
+        M-D-YYYY-H-M file name, or the file's modification date.
+    """
+
+    try:
+        date = parse_folder_name(os.path.basename(os.path.dirname(path)))[0]
+        return 2000 + int(date[:2])
+    except (IndexError, ValueError):
+        pass
+
+    match = DEFAULT_NAME_PATTERN.match(os.path.basename(path))
+    if match:
+        return int(match["year"])
+
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path)).year
+
+
+def parse_legacy_time(text: str, year: int, fraction_ms: bool):
+    """Parses one time from a legacy file.
+
+    Args:
+        text: The time, e.g. "11/16 14:3:27:125000", or "2019-11-16
+            14:03:27.125000" where changeText rewrote a predicted time.
+        year: The year of the session.
+        fraction_ms: Whether the last field is in ms, as in the predicted
+            times, rather than in us.
+
+    Returns:
+        The time as a datetime, or None if it can't be read.
+    """
+
+    match = TIME_PATTERN.match(text)
+    if match is None:
+        try:
+            return datetime.datetime.fromisoformat(text)
+        except ValueError:
+            return None
+
+    fraction = float(match["fraction"])
+
+    # The predicted times never roll over into the next day, so add the
+    # fields up instead of building the datetime from them directly
+    return datetime.datetime(year, int(match["month"]), int(match["day"])) + (
+        datetime.timedelta(
+            hours=int(match["hour"]),
+            minutes=int(match["minute"]),
+            seconds=int(match["second"]),
+            milliseconds=fraction if fraction_ms else 0,
+            microseconds=0 if fraction_ms else fraction,
+        )
+    )
+
+
+def read_legacy_file(path: str):
+    """Reads a legacy timing file one trial at a time.
+
+    Args:
+        path: Path of the legacy .txt file.
+
+    Yields:
+        First the solenoid order as a list of odor numbers, then for each
+        trial a dict of its event times by event, e.g. {"triggered":
+        datetime, ...}.
+    """
+
+    year = legacy_year(path)
+    fraction_ms = os.path.splitext(path)[0].endswith(INITIAL_GUESS_SUFFIX)
+
+    with open(path, errors="replace") as legacy_file:
+        first_line = legacy_file.readline().strip()
+        yield ast.literal_eval(first_line[len(ORDER_PREFIX) :].strip())
+
+        trial_times = {}
+        for line in legacy_file:
+            match = EVENT_PATTERN.match(line.strip())
+            if match is None:
+                continue
+
+            # Each trial starts with its microscope trigger
+            if match["event"] == "triggered" and trial_times:
+                yield trial_times
+                trial_times = {}
+
+            trial_times[match["event"]] = parse_legacy_time(
+                match["time"], year, fraction_ms
+            )
+
+        if trial_times:
+            yield trial_times
+
+
+def is_legacy_file(path: str):
+    """Returns whether a .txt file was written by the pyzo app."""
+
+    try:
+        with open(path, errors="replace") as text_file:
+            return text_file.readline().startswith(ORDER_PREFIX)
+    except OSError:
+        return False
+
+
+def first_time(path: str):
+    """Gets the first time in a legacy file, which names the converted
+    files.
+
+    Args:
+        path: Path of the legacy .txt file.
+
+    Returns:
+        The datetime, or None if the file has no times.
+    """
+
+    trials = read_legacy_file(path)
+    next(trials)
+
+    for trial_times in trials:
+        times = [time for time in trial_times.values() if time is not None]
+        if times:
+            return min(times)
+
+    return None
+
+
+def session_names(stem_path: str, start: datetime.datetime):
+    """Gets the date, animal, ROI and csv_time the converted files are named
+    with.
+
+    Args:
+        stem_path: Path of the legacy file without "(InitialGuess).txt" or
+            ".txt".
+        start: The first time of the session.
+
+    Returns:
+        (date, animal, roi, csv_time). Sessions outside a YYMMDD--animal_ROIX
+        folder are named after their file, with ROI "ROI0".
+    """
+
+    try:
+        date, animal, roi = parse_folder_name(
+            os.path.basename(os.path.dirname(stem_path))
+        )
+    except IndexError:
+        date = start.strftime("%y%m%d")
+        animal = re.sub(r"[^\w-]", "-", os.path.basename(stem_path)).replace("_", "-")
+        roi = "ROI0"
+
+    return date, animal, roi, start.strftime("%y%m%d-%H%M%S")
+
+
+def write_timings(path: str, output_path: str, panel_type: str):
+    """Streams one legacy file's times into a timings csv.
+
+    Args:
+        path: Path of the legacy .txt file.
+        output_path: Path of the csv file to write.
+        panel_type: Whether odor panel is 1% or 10%.
+
+    Returns:
+        The solenoid order and the number of trials written.
+    """
+
+    trials = read_legacy_file(path)
+    solenoid_order = next(trials)
+
+    writer = TimingsWriter(output_path, timings_columns(panel_type))
+    writer.open()
+
+    try:
+        for trial, trial_times in enumerate(trials):
+            if trial >= len(solenoid_order):
+                break
+
+            row = [trial + 1, solenoid_order[trial], "", "", "", "", ""]
+            for event, time in trial_times.items():
+                if time is not None:
+                    row[EVENT_COLUMNS[event]] = time.isoformat(
+                        "|", timespec="milliseconds"
+                    )
+            writer.write_row(row)
+    finally:
+        writer.close()
+
+    return solenoid_order, writer.rows_written
+
+
+def write_order(output_path: str, solenoid_order: list, panel_type: str):
+    """Writes a solenoid order csv as OdorDeliveryApp.save_solenoid_info
+    does, sorted by odor.
+
+    Args:
+        output_path: Path of the csv file to write.
+        solenoid_order: The odor of each trial.
+        panel_type: Whether odor panel is 1% or 10%.
+    """
+
+    TrialSchedule(solenoid_order).to_dataframe(panel_type).to_csv(
+        output_path, index=False
+    )
+
+
+def convert_session(stem_path: str, output_dir: str = None, panel_type: str = "10%"):
+    """Converts one pyzo session's actual and predicted timing files.
+
+    Args:
+        stem_path: Path of the legacy files without "(InitialGuess).txt" or
+            ".txt".
+        output_dir: Directory for the converted files, or None for the
+            directory of the legacy files.
+        panel_type: Whether odor panel is 1% or 10%.
+
+    Returns:
+        List of the paths written.
+    """
+
+    actual_path = stem_path + ".txt"
+    guess_path = stem_path + INITIAL_GUESS_SUFFIX + ".txt"
+    sources = [
+        (kind, path)
+        for kind, path in [
+            ("solenoid_timings", actual_path),
+            ("solenoid_predicted_timings", guess_path),
+        ]
+        if os.path.exists(path) and is_legacy_file(path)
+    ]
+
+    # The predicted times were written when the session started, so they
+    # name the session when there are any
+    start = None
+    for kind, path in reversed(sources):
+        start = first_time(path)
+        if start is not None:
+            break
+    if start is None:
+        return []
+
+    date, animal, roi, csv_time = session_names(stem_path, start)
+    output_dir = output_dir or os.path.dirname(stem_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    written = []
+    solenoid_order = None
+    for kind, path in sources:
+        output_path = os.path.join(
+            output_dir, f"{date}_{animal}_{roi}_{kind}_{csv_time}.csv"
+        )
+        solenoid_order = write_timings(path, output_path, panel_type)[0]
+        written.append(output_path)
+
+    order_path = os.path.join(
+        output_dir, f"{date}_{animal}_{roi}_solenoid_order_{csv_time}.csv"
+    )
+    write_order(order_path, solenoid_order, panel_type)
+    written.append(order_path)
+
+    return written
+
+
+def find_legacy_sessions(root: str):
+    """Finds the pyzo sessions under a directory.
+
+    Args:
+        root: The directory to search.
+
+    Yields:
+        Path of each session's files without "(InitialGuess).txt" or ".txt".
+    """
+
+    for directory, subdirectories, file_names in os.walk(root):
+        stems = set()
+        for file_name in file_names:
+            if file_name.endswith(".txt"):
+                stem = file_name[: -len(".txt")]
+                if stem.endswith(INITIAL_GUESS_SUFFIX):
+                    stem = stem[: -len(INITIAL_GUESS_SUFFIX)]
+                stems.add(stem)
+
+        for stem in sorted(stems):
+            yield os.path.join(directory, stem)
+
+
+def main():
+    """Converts every pyzo session under a directory and prints a summary."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", help="directory to search for .txt files")
+    parser.add_argument(
+        "--output", help="directory for the csv files, default next to each file"
+    )
+    parser.add_argument(
+        "--panel",
+        default="10%",
+        help="odor panel of the old rig, which ran on COM7 (default 10%%)",
+    )
+    args = parser.parse_args()
+
+    sessions = 0
+    files = 0
+    for stem_path in find_legacy_sessions(args.root):
+        output_dir = None
+        if args.output:
+            output_dir = os.path.join(
+                args.output, os.path.relpath(os.path.dirname(stem_path), args.root)
+            )
+
+        try:
+            written = convert_session(stem_path, output_dir, args.panel)
+        except (OSError, ValueError, SyntaxError) as error:
+            print(f"Could not convert {stem_path}: {error!r}")
+            continue
+
+        if written:
+            sessions += 1
+            files += len(written)
+
+    print(f"Converted {sessions} sessions into {files} csv files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Contains the PredictedSchedule class to work out when every event of a
+session should happen before it starts."""
+
+import numpy as np
+import pandas as pd
+
+from components.event_store import EVENT_TYPES
+from components.protocol import (
+    BASELINE_MS,
+    TRIGGER_PULSE_MS,
+    TRIGGER_TIME_MS,
+    delay_after_odor_ms,
+)
+
+
+class PredictedSchedule:
+    """The expected time of every trial's microscope trigger, odor on, odor
+    off and delay end, as offsets from the first trigger.
+
+    The offsets follow arduino_sketch's runTrial step by step:
+
+        trigger  "9"  the microscope trigger arrives
+        on       "1"  trigger + TRIGGER_PULSE_MS + BASELINE_MS
+        off      "2"  on + odor duration
+        end      "3"  off + delay_after_odor_ms(time between odors), i.e.
+                      toDelayTime
+        next     "9"  end + TRIGGER_TIME_MS
+
+    The only step the arduino doesn't time itself is the wait for the next
+    trigger, which is assumed to arrive TRIGGER_TIME_MS after the delay
+    ends, as triggerTime sets aside. Each trial then takes the odor duration
+    plus the time between odors. A trigger that arrives earlier or later
+    shifts every later event, which shows up as drift. The absolute times
+    are known once the first event anchors the schedule.
+    """
+
+    def __init__(self, odor_sequence: list, odor_ms, btw_ms):
+        """Computes the offsets of every event.
+
+        Args:
+            odor_sequence: The order of odor delivery, by odor number.
+            odor_ms: Odor duration in ms, for all trials or per trial.
+            btw_ms: Time between odors in ms, for all trials or per trial.
+        """
+
+        num_trials = len(odor_sequence)
+
+        #: np.ndarray: The odor of each trial
+        self.odors = np.asarray(odor_sequence, dtype=np.int16)
+
+        #: np.ndarray: Odor duration of each trial in ms
+        self.odor_ms = np.broadcast_to(
+            np.asarray(odor_ms, dtype=np.int64), (num_trials,)
+        )
+
+        #: np.ndarray: Time between odors of each trial in ms
+        self.btw_ms = np.broadcast_to(np.asarray(btw_ms, dtype=np.int64), (num_trials,))
+
+        # Each trial's events relative to its own trigger, as runTrial times
+        # them
+        on_ms = TRIGGER_PULSE_MS + BASELINE_MS
+        off_ms = on_ms + self.odor_ms
+        end_ms = off_ms + delay_after_odor_ms(self.btw_ms)
+
+        # The next trigger is expected once triggerTime has passed
+        trigger_ms = np.concatenate(
+            [[0], np.cumsum(end_ms + TRIGGER_TIME_MS)[:-1]]
+        ).astype(np.int64)[:num_trials]
+
+        #: np.ndarray: Offset in ns of each trial's event of each type from
+        # the first trigger, shaped (trials, EVENT_TYPES)
+        self.offsets_ns = np.stack(
+            [trigger_ms, trigger_ms + on_ms, trigger_ms + off_ms, trigger_ms + end_ms],
+            axis=1,
+        ) * (10**6)
+
+        #: int: Wall-clock time in ns of the first trigger, or None until an
+        # event anchors the schedule
+        self.anchor_ns = None
+
+    def offset(self, trial: int, msg: str):
+        """Gets the offset of one trial's event from the first trigger.
+
+        Args:
+            trial: The trial, counting from 0.
+            msg: The event type, "9", "1", "2" or "3".
+
+        Returns:
+            The offset in ns.
+        """
+
+        return int(self.offsets_ns[trial, EVENT_TYPES.index(msg)])
+
+    def anchor(self, trial: int, msg: str, time_ns: int):
+        """Anchors the schedule so that an event happened on time.
+
+        Args:
+            trial: The trial of the event, counting from 0.
+            msg: The event type.
+            time_ns: Wall-clock time of the event in ns since the epoch.
+        """
+
+        self.anchor_ns = time_ns - self.offset(trial, msg)
+
+    def predicted(self, trial: int, msg: str):
+        """Gets the predicted time of one trial's event.
+
+        Args:
+            trial: The trial, counting from 0.
+            msg: The event type.
+
+        Returns:
+            Wall-clock time in ns since the epoch.
+        """
+
+        return self.anchor_ns + self.offset(trial, msg)
+
+    def to_dataframe(self, panel_type: str):
+        """Gets the schedule in the layout of the solenoid timings csv, with
+        offsets in ms from the first trigger instead of times.
+
+        Args:
+            panel_type: Whether odor panel is 1% or 10%.
+
+        Returns:
+            DataFrame with one row per trial.
+        """
+
+        offsets_ms = self.offsets_ns // 10**6
+
+        return pd.DataFrame(
+            {
+                "Trial": np.arange(1, len(self.odors) + 1),
+                f"Odor {panel_type}": self.odors,
+                "Odor duration (ms)": self.odor_ms,
+                "Time btw odors (ms)": self.btw_ms,
+                "Microscope Triggered (ms)": offsets_ms[:, 0],
+                "Solenoid opened (ms)": offsets_ms[:, 1],
+                "Solenoid closed (ms)": offsets_ms[:, 2],
+                "Delay finished (ms)": offsets_ms[:, 3],
+            }
+        )
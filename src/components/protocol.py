@@ -0,0 +1,290 @@
+"""Contains the binary framing used between the app and arduino_sketch.
+
+Every message is sent as one frame:
+
+    | 0xA5 | type | seq | len | payload (len bytes) | crc8 |
+
+type is a single ASCII character, seq counts frames sent in each direction
+(mod 256) so lost frames can be detected, and crc8 (polynomial 0x07) covers
+type, seq, len and payload.
+
+Messages from the app to the arduino:
+
+    "T" one trial: solenoid (u8), odor duration ms (u32), time between odors
+        ms (u32). The arduino queues up to a few trials and runs them back to
+        back, and doesn't acknowledge a trial while its queue is full.
+    "C" cancel the queued trials and the rest of an uploaded sequence, no
+        payload
+    "S" start of a sequence upload: number of trials (u16), at most
+        MAX_SEQUENCE_TRIALS
+    "Q" trials of a sequence upload, repeated for up to MAX_TRIALS_PER_FRAME
+        trials in the same layout as "T"
+    "H" hello, sent until the arduino answers: keepalive interval ms (u16),
+        or 0 for no keepalive
+    "?" clock sync ping, no payload
+    "B" switch to a new baud rate (u32). The arduino keeps the new rate only
+        if it then receives enough pings before falling back.
+
+Messages from the arduino to the app:
+
+    "r" ready, answers a hello: firmware version (u16), seq of the hello (u8)
+    "y" status, sent after each "r" and as a keepalive after the arduino has
+        been silent for the keepalive interval: number of trials completed
+        (u16)
+    "9", "1", "2", "3" microscope triggered, odor on, odor off and delay
+        finished: arduino millis() (u32)
+    "p" ping reply: arduino millis() (u32), seq of the ping (u8)
+    "8" sequence upload stored: number of trials stored (u16)
+    "a" command received: seq of the acknowledged frame (u8)
+    "n" corrupted command received, no payload
+
+All numbers are little-endian.
+"""
+
+import struct
+
+#: int: Version of arduino_sketch that speaks this protocol, checked in the
+# ready reply
+FIRMWARE_VERSION = 2
+
+#: int: First byte of every frame
+SYNC = 0xA5
+
+#: int: Number of bytes before the payload
+HEADER_SIZE = 4
+
+#: int: Largest payload that fits in a frame
+MAX_PAYLOAD = 255
+
+#: str: Layout of a trial in "T" and "Q" payloads
+TRIAL_FORMAT = "<BII"
+
+#: int: Number of trials sent per "Q" frame
+MAX_TRIALS_PER_FRAME = MAX_PAYLOAD // struct.calcsize(TRIAL_FORMAT)
+
+#: int: Most trials the arduino can store from a sequence upload, must match
+# maxTrials in arduino_sketch
+MAX_SEQUENCE_TRIALS = 200
+
+#: int: How long in ms arduino_sketch holds the microscope trigger pulse
+TRIGGER_PULSE_MS = 100
+
+#: int: How long in ms arduino_sketch waits after the trigger pulse before
+# opening the solenoid, must match delayMicroscopeTrigger
+BASELINE_MS = 0
+
+#: int: How long in ms arduino_sketch sets aside for the next microscope
+# trigger at the end of each trial, must match triggerTime
+TRIGGER_TIME_MS = 400
+
+#: int: Largest payload sent by the arduino
+MAX_ARDUINO_PAYLOAD = 5
+
+#: set: Arduino message types whose payload ends with the seq of the command
+# they answer
+REPLY_TYPES = {"p", "a", "r"}
+
+#: dict: Layout of the payload of each arduino message type
+VALUE_FORMATS = {
+    "y": "<H",
+    "9": "<I",
+    "1": "<I",
+    "2": "<I",
+    "3": "<I",
+    "p": "<IB",
+    "r": "<HB",
+    "8": "<H",
+    "a": "<B",
+}
+
+
+def make_crc8_table():
+    """Builds the lookup table for CRC-8 with polynomial 0x07.
+
+    Returns:
+        List of the CRC of every byte value.
+    """
+
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+
+    return table
+
+
+#: list: CRC-8 lookup table
+CRC8_TABLE = make_crc8_table()
+
+
+def crc8(data: bytes):
+    """Calculates the CRC-8 of some bytes.
+
+    Args:
+        data: The bytes to check.
+
+    Returns:
+        The CRC as an int.
+    """
+
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+
+    return crc
+
+
+def encode_frame(msg_type: str, seq: int, payload: bytes = b""):
+    """Packs a message into a frame.
+
+    Args:
+        msg_type: The single character message type.
+        seq: The frame's sequence number.
+        payload: The message contents.
+
+    Returns:
+        The frame as bytes.
+    """
+
+    body = bytes([ord(msg_type), seq & 0xFF, len(payload)]) + payload
+
+    return bytes([SYNC]) + body + bytes([crc8(body)])
+
+
+def encode_trial(solenoid: int, odor_ms: int, btw_ms: int):
+    """Packs one trial in the layout used by "T" and "Q" payloads.
+
+    Args:
+        solenoid: The solenoid (odor) number.
+        odor_ms: Odor duration in ms.
+        btw_ms: Time between odors in ms.
+
+    Returns:
+        The trial as bytes.
+    """
+
+    return struct.pack(TRIAL_FORMAT, solenoid, odor_ms, btw_ms)
+
+
+def delay_after_odor_ms(btw_ms):
+    """Works out how long arduino_sketch waits after the odor, as its
+    toDelayTime does. The time between odors also covers the trigger pulse,
+    the baseline and the time set aside for the next trigger.
+
+    Args:
+        btw_ms: Time between odors in ms, a number or an array.
+
+    Returns:
+        The delay in ms.
+    """
+
+    return btw_ms - (BASELINE_MS + TRIGGER_PULSE_MS) - TRIGGER_TIME_MS
+
+
+def decode_payload(msg_type: str, payload: bytes):
+    """Unpacks the numbers carried by a message from the arduino.
+
+    Args:
+        msg_type: The single character message type.
+        payload: The message contents.
+
+    Returns:
+        The number carried by the message, or None if it doesn't carry one,
+        and the seq of the command it answers, or None if it isn't a reply.
+    """
+
+    value_format = VALUE_FORMATS.get(msg_type)
+
+    if value_format is None or len(payload) != struct.calcsize(value_format):
+        return None, None
+
+    fields = struct.unpack(value_format, payload)
+
+    if msg_type in REPLY_TYPES:
+        return (fields[0] if len(fields) > 1 else None), fields[-1]
+
+    return fields[0], None
+
+
+class FrameParser:
+    """Splits a stream of bytes into frames, dropping corrupted frames and
+    counting frames that never arrived."""
+
+    def __init__(self, max_payload: int = MAX_PAYLOAD):
+        """Initializes an empty parser.
+
+        Args:
+            max_payload: Largest payload expected. Frames claiming a longer
+                payload are treated as corrupted instead of waiting for bytes
+                that will never arrive.
+        """
+
+        #: bytearray: Bytes received but not yet parsed
+        self.buffer = bytearray()
+
+        #: int: Largest payload expected
+        self.max_payload = max_payload
+
+        #: int: Sequence number of the last valid frame
+        self.last_seq = None
+
+        #: int: Number of frames that failed the CRC check
+        self.bad_frames = 0
+
+        #: int: Number of frames skipped in the sequence numbers
+        self.lost_frames = 0
+
+    def feed(self, data: bytes):
+        """Adds received bytes and returns the frames completed by them.
+
+        Args:
+            data: Bytes read from the port.
+
+        Returns:
+            List of (msg_type, seq, payload) tuples for each valid frame, and
+            the number of frames found to be corrupted or lost.
+        """
+
+        self.buffer += data
+        frames = []
+        errors = 0
+
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                self.buffer.clear()
+                break
+            del self.buffer[:start]
+
+            if len(self.buffer) < HEADER_SIZE:
+                break
+
+            frame_size = HEADER_SIZE + self.buffer[3] + 1
+            if self.buffer[3] <= self.max_payload and len(self.buffer) < frame_size:
+                break
+
+            body = bytes(self.buffer[1 : frame_size - 1])
+            if (
+                self.buffer[3] > self.max_payload
+                or crc8(body) != self.buffer[frame_size - 1]
+            ):
+                # Drop only the sync byte so the next frame can be found
+                self.bad_frames += 1
+                errors += 1
+                del self.buffer[:1]
+                continue
+
+            del self.buffer[:frame_size]
+            msg_type, seq = chr(body[0]), body[1]
+
+            if self.last_seq is not None:
+                skipped = (seq - self.last_seq - 1) & 0xFF
+                self.lost_frames += skipped
+                errors += skipped
+            self.last_seq = seq
+
+            frames.append((msg_type, seq, body[3:]))
+
+        return frames, errors
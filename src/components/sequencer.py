@@ -0,0 +1,97 @@
+"""Contains the requests ArduinoSession's serial conversation makes of its
+transport, and the drivers that carry them out on either serial engine.
+
+The conversation (handshake, baud rate negotiation, clock sync and the trial
+loop) is written once, as generators that never touch the port. Each yields
+a request such as Write or ReadEvent and is sent back the result, e.g. the
+ArduinoEvent that was read. run_steps carries the requests out on a blocking
+SerialTransport and run_steps_async on an AsyncArduinoTransport, so both
+engines follow exactly the same protocol.
+"""
+
+from typing import Generator, NamedTuple, Optional
+
+
+class Write(NamedTuple):
+    """Asks the transport to write a frame to the arduino."""
+
+    #: bytes: The frame to send
+    data: bytes
+
+
+class ReadEvent(NamedTuple):
+    """Asks the transport for the next message from the arduino. The result
+    is the ArduinoEvent, or None if the wait timed out or was aborted."""
+
+    #: float: How long in s to wait, or None to wait until a message arrives
+    timeout: Optional[float]
+
+
+class SetBaudRate(NamedTuple):
+    """Asks the transport to switch the host side of the port to a new baud
+    rate."""
+
+    #: int: The new baud rate
+    baud_rate: int
+
+
+class Sleep(NamedTuple):
+    """Asks the transport to wait without reading, unless aborted first."""
+
+    #: float: How long in s to wait
+    seconds: float
+
+
+#: dict: Transport method carrying out each type of request
+TRANSPORT_METHODS = {
+    Write: "write",
+    ReadEvent: "read_event",
+    SetBaudRate: "set_baud_rate",
+    Sleep: "sleep",
+}
+
+
+def run_steps(steps: Generator, transport):
+    """Runs a conversation on a blocking transport until it finishes.
+
+    Args:
+        steps: The generator yielding requests.
+        transport: The SerialTransport carrying them out.
+
+    Returns:
+        The value the generator returned.
+    """
+
+    result = None
+
+    while True:
+        try:
+            request = steps.send(result)
+        except StopIteration as finished:
+            return finished.value
+
+        result = getattr(transport, TRANSPORT_METHODS[type(request)])(*request)
+
+
+async def run_steps_async(steps: Generator, transport):
+    """Runs a conversation on an asyncio transport until it finishes.
+
+    Args:
+        steps: The generator yielding requests.
+        transport: The AsyncArduinoTransport carrying them out.
+
+    Returns:
+        The value the generator returned.
+    """
+
+    result = None
+
+    while True:
+        try:
+            request = steps.send(result)
+        except StopIteration as finished:
+            return finished.value
+
+        result = await getattr(transport, TRANSPORT_METHODS[type(request)])(
+            *request
+        )
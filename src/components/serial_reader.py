@@ -0,0 +1,94 @@
+"""Contains the SerialReader class to read messages from the Arduino board in
+a background thread."""
+
+import queue
+import time
+from threading import Thread, Event
+from typing import NamedTuple, Optional
+
+import serial
+
+from components.protocol import FrameParser, MAX_ARDUINO_PAYLOAD, decode_payload
+
+
+class ArduinoEvent(NamedTuple):
+    """A single message received from the Arduino board."""
+
+    #: str: The message type sent by the arduino, e.g. "9", "1", "2", "3" or
+    # "y", or "e" when frames were found to be corrupted or lost
+    msg: str
+
+    #: int: time.perf_counter_ns() when the message was read from the port
+    time: int
+
+    #: int: The number carried by the message, e.g. the arduino's millis()
+    # for "9", "1", "2", "3" and "p", the number of stored trials for "8" or
+    # the firmware version for "r"
+    value: Optional[int] = None
+
+    #: int: The seq of the command this message answers, for "a", "p" and "r"
+    reply_seq: Optional[int] = None
+
+
+class SerialReader(Thread):
+    """Reads frames from the Arduino port as soon as they arrive and pushes
+    them into a queue as ArduinoEvents."""
+
+    def __init__(self, arduino: serial.Serial, events: queue.Queue):
+        """Initializes the reader thread for an opened Arduino port.
+
+        Args:
+            arduino: The opened Serial instance to read from.
+            events: The queue that parsed ArduinoEvents are pushed into.
+        """
+
+        super().__init__(daemon=True)
+
+        #: serial.Serial: The Serial instance the reader reads from
+        self.arduino = arduino
+
+        #: queue.Queue: Queue of ArduinoEvents for the sequencer and UI
+        self.events = events
+
+        #: Event: Event to stop the reader thread
+        self.stop_reading = Event()
+
+        #: FrameParser: Splits received bytes into frames
+        self.parser = FrameParser(max_payload=MAX_ARDUINO_PAYLOAD)
+
+    def run(self):
+        """Reads frames until stopped or the port is closed."""
+
+        while not self.stop_reading.is_set():
+            try:
+                # Block for the first byte, then take whatever else is waiting
+                data = self.arduino.read(1)
+                if data and self.arduino.in_waiting:
+                    data += self.arduino.read(self.arduino.in_waiting)
+            except (serial.SerialException, TypeError, AttributeError, OSError):
+                # Port was closed from another thread
+                break
+
+            if not data:
+                continue
+
+            # Timestamp the frames the moment they land
+            time_received = time.perf_counter_ns()
+            frames, errors = self.parser.feed(data)
+
+            if errors:
+                self.events.put(ArduinoEvent("e", time_received, errors))
+
+            for msg_type, seq, payload in frames:
+                value, reply_seq = decode_payload(msg_type, payload)
+                self.events.put(
+                    ArduinoEvent(msg_type, time_received, value, reply_seq)
+                )
+
+    def stop(self):
+        """Stops the reader thread and waits for it to finish."""
+
+        self.stop_reading.set()
+        if self.is_alive():
+            self.arduino.cancel_read()
+            self.join(timeout=self.arduino.timeout)
@@ -0,0 +1,110 @@
+"""Contains the SerialTransport class to open, read from and write to the
+Arduino port from a blocking thread."""
+
+import queue
+from threading import Event
+
+import serial
+
+from components.serial_reader import SerialReader
+
+
+class SerialTransport:
+    """Blocking layer over the Arduino serial port for the thread engine.
+
+    Messages are read by a SerialReader thread into a queue, which the
+    conversation blocks on. Aborting wakes a blocked read right away.
+    """
+
+    def __init__(self, arduino: serial.Serial):
+        """Initializes the transport for a configured but unopened port.
+
+        Args:
+            arduino: The Serial instance to open.
+        """
+
+        #: serial.Serial: The Serial instance used in this session
+        self.arduino = arduino
+
+        #: queue.Queue: ArduinoEvents pushed by the reader thread, and None
+        # when the session is aborted
+        self.events = queue.Queue()
+
+        #: SerialReader: Background thread reading messages from the arduino
+        self.reader = None
+
+        #: Event: Set when the session is aborted
+        self.aborted = Event()
+
+    def open(self):
+        """Opens the port and starts reading messages from it."""
+
+        self.arduino.open()
+
+        self.reader = SerialReader(self.arduino, self.events)
+        self.reader.start()
+
+    def write(self, data: bytes):
+        """Writes data to the arduino.
+
+        Args:
+            data: The frame to send.
+        """
+
+        self.arduino.write(data)
+
+    def read_event(self, timeout: float = None):
+        """Waits for the next message from the arduino or for an abort.
+
+        Args:
+            timeout: How long in s to wait, or None to wait until a message
+                arrives.
+
+        Returns:
+            The next ArduinoEvent, or None if the wait was aborted or timed
+            out.
+        """
+
+        if self.aborted.is_set():
+            return None
+
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def set_baud_rate(self, baud_rate: int):
+        """Switches the host side of the port to a new baud rate.
+
+        Args:
+            baud_rate: The new baud rate.
+        """
+
+        self.arduino.flush()
+        self.arduino.baudrate = baud_rate
+        self.arduino.reset_input_buffer()
+
+    def sleep(self, seconds: float):
+        """Waits without reading, unless aborted first.
+
+        Args:
+            seconds: How long in s to wait.
+        """
+
+        self.aborted.wait(seconds)
+
+    def abort(self):
+        """Wakes a blocked read_event or sleep. Can be called from any
+        thread."""
+
+        self.aborted.set()
+        self.events.put(None)
+
+    def close(self):
+        """Stops the reader thread and closes the port."""
+
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+
+        self.arduino.close()
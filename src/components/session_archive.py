@@ -0,0 +1,265 @@
+"""Contains functions to archive sessions as a Parquet dataset that analysis
+jobs can query without parsing every csv.
+
+The archive holds three tables, each a directory of Parquet files
+partitioned by date and animal:
+
+    <archive>/sessions/date=231116/animal=123/ROI1_231116-140327.parquet
+    <archive>/trials/date=231116/animal=123/ROI1_231116-140327.parquet
+    <archive>/events/date=231116/animal=123/ROI1_231116-140327.parquet
+
+"sessions" has one row per session with its settings, "trials" one row per
+trial with its odor and times, and "events" one row per arduino event. Times
+are UTC timestamps in ns. Read a slice of it with e.g.
+
+    load_archive(path, "trials", [("animal", "=", "123"), ("odor", "=", 3)])
+
+Archiving needs pyarrow, which the app doesn't otherwise depend on. Without
+it ARCHIVE_AVAILABLE is False and sessions are only saved as csv files.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from components.event_store import EVENT_TYPES, MISSING, EventStore
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+#: bool: Whether pyarrow is installed, so sessions can be archived
+ARCHIVE_AVAILABLE = pa is not None
+
+#: str: Default location of the archive, in the user's home directory next to
+# the experiment index
+DEFAULT_ARCHIVE_PATH = os.path.join(os.path.expanduser("~"), "odor_delivery_archive")
+
+
+def partition_dir(archive_path: str, table: str, date: str, animal: str):
+    """Gets the directory holding one date and animal of a table.
+
+    Args:
+        archive_path: The archive's root directory.
+        table: "sessions", "trials" or "events".
+        date: The date of the experiment, e.g. "231116".
+        animal: The animal ID of the experiment.
+
+    Returns:
+        Path of the partition directory.
+    """
+
+    return os.path.join(archive_path, table, f"date={date}", f"animal={animal}")
+
+
+def write_partition(
+    archive_path: str, table: str, date: str, animal: str, name: str, data
+):
+    """Writes one session's rows of a table.
+
+    The file is written under a temporary name and then renamed, so readers
+    never see half a file, and archiving the same session again replaces it.
+
+    Args:
+        archive_path: The archive's root directory.
+        table: "sessions", "trials" or "events".
+        date: The date of the experiment.
+        animal: The animal ID of the experiment.
+        name: Name of the session's file, without extension.
+        data: The pyarrow Table of rows.
+    """
+
+    directory = partition_dir(archive_path, table, date, animal)
+    os.makedirs(directory, exist_ok=True)
+
+    path = os.path.join(directory, f"{name}.parquet")
+    pq.write_table(data, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def timestamps(time_ns: np.ndarray):
+    """Converts ns since the epoch to a UTC timestamp column.
+
+    Args:
+        time_ns: int64 times, with MISSING for times that weren't recorded.
+
+    Returns:
+        pyarrow timestamp array with nulls for missing times.
+    """
+
+    return pa.array(time_ns, pa.timestamp("ns", tz="UTC"), mask=time_ns == MISSING)
+
+
+def sessions_table(settings: dict, panel_type: str, csv_time: str, outcome: str):
+    """Gets a session's row of the sessions table.
+
+    Args:
+        settings: All experiment settings entered from settings fields.
+        panel_type: Whether odor panel is 1% or 10%.
+        csv_time: Timestamp the session's csv files are named with.
+        outcome: How the session ended, e.g. "complete" or "aborted".
+
+    Returns:
+        pyarrow Table with one row.
+    """
+
+    return pa.table(
+        {
+            "roi": pa.array([settings["roi"]], pa.string()),
+            "session": pa.array([csv_time], pa.string()),
+            "panel_type": pa.array([panel_type], pa.string()),
+            "trial_type": pa.array([settings.get("trial_type")], pa.string()),
+            "odor_duration": pa.array([settings.get("odor_duration")], pa.int32()),
+            "time_btw_odors": pa.array([settings.get("time_btw_odors")], pa.int32()),
+            "num_trials": pa.array([settings.get("num_trials")], pa.int32()),
+            "randomize_trials": pa.array(
+                [settings.get("randomize_trials")], pa.bool_()
+            ),
+            "outcome": pa.array([outcome], pa.string()),
+            # Every setting, including ones added later, as the app saved them
+            "settings": pa.array([json.dumps(settings)], pa.string()),
+        }
+    )
+
+
+def trials_table(roi: str, csv_time: str, event_store: EventStore):
+    """Gets a session's rows of the trials table.
+
+    Args:
+        roi: The ROI of the experiment.
+        csv_time: Timestamp the session's csv files are named with.
+        event_store: The session's events.
+
+    Returns:
+        pyarrow Table with one row per trial in the odor sequence, with its
+        scheduled odor duration and time between odors in ms.
+    """
+
+    num_trials = event_store.num_trials
+    columns = {
+        "roi": pa.array([roi] * num_trials, pa.string()),
+        "session": pa.array([csv_time] * num_trials, pa.string()),
+        "trial": pa.array(np.arange(1, num_trials + 1, dtype=np.int32)),
+        "odor": pa.array(event_store.odors),
+    }
+
+    # What was scheduled for each trial, null for sessions from before
+    # trials were timed one by one
+    for name in ["odor_ms", "btw_ms"]:
+        if event_store.schedule is not None:
+            columns[name] = pa.array(getattr(event_store.schedule, name), pa.int32())
+        else:
+            columns[name] = pa.nulls(num_trials, pa.int32())
+
+    for name, msg in [
+        ("microscope_triggered", "9"),
+        ("solenoid_opened", "1"),
+        ("solenoid_closed", "2"),
+        ("delay_finished", "3"),
+    ]:
+        rows = event_store.event_rows[:, EVENT_TYPES.index(msg)]
+        time_ns = np.where(
+            rows >= 0, event_store.time_ns[np.maximum(rows, 0)], MISSING
+        )
+        columns[name] = timestamps(time_ns)
+
+    return pa.table(columns)
+
+
+def events_table(roi: str, csv_time: str, event_store: EventStore):
+    """Gets a session's rows of the events table.
+
+    Args:
+        roi: The ROI of the experiment.
+        csv_time: Timestamp the session's csv files are named with.
+        event_store: The session's events.
+
+    Returns:
+        pyarrow Table with one row per recorded event.
+    """
+
+    events = slice(0, event_store.num_events)
+    num_events = event_store.num_events
+    device_ms = event_store.device_ms[events]
+
+    return pa.table(
+        {
+            "roi": pa.array([roi] * num_events, pa.string()),
+            "session": pa.array([csv_time] * num_events, pa.string()),
+            "trial": pa.array(event_store.trial[events] + 1),
+            "odor": pa.array(event_store.odor[events]),
+            "event": pa.DictionaryArray.from_arrays(
+                pa.array(event_store.event_type[events]),
+                pa.array(list(EVENT_TYPES)),
+            ),
+            "time": timestamps(event_store.time_ns[events]),
+            "device_ms": pa.array(device_ms, mask=device_ms < 0),
+        }
+    )
+
+
+def write_session_archive(
+    archive_path: str,
+    settings: dict,
+    panel_type: str,
+    csv_time: str,
+    event_store: EventStore,
+    outcome: str,
+):
+    """Archives one session's settings, trial order and event times.
+
+    Args:
+        archive_path: The archive's root directory.
+        settings: All experiment settings entered from settings fields.
+        panel_type: Whether odor panel is 1% or 10%.
+        csv_time: Timestamp the session's csv files are named with.
+        event_store: The session's events.
+        outcome: How the session ended, e.g. "complete" or "aborted".
+    """
+
+    if not ARCHIVE_AVAILABLE:
+        raise ImportError("pyarrow is needed to archive sessions")
+
+    date = settings["date"]
+    animal = settings["mouse"]
+    roi = settings["roi"]
+    name = f"{roi}_{csv_time}"
+
+    for table, data in [
+        ("sessions", sessions_table(settings, panel_type, csv_time, outcome)),
+        ("trials", trials_table(roi, csv_time, event_store)),
+        ("events", events_table(roi, csv_time, event_store)),
+    ]:
+        write_partition(archive_path, table, date, animal, name, data)
+
+
+def load_archive(archive_path: str, table: str, filters: list = None):
+    """Reads rows of an archive table as a DataFrame.
+
+    Only the partitions and row groups that can match the filters are read.
+
+    Args:
+        archive_path: The archive's root directory.
+        table: "sessions", "trials" or "events".
+        filters: pyarrow filters, e.g. [("date", ">=", "231101")], or None
+            to read the whole table.
+
+    Returns:
+        DataFrame with the table's columns plus "date" and "animal".
+    """
+
+    if not ARCHIVE_AVAILABLE:
+        raise ImportError("pyarrow is needed to read the archive")
+
+    return pq.read_table(
+        os.path.join(archive_path, table),
+        filters=filters,
+        partitioning=ds.partitioning(
+            pa.schema([("date", pa.string()), ("animal", pa.string())]),
+            flavor="hive",
+        ),
+    ).to_pandas()
@@ -0,0 +1,63 @@
+"""Contains the SessionClock class to timestamp a session's events with a
+monotonic clock that is tied to the wall clock once, when the session
+starts."""
+
+import time
+
+
+class SessionClock:
+    """Converts time.perf_counter_ns() timestamps to wall-clock time.
+
+    The wall clock is read only when the clock is created. Every later time is
+    that reading plus the perf_counter time elapsed since, so an NTP
+    correction in the middle of a session can't stretch or shift the
+    intervals between events, and taking a timestamp is a single
+    perf_counter_ns() call instead of building a datetime.
+    """
+
+    def __init__(self, anchor_samples: int = 5):
+        """Reads the wall clock against perf_counter.
+
+        Args:
+            anchor_samples: Number of wall clock readings to take. The one
+                bracketed by the closest pair of perf_counter readings is
+                kept.
+        """
+
+        best = None
+        for sample in range(anchor_samples):
+            before = time.perf_counter_ns()
+            wall_ns = time.time_ns()
+            after = time.perf_counter_ns()
+
+            if best is None or after - before < best[0]:
+                best = (after - before, wall_ns, (before + after) // 2)
+
+        #: int: Time in ns between the perf_counter readings around the wall
+        # clock reading, which bounds the error of the anchor
+        self.anchor_uncertainty_ns = best[0]
+
+        #: int: Wall-clock time in ns since the epoch when the clock was made
+        self.wall_anchor_ns = best[1]
+
+        #: int: perf_counter_ns() at the same moment
+        self.perf_anchor_ns = best[2]
+
+    def to_wall_ns(self, perf_ns):
+        """Maps perf_counter_ns() timestamps onto the wall clock.
+
+        Args:
+            perf_ns: A perf_counter_ns() timestamp, or an int64 array of
+                them.
+
+        Returns:
+            The wall-clock time in ns since the epoch, in the same form.
+        """
+
+        return self.wall_anchor_ns + (perf_ns - self.perf_anchor_ns)
+
+    def wall_ns(self):
+        """Returns the current wall-clock time in ns since the epoch, as
+        measured by perf_counter since the anchor."""
+
+        return self.to_wall_ns(time.perf_counter_ns())
@@ -0,0 +1,381 @@
+"""Contains the SessionJournal class to keep a crash-safe record of a session,
+and functions to replay it after a crash.
+
+The journal is a binary file next to the solenoid order csv. Each record is
+
+    | kind (1) | host time s (f8) | msg type (1) | len (u16) | payload | crc32 |
+
+with kind "M" for the session's metadata as JSON, "C" for a command sent to
+the arduino with the frame's payload, "E" for an event received from the
+arduino with the trial (i4) and the number it carried (i8, -1 for none), and
+"X" when the session ended. A journal without an "X" record belongs to a
+session that crashed. Records cut short by the crash fail their crc and are
+ignored.
+"""
+
+import datetime
+import glob
+import json
+import os
+import struct
+import time
+import zlib
+from threading import Lock, Timer
+
+from components.io_worker import IOWorker
+from components.serial_reader import ArduinoEvent
+
+#: str: Layout of the fixed part of every record
+RECORD_FORMAT = "<cdBH"
+
+#: int: Size of the fixed part of every record
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+#: str: Layout of an event record's payload
+EVENT_FORMAT = "<iq"
+
+#: int: Size of an event record's payload
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+
+class SessionJournal:
+    """Appends every command and event of a session to the journal file.
+
+    Records are collected in memory and written and fsynced in batches on
+    the I/O worker, so the serial loop never waits on the disk. A timer hands
+    a batch to the worker once its first record has waited fsync_interval,
+    even if no further record arrives, e.g. because the arduino went silent.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        io_worker: IOWorker,
+        batch_records: int = 32,
+        fsync_interval: float = 1.0,
+    ):
+        """Initializes the journal without creating the file yet.
+
+        Args:
+            path: Path of the journal file.
+            io_worker: The worker that writes the batches.
+            batch_records: Number of records collected before a batch is
+                written.
+            fsync_interval: Longest time in s a record waits before its batch
+                is handed to the worker to be written and fsynced.
+        """
+
+        #: str: Path of the journal file
+        self.path = path
+
+        #: IOWorker: The worker that writes the batches
+        self.io_worker = io_worker
+
+        #: int: Number of records collected before a batch is written
+        self.batch_records = batch_records
+
+        #: float: Longest time in s a record waits before being handed to the
+        # worker
+        self.fsync_interval = fsync_interval
+
+        #: bytearray: Records not yet handed to the worker
+        self.pending = bytearray()
+
+        #: int: Number of records in pending
+        self.pending_records = 0
+
+        #: Timer: Flushes the pending records once the first has waited
+        # fsync_interval, or None when nothing is pending
+        self.flush_timer = None
+
+        #: Lock: Guards the pending records, which the timer also flushes
+        self.lock = Lock()
+
+        #: file: The open journal file, used only on the worker thread
+        self.file = None
+
+    def add_record(self, kind: bytes, when: float, msg_type: str, payload: bytes):
+        """Adds one record and writes the batch if it is due.
+
+        Args:
+            kind: The record kind, b"M", b"C", b"E" or b"X".
+            when: Host time in s of the record.
+            msg_type: The single character message type, or "" for none.
+            payload: The record contents.
+        """
+
+        header = struct.pack(
+            RECORD_FORMAT, kind, when, ord(msg_type or "\0"), len(payload)
+        )
+        record = header + payload
+
+        with self.lock:
+            self.pending += record + struct.pack("<I", zlib.crc32(record))
+            self.pending_records += 1
+
+            if self.pending_records >= self.batch_records:
+                self.flush_pending()
+            elif self.flush_timer is None:
+                self.flush_timer = Timer(self.fsync_interval, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def start(self, metadata: dict):
+        """Starts the journal with the session's metadata.
+
+        Args:
+            metadata: Settings, odor sequence and file names needed to
+                rebuild the session.
+        """
+
+        self.add_record(b"M", time.time(), "", json.dumps(metadata).encode())
+        self.flush()
+
+    def log_command(self, msg_type: str, payload: bytes):
+        """Records a command sent to the arduino.
+
+        Args:
+            msg_type: The single character message type.
+            payload: The frame's payload.
+        """
+
+        self.add_record(b"C", time.time(), msg_type, payload)
+
+    def log_event(self, trial: int, event: ArduinoEvent, time_ns: int):
+        """Records an event received from the arduino.
+
+        Args:
+            trial: The trial running when the event arrived.
+            event: The message received from the arduino.
+            time_ns: The time the event happened in ns since the epoch, as
+                saved in the timings.
+        """
+
+        value = -1 if event.value is None else event.value
+        self.add_record(
+            b"E",
+            time_ns / 1e9,
+            event.msg,
+            struct.pack(EVENT_FORMAT, trial, value),
+        )
+
+    def finish(self, outcome: str):
+        """Records that the session ended and closes the journal.
+
+        Args:
+            outcome: How the session ended, e.g. "complete" or "aborted".
+        """
+
+        self.add_record(b"X", time.time(), "", outcome.encode())
+        self.flush()
+        self.io_worker.submit(self.close)
+
+    def flush(self):
+        """Hands the collected records to the worker to be written. Called
+        from the session's thread or by the flush timer."""
+
+        with self.lock:
+            self.flush_pending()
+
+    def flush_pending(self):
+        """Hands the collected records to the worker and stops the flush
+        timer. The lock must be held."""
+
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        if self.pending:
+            self.io_worker.submit(self.write_batch, bytes(self.pending))
+            self.pending = bytearray()
+            self.pending_records = 0
+
+    def write_batch(self, data: bytes):
+        """Appends a batch of records and fsyncs it. Runs on the worker.
+
+        Args:
+            data: The records to write.
+        """
+
+        if self.file is None:
+            self.file = open(self.path, "ab")
+
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        """Closes the journal file. Runs on the worker."""
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_journal(path: str):
+    """Reads every intact record of a journal.
+
+    Args:
+        path: Path of the journal file.
+
+    Returns:
+        List of (kind, host time s, msg type, payload) tuples, stopping at the
+        first record that was cut short or corrupted, and the size in bytes of
+        the intact records.
+    """
+
+    with open(path, "rb") as journal_file:
+        data = journal_file.read()
+
+    records = []
+    offset = 0
+
+    while offset + RECORD_SIZE <= len(data):
+        kind, when, msg_type, length = struct.unpack_from(RECORD_FORMAT, data, offset)
+        end = offset + RECORD_SIZE + length
+
+        if end + 4 > len(data):
+            break
+        (crc,) = struct.unpack_from("<I", data, end)
+        if zlib.crc32(data[offset:end]) != crc:
+            break
+
+        records.append(
+            (
+                kind.decode(),
+                when,
+                chr(msg_type) if msg_type else "",
+                data[offset + RECORD_SIZE : end],
+            )
+        )
+        offset = end + 4
+
+    return records, offset
+
+
+def replay_journal(path: str):
+    """Rebuilds the state of a session from its journal.
+
+    A trial counts as delivered once its solenoid closed. A trial whose
+    solenoid opened but never closed was in progress when the session
+    stopped and is delivered again on resume.
+
+    Args:
+        path: Path of the journal file.
+
+    Returns:
+        Dict with the session "metadata", whether it "finished", the
+        "timings" rows for the timings csv, the number of trials
+        "delivered", the trial "in_progress" or None, and the "remaining"
+        odors in order with their "remaining_odor_ms" and "remaining_btw_ms",
+        which are None for journals from before trials were timed one by one.
+    """
+
+    records = read_journal(path)[0]
+
+    metadata = None
+    finished = False
+    trial_times = {}
+
+    for kind, when, msg_type, payload in records:
+        if kind == "M":
+            metadata = json.loads(payload)
+        elif kind == "X":
+            finished = True
+        elif kind == "E" and msg_type in "912" and len(payload) == EVENT_SIZE:
+            trial, value = struct.unpack(EVENT_FORMAT, payload)
+            trial_times.setdefault(trial, {})[msg_type] = (
+                datetime.datetime.fromtimestamp(when).isoformat(
+                    "|", timespec="milliseconds"
+                )
+            )
+
+    if metadata is None:
+        return None
+
+    solenoid_order = metadata["solenoid_order"]
+    seeds = [
+        metadata["settings"].get("seed"),
+        metadata["settings"].get("timing_seed"),
+    ]
+
+    delivered = 0
+    for trial in sorted(trial_times):
+        if "2" in trial_times[trial] or trial + 1 in trial_times:
+            delivered = trial + 1
+
+    in_progress = delivered if delivered in trial_times else None
+
+    timings = []
+    for trial in range(delivered):
+        times = trial_times.get(trial, {})
+        timings.append(
+            [
+                trial + 1,
+                solenoid_order[trial],
+                times.get("9", ""),
+                times.get("1", ""),
+                times.get("2", ""),
+            ]
+            + seeds
+        )
+
+    return {
+        "metadata": metadata,
+        "finished": finished,
+        "timings": timings,
+        "delivered": delivered,
+        "in_progress": in_progress,
+        "remaining": solenoid_order[delivered:],
+        "remaining_odor_ms": (
+            metadata["odor_ms"][delivered:] if "odor_ms" in metadata else None
+        ),
+        "remaining_btw_ms": (
+            metadata["btw_ms"][delivered:] if "btw_ms" in metadata else None
+        ),
+    }
+
+
+def find_unfinished_journals(directory: str):
+    """Finds the journals of sessions in a directory that never ended.
+
+    Args:
+        directory: The experiment directory.
+
+    Returns:
+        List of (path, replayed session) for each unfinished journal, newest
+        first.
+    """
+
+    unfinished = []
+
+    for path in sorted(
+        glob.glob(os.path.join(directory, "*_session_journal_*.bin")), reverse=True
+    ):
+        session = replay_journal(path)
+        if session is not None and not session["finished"]:
+            unfinished.append((path, session))
+
+    return unfinished
+
+
+def mark_journal_resolved(path: str, outcome: str):
+    """Ends a crashed session's journal, so it isn't offered again.
+
+    Args:
+        path: Path of the journal file.
+        outcome: What was done with it, e.g. "resumed" or "discarded".
+    """
+
+    records, intact_size = read_journal(path)
+
+    payload = outcome.encode()
+    record = struct.pack(RECORD_FORMAT, b"X", time.time(), 0, len(payload)) + payload
+
+    # Drop a record cut short by the crash, so the end record can be read
+    with open(path, "r+b") as journal_file:
+        journal_file.truncate(intact_size)
+        journal_file.seek(intact_size)
+        journal_file.write(record + struct.pack("<I", zlib.crc32(record)))
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
@@ -11,6 +11,9 @@ from flet import (
 
 import pdb
 
+from components.counterbalance import DESIGNS
+from components.trial_schedule import JITTER_DISTRIBUTIONS
+
 
 class SettingsFields(UserControl):
     """Creates settings field for each specific input with default values."""
@@ -41,6 +44,11 @@ class SettingsFields(UserControl):
             "Odor duration (s)": {"value": "1"},
             "Time between odors (s)": {"value": "10"},
             "Specific odors": {"value": ""},
+            "Longest run of an odor": {"value": ""},
+            "Min. trials between repeats": {"value": "0"},
+            "Seed": {"value": ""},
+            "ITI jitter (s)": {"value": "0"},
+            "Odor durations (s)": {"value": ""},
         }
 
         #: ft.TextField: The actual field UI element
@@ -67,6 +75,38 @@ class SettingsFields(UserControl):
         if self.label == "Specific odors":
             self.text_field.hint_text = "e.g. 1,2,7"
 
+        if self.label in [
+            "Longest run of an odor",
+            "Min. trials between repeats",
+            "Seed",
+        ]:
+            self.text_field.input_filter = ft.InputFilter(
+                allow=True,
+                regex_string=r"[0-9]",
+                replacement_string="",
+            )
+
+        if self.label == "Longest run of an odor":
+            self.text_field.hint_text = "No limit"
+
+        if self.label == "Seed":
+            self.text_field.hint_text = "New seed"
+
+        if self.label == "ITI jitter (s)":
+            self.text_field.input_filter = ft.InputFilter(
+                allow=True,
+                regex_string=r"[0-9.]",
+                replacement_string="",
+            )
+
+        if self.label == "Odor durations (s)":
+            self.text_field.input_filter = ft.InputFilter(
+                allow=True,
+                regex_string=r"[0-9.,]",
+                replacement_string="",
+            )
+            self.text_field.hint_text = "e.g. 1,2,4"
+
     def reset(self):
         """Resets the text field to default value."""
         self.text_field.value = self.textfield_dict[self.label]["value"]
@@ -201,6 +241,58 @@ class SettingsLayout(UserControl):
             label="Time between odors (s)", on_change=check_complete
         )
 
+        #: ft.Dropdown: Select shuffled trials or a counterbalanced design
+        self.design = ft.Dropdown(
+            value="Shuffled",
+            label="Trial order",
+            options=[ft.dropdown.Option(design) for design in ["Shuffled"] + DESIGNS],
+            col={"sm": 4},
+            border_color=ft.colors.SECONDARY_CONTAINER,
+            border_width=1,
+            focused_border_color=ft.colors.SURFACE_TINT,
+            focused_border_width=2,
+        )
+
+        #: ft.Checkbox: Whether shuffled trials may repeat an odor back to back
+        self.no_repeats = ft.Checkbox(label="No repeats", value=False)
+
+        #: ft.Checkbox: Whether shuffled trials deliver every odor once per
+        # block of trials
+        self.balanced_blocks = ft.Checkbox(label="Balanced blocks", value=False)
+
+        #: SettingsFields: Most shuffled trials in a row with the same odor
+        self.max_run = SettingsFields(label="Longest run of an odor")
+
+        #: SettingsFields: Seed to shuffle trials with, to repeat a past
+        # session's order
+        self.seed = SettingsFields(label="Seed")
+
+        #: SettingsFields: Fewest other trials between shuffled trials with the
+        # same odor
+        self.min_gap = SettingsFields(label="Min. trials between repeats")
+
+        #: SettingsFields: Jitter of the time between odors (s)
+        self.iti_jitter = SettingsFields(label="ITI jitter (s)")
+
+        #: ft.Dropdown: Select the distribution the jitter is drawn from
+        self.jitter_distribution = ft.Dropdown(
+            value=JITTER_DISTRIBUTIONS[0],
+            label="Jitter distribution",
+            options=[
+                ft.dropdown.Option(distribution)
+                for distribution in JITTER_DISTRIBUTIONS
+            ],
+            col={"sm": 4},
+            border_color=ft.colors.SECONDARY_CONTAINER,
+            border_width=1,
+            focused_border_color=ft.colors.SURFACE_TINT,
+            focused_border_width=2,
+        )
+
+        #: SettingsFields: Odor durations (s) each odor steps through, e.g.
+        # for a concentration series
+        self.duration_series = SettingsFields(label="Odor durations (s)")
+
     def arrange_settings_fields(self, e=None):
         """Arranges settings fields in rows.
 
@@ -219,15 +311,24 @@ class SettingsLayout(UserControl):
                 ]
             )
 
-            #: ft.ResponsiveRow: Arranges settings fields in the bottom row
+            #: ft.ResponsiveRow: Arranges settings fields in the middle row
             self.row2 = ft.Container()
 
+            #: ft.ResponsiveRow: Arranges the shuffle constraints in the
+            # third row
+            self.row3 = ft.Container()
+
+            #: ft.ResponsiveRow: Arranges the trial timing settings in the
+            # bottom row
+            self.row4 = ft.Container()
+
         if self.trial_type.value == "Multiple":
             self.row1 = ft.ResponsiveRow(
                 [
                     Column(col={"sm": 3}, controls=[self.panel_type]),
                     Column(col={"sm": 3}, controls=[self.trial_type]),
                     Column(col={"sm": 3}, controls=[self.num_odors]),
+                    Column(col={"sm": 3}, controls=[self.design]),
                 ]
             )
 
@@ -236,6 +337,24 @@ class SettingsLayout(UserControl):
                     Column(col={"sm": 3}, controls=[self.num_trials]),
                     Column(col={"sm": 3}, controls=[self.odor_duration]),
                     Column(col={"sm": 3}, controls=[self.time_btw_odors]),
+                    Column(col={"sm": 3}, controls=[self.seed]),
+                ]
+            )
+
+            self.row3 = ft.ResponsiveRow(
+                [
+                    Column(col={"sm": 3}, controls=[self.no_repeats]),
+                    Column(col={"sm": 3}, controls=[self.balanced_blocks]),
+                    Column(col={"sm": 3}, controls=[self.max_run]),
+                    Column(col={"sm": 3}, controls=[self.min_gap]),
+                ]
+            )
+
+            self.row4 = ft.ResponsiveRow(
+                [
+                    Column(col={"sm": 3}, controls=[self.iti_jitter]),
+                    Column(col={"sm": 3}, controls=[self.jitter_distribution]),
+                    Column(col={"sm": 3}, controls=[self.duration_series]),
                 ]
             )
 
@@ -245,6 +364,7 @@ class SettingsLayout(UserControl):
                     Column(col={"sm": 3}, controls=[self.panel_type]),
                     Column(col={"sm": 3}, controls=[self.trial_type]),
                     Column(col={"sm": 3}, controls=[self.specf_odors]),
+                    Column(col={"sm": 3}, controls=[self.design]),
                 ]
             )
 
@@ -253,6 +373,24 @@ class SettingsLayout(UserControl):
                     Column(col={"sm": 3}, controls=[self.num_trials]),
                     Column(col={"sm": 3}, controls=[self.odor_duration]),
                     Column(col={"sm": 3}, controls=[self.time_btw_odors]),
+                    Column(col={"sm": 3}, controls=[self.seed]),
+                ]
+            )
+
+            self.row3 = ft.ResponsiveRow(
+                [
+                    Column(col={"sm": 3}, controls=[self.no_repeats]),
+                    Column(col={"sm": 3}, controls=[self.balanced_blocks]),
+                    Column(col={"sm": 3}, controls=[self.max_run]),
+                    Column(col={"sm": 3}, controls=[self.min_gap]),
+                ]
+            )
+
+            self.row4 = ft.ResponsiveRow(
+                [
+                    Column(col={"sm": 3}, controls=[self.iti_jitter]),
+                    Column(col={"sm": 3}, controls=[self.jitter_distribution]),
+                    Column(col={"sm": 3}, controls=[self.duration_series]),
                 ]
             )
 
@@ -293,6 +431,15 @@ class SettingsLayout(UserControl):
         self.odor_duration.reset()
         self.time_btw_odors.reset()
         self.specf_odors.reset()
+        self.design.value = "Shuffled"
+        self.no_repeats.value = False
+        self.balanced_blocks.value = False
+        self.max_run.reset()
+        self.min_gap.reset()
+        self.seed.reset()
+        self.iti_jitter.reset()
+        self.jitter_distribution.value = JITTER_DISTRIBUTIONS[0]
+        self.duration_series.reset()
 
         self.arrange_settings_fields(e)
         self.disable_settings_fields(disable=False)
@@ -315,6 +462,15 @@ class SettingsLayout(UserControl):
         self.num_trials.disabled = disable
         self.odor_duration.disabled = disable
         self.time_btw_odors.disabled = disable
+        self.design.disabled = disable
+        self.no_repeats.disabled = disable
+        self.balanced_blocks.disabled = disable
+        self.max_run.disabled = disable
+        self.min_gap.disabled = disable
+        self.seed.disabled = disable
+        self.iti_jitter.disabled = disable
+        self.jitter_distribution.disabled = disable
+        self.duration_series.disabled = disable
 
         self.update()
 
@@ -323,5 +479,7 @@ class SettingsLayout(UserControl):
             controls=[
                 self.row1,
                 self.row2,
+                self.row3,
+                self.row4,
             ],
         )
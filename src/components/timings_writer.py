@@ -0,0 +1,178 @@
+"""Contains the TimingsWriter class to stream solenoid timings to a .csv file
+one trial at a time."""
+
+import csv
+import os
+from itertools import zip_longest
+
+
+def timings_columns(panel_type: str):
+    """Gets the column names of the solenoid timings csv.
+
+    Args:
+        panel_type: Whether odor panel is 1% or 10%.
+
+    Returns:
+        List of column names. The seeds the trials were shuffled and timed
+        with are repeated on every row, as in the solenoid order csv.
+    """
+
+    return [
+        "Trial",
+        f"Odor {panel_type}",
+        "Microscope Triggered",
+        "Solenoid opened",
+        "Solenoid closed",
+        "Seed",
+        "Timing seed",
+    ]
+
+
+class TimingsWriter:
+    """Appends one row per trial to a .csv file that stays open for the whole
+    session.
+
+    Every row is flushed as soon as it is written, so the file holds every
+    finished trial even if the app is killed, and each trial costs the same
+    however long the session runs.
+    """
+
+    def __init__(self, path: str, columns: list):
+        """Initializes the writer without creating the file yet.
+
+        Args:
+            path: Path of the .csv file.
+            columns: The column names written as the header.
+        """
+
+        #: str: Path of the .csv file
+        self.path = path
+
+        #: list: The column names written as the header
+        self.columns = columns
+
+        #: file: The open .csv file, or None until the first row
+        self.file = None
+
+        #: csv.writer: Writes rows to the open file
+        self.writer = None
+
+        #: int: Number of rows written so far, not counting the header
+        self.rows_written = 0
+
+    def open(self):
+        """Creates the file and writes the header."""
+
+        self.file = open(self.path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columns)
+        self.file.flush()
+
+    def write_row(self, row: list):
+        """Appends one row and flushes it to the operating system.
+
+        Args:
+            row: The values of the row, in the order of the columns.
+        """
+
+        if self.file is None:
+            self.open()
+
+        self.writer.writerow(row)
+        self.file.flush()
+        self.rows_written += 1
+
+    def rewrite(self, rows: list):
+        """Replaces every row of the file, e.g. once the final times are
+        known.
+
+        The rows are written to a temporary file that then replaces the old
+        one, so a crash leaves either the old or the new file complete.
+
+        Args:
+            rows: Every row of the file, in order.
+        """
+
+        self.close()
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", newline="") as temp_file:
+            writer = csv.writer(temp_file)
+            writer.writerow(self.columns)
+            writer.writerows(rows)
+        os.replace(temp_path, self.path)
+
+        self.file = open(self.path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        self.rows_written = len(rows)
+
+    def read_rows(self):
+        """Reads the rows already in the file.
+
+        Returns:
+            Dict of rows by trial number, skipping a row the app was killed
+            in the middle of writing if its trial number is cut off.
+        """
+
+        rows = {}
+
+        if not os.path.exists(self.path):
+            return rows
+
+        with open(self.path, newline="") as timings_file:
+            reader = csv.reader(timings_file)
+            next(reader, None)
+            for row in reader:
+                if row and row[0].isdigit():
+                    rows[int(row[0])] = row
+
+        return rows
+
+    def merge(self, rows: list):
+        """Adds rows, e.g. recovered from a session journal, without dropping
+        or changing any time already in the file.
+
+        Rows of trials the file already has only fill in the times it is
+        missing.
+
+        Args:
+            rows: The rows to add, in the order of the columns.
+
+        Returns:
+            Number of rows added or filled in.
+        """
+
+        merged = self.read_rows()
+        changed = 0
+
+        for row in rows:
+            row = ["" if value is None else str(value) for value in row]
+            old_row = merged.get(int(row[0]))
+
+            if old_row is None:
+                new_row = row
+            else:
+                new_row = [
+                    old_value or new_value
+                    for old_value, new_value in zip_longest(
+                        old_row, row, fillvalue=""
+                    )
+                ]
+
+            if new_row != old_row:
+                merged[int(row[0])] = new_row
+                changed += 1
+
+        if changed:
+            self.rewrite([merged[trial] for trial in sorted(merged)])
+            self.close()
+
+        return changed
+
+    def close(self):
+        """Closes the file."""
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.writer = None
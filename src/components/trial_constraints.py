@@ -0,0 +1,405 @@
+"""Contains the TrialConstraints class and constrained_order function to
+shuffle trials so that odors don't repeat or cluster more than the
+experiment allows.
+
+Orders are shuffled by a numpy Generator seeded with a seed that is saved
+with the session, so trials_from_settings gives back a past session's order
+from its settings alone, and schedule_from_settings its timings too.
+"""
+
+from collections import Counter
+
+import numpy as np
+
+from components.counterbalance import counterbalanced_trials
+from components.trial_schedule import TrialSchedule, TrialTimings, timing_rng
+
+#: int: Most dead ends the search backs out of before giving up
+MAX_BACKTRACKS = 100000
+
+
+class TrialConstraints:
+    """Constraints on how the odors of a shuffled trial order may follow each
+    other."""
+
+    def __init__(
+        self,
+        no_repeats: bool = False,
+        max_run: int = None,
+        min_gap: int = 0,
+        balanced_blocks: bool = False,
+    ):
+        """Initializes an instance of the TrialConstraints class.
+
+        Args:
+            no_repeats: Whether the same odor may not be delivered twice in a
+                row.
+            max_run: Most trials in a row with the same odor, or None for no
+                limit.
+            min_gap: Fewest other trials between two trials with the same
+                odor.
+            balanced_blocks: Whether every odor is delivered once in each
+                block of trials, so each odor is spread over the session.
+        """
+
+        #: bool: Whether the same odor may not be delivered twice in a row
+        self.no_repeats = no_repeats
+
+        #: int: Most trials in a row with the same odor, or None for no limit
+        self.max_run = max_run
+
+        #: int: Fewest other trials between two trials with the same odor
+        self.min_gap = min_gap
+
+        #: bool: Whether every odor is delivered once in each block of trials
+        self.balanced_blocks = balanced_blocks
+
+    @property
+    def gap(self):
+        """int: Fewest other trials between two trials with the same odor,
+        counting no_repeats and a max_run of 1 as a gap of 1."""
+
+        if self.no_repeats or self.max_run == 1:
+            return max(self.min_gap, 1)
+
+        return self.min_gap
+
+    def check(self, trials: list):
+        """Checks that some order of the trials can meet the constraints.
+
+        Args:
+            trials: The odor of each trial, in any order.
+
+        Raises:
+            ValueError: The constraints can't be met, with the reason.
+        """
+
+        if self.max_run is not None and self.max_run < 1:
+            raise ValueError("The longest run of an odor must be at least 1 trial")
+        if self.min_gap < 0:
+            raise ValueError("The gap between repeats can't be negative")
+
+        counts = Counter(trials)
+        if not counts:
+            return
+
+        num_trials = len(trials)
+        odor, most = counts.most_common(1)[0]
+        gap = self.gap
+
+        if self.balanced_blocks and len(set(counts.values())) > 1:
+            raise ValueError(
+                "Balanced blocks need every odor to be delivered the same "
+                "number of times"
+            )
+
+        # Odors delivered the most times fill the first and last slots of
+        # every stretch of gap + 1 trials
+        tied = sum(1 for count in counts.values() if count == most)
+        needed = (most - 1) * (gap + 1) + min(tied, gap + 1)
+        if needed > num_trials:
+            raise ValueError(
+                f"Odor {odor} is delivered {most} times, which needs at least "
+                f"{needed} trials to space its repeats {gap + 1} trials apart, "
+                f"but there are {num_trials}"
+            )
+
+        if self.max_run is not None and most > self.max_run * (
+            num_trials - most + 1
+        ):
+            raise ValueError(
+                f"Odor {odor} is delivered {most} times, too many to break into "
+                f"runs of at most {self.max_run} with the other "
+                f"{num_trials - most} trials"
+            )
+
+    def is_met(self, order: list):
+        """Returns whether a trial order meets the constraints."""
+
+        gap = self.gap
+        last = {}
+        run = 0
+
+        for position, odor in enumerate(order):
+            if odor in last and position - last[odor] <= gap:
+                return False
+
+            run = run + 1 if position and order[position - 1] == odor else 1
+            if self.max_run is not None and run > self.max_run:
+                return False
+
+            last[odor] = position
+
+        if self.balanced_blocks:
+            block_size = len(set(order))
+            for start in range(0, len(order), block_size):
+                block = order[start : start + block_size]
+                if len(set(block)) != len(block):
+                    return False
+
+        return True
+
+
+def new_seed():
+    """Draws a seed for a trial order from the operating system's entropy.
+
+    Returns:
+        The seed, short enough to read off the app and type back in.
+    """
+
+    return int(np.random.SeedSequence().generate_state(1)[0])
+
+
+def seeded_rng(seed: int):
+    """Gets the generator that shuffles a trial order.
+
+    Args:
+        seed: The order's seed.
+
+    Returns:
+        numpy Generator using PCG64.
+    """
+
+    return np.random.Generator(np.random.PCG64(seed))
+
+
+def constrained_order(
+    trials: list, constraints: TrialConstraints = None, rng: np.random.Generator = None
+):
+    """Shuffles trials so that the order meets the constraints.
+
+    Without a gap between repeats or a longest run, the trials, or each
+    block of them, are permuted by numpy in one call. Otherwise the order
+    is built one trial at a time. Each position draws from the odors the
+    constraints allow there, weighted by how many trials each has left, so
+    without constraints every order is equally likely. The draws only
+    depend on which odors the trials have, not on their order, so the same
+    seed always gives the same order. An odor that has to go at a position
+    to fit its remaining repeats into the session is placed there, and when
+    no odor fits the search backs out of its last choices.
+
+    Args:
+        trials: The odor of each trial, in any order.
+        constraints: The constraints to meet, or None to only shuffle.
+        rng: Generator to draw with, or None for an unseeded one.
+
+    Returns:
+        The shuffled odor of each trial, as a new list.
+
+    Raises:
+        ValueError: The constraints can't be met, or no order meeting them
+            was found within MAX_BACKTRACKS dead ends.
+    """
+
+    if constraints is None:
+        constraints = TrialConstraints()
+    if rng is None:
+        rng = np.random.default_rng()
+    constraints.check(trials)
+
+    counts = Counter(trials)
+    odors = sorted(counts)
+    num_trials = len(trials)
+    gap = constraints.gap
+    # With a gap, runs are never longer than 1 trial anyway
+    max_run = constraints.max_run if gap == 0 else None
+    block_size = len(odors) if constraints.balanced_blocks else num_trials
+
+    # Blocks can only put two trials of an odor in a row, at their edges
+    if gap == 0 and (
+        constraints.max_run is None
+        or (constraints.balanced_blocks and constraints.max_run >= 2)
+    ):
+        if constraints.balanced_blocks:
+            blocks = np.tile(odors, (num_trials // block_size, 1))
+            return rng.permuted(blocks, axis=1).ravel().tolist()
+
+        return rng.permutation(np.sort(trials)).tolist()
+
+    # Number of trials left for each odor
+    remaining = dict(counts)
+    # Position of the last trial placed for each odor
+    last = {odor: -num_trials - gap - 1 for odor in odors}
+
+    def uniform_draws():
+        """Yields the generator's draws, taken from it in batches since one
+        draw at a time is slow."""
+
+        while True:
+            yield from rng.random(1024).tolist()
+
+    draws = uniform_draws()
+
+    def candidates(position: int):
+        """Gets the odors that can go at a position, in the order to try
+        them, last first."""
+
+        if constraints.balanced_blocks:
+            block_start = position - position % block_size
+            block_end = min(block_start + block_size, num_trials) - 1
+            in_block = set(order[block_start:position])
+
+        forced = None
+        allowed = []
+        for odor in odors:
+            left = remaining[odor]
+            if not left:
+                continue
+
+            # The latest position the odor's next trial can go and still fit
+            # its remaining trials into the session
+            if constraints.balanced_blocks:
+                if odor in in_block:
+                    continue
+                deadline = block_end
+            else:
+                deadline = num_trials - 1 - (left - 1) * (gap + 1)
+
+            earliest = max(position, last[odor] + gap + 1)
+            if earliest > deadline:
+                return []
+            if deadline == position:
+                if forced is not None:
+                    return []
+                forced = odor
+            if earliest == position:
+                allowed.append(odor)
+
+        if max_run is not None and position >= max_run:
+            previous = order[position - max_run : position]
+            if len(set(previous)) == 1:
+                allowed = [odor for odor in allowed if odor != previous[0]]
+
+            # The odor with the most trials left has to be broken up by the
+            # others
+            most = max(remaining.values())
+            if most > max_run * (num_trials - position - most + 1):
+                return []
+
+        if forced is not None:
+            return [forced] if forced in allowed else []
+
+        # Weighted sampling without replacement, largest key tried first
+        keys = {odor: next(draws) ** (1 / remaining[odor]) for odor in allowed}
+        return sorted(allowed, key=keys.get)
+
+    order = []
+    # Previous last position of each odor placed, to undo its placement
+    previous_last = []
+    # Odors left to try at each position placed so far and the next one
+    to_try = []
+    backtracks = 0
+
+    while len(order) < num_trials:
+        position = len(order)
+        if len(to_try) == position:
+            to_try.append(candidates(position))
+
+        if to_try[position]:
+            odor = to_try[position].pop()
+            order.append(odor)
+            previous_last.append(last[odor])
+            last[odor] = position
+            remaining[odor] -= 1
+            continue
+
+        # Dead end, so back out of the last choice
+        to_try.pop()
+        if not order:
+            raise ValueError("No trial order meets the constraints")
+
+        backtracks += 1
+        if backtracks > MAX_BACKTRACKS:
+            raise ValueError(
+                f"Could not find a trial order meeting the constraints within "
+                f"{MAX_BACKTRACKS} tries, try loosening them"
+            )
+
+        odor = order.pop()
+        last[odor] = previous_last.pop()
+        remaining[odor] += 1
+
+    return order
+
+
+def trials_from_settings(settings: dict):
+    """Rebuilds a session's trial order from its saved settings, as
+    TrialOrderTable ordered it.
+
+    Args:
+        settings: All experiment settings entered from settings fields, as
+            saved in the experiment index or the session archive.
+
+    Returns:
+        The odor of each trial.
+
+    Raises:
+        ValueError: The session resumed the remaining trials of another one,
+            so its order can't be rebuilt from its settings.
+    """
+
+    if settings.get("resumed_from") is not None:
+        raise ValueError(
+            f"The session resumed session {settings['resumed_from']} from "
+            f"trial {settings['resumed_first_trial']}, so its order is only "
+            "in its solenoid order csv"
+        )
+
+    if settings["trial_type"] == "Single":
+        return [settings["single_odor"]]
+
+    if settings["trial_type"] == "Multiple":
+        odors = list(range(1, settings["num_odors"] + 1))
+    else:
+        odors = settings["specific_odors"]
+
+    if settings.get("design") is not None:
+        return counterbalanced_trials(
+            odors, settings["num_trials"], settings["design"], settings["design_row"]
+        )
+
+    trials = odors * settings["num_trials"]
+    if settings.get("seed") is None:
+        return trials
+
+    constraints = TrialConstraints(
+        no_repeats=settings.get("no_repeats", False),
+        max_run=settings.get("max_run"),
+        min_gap=settings.get("min_gap", 0),
+        balanced_blocks=settings.get("balanced_blocks", False),
+    )
+
+    return constrained_order(trials, constraints, seeded_rng(settings["seed"]))
+
+
+def schedule_from_settings(settings: dict):
+    """Rebuilds a session's trial order and the timing of each trial from its
+    saved settings, as TrialOrderTable timed them.
+
+    Args:
+        settings: All experiment settings entered from settings fields, as
+            saved in the experiment index or the session archive.
+
+    Returns:
+        The TrialSchedule, untimed if the settings are from before trials
+        were timed one by one or their jitter has no saved seed.
+
+    Raises:
+        ValueError: The session resumed the remaining trials of another one.
+    """
+
+    schedule = TrialSchedule(trials_from_settings(settings))
+
+    timings = TrialTimings(
+        settings["odor_duration"],
+        settings["time_btw_odors"],
+        iti_jitter=settings.get("iti_jitter", 0),
+        jitter_distribution=settings.get("jitter_distribution", "Uniform"),
+        duration_series=settings.get("odor_duration_series"),
+    )
+    timing_seed = settings.get("timing_seed")
+
+    if "iti_jitter" not in settings or (timings.iti_jitter and timing_seed is None):
+        return schedule
+
+    return timings.apply(schedule, timing_rng(timing_seed))
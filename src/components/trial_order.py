@@ -9,11 +9,17 @@ from flet import (
     Text,
 )
 
-from simpledt import DataFrame
-import pandas as pd
-import random
 import pdb
 
+from components.counterbalance import counterbalanced_trials
+from components.trial_constraints import (
+    TrialConstraints,
+    constrained_order,
+    new_seed,
+    seeded_rng,
+)
+from components.trial_schedule import TrialSchedule, TrialTimings, timing_rng
+
 
 class TrialOrderTable(UserControl):
     """Generates trial order based on experiment settings and displays the
@@ -27,7 +33,12 @@ class TrialOrderTable(UserControl):
         randomize: bool,
         num_trials: int,
         num_odors: int,
-        specf_odors: str
+        specf_odors: str,
+        constraints: TrialConstraints = None,
+        design: str = None,
+        design_row: int = 0,
+        seed: int = None,
+        timings: TrialTimings = None,
         # reset: bool,
     ):
         """Initializes an instance of the TrialOrderTable class.
@@ -40,7 +51,20 @@ class TrialOrderTable(UserControl):
             num_trials: Number of trials to run per odor.
             num_odors: Number of odors to deliver.
             specf_odors: Numbers of specific odors to deliver.
+            constraints: Constraints the shuffled order has to meet, or None
+                to only shuffle.
+            design: Latin square or Williams design to order trials by
+                instead of shuffling them, or None.
+            design_row: The row of the design the session starts at.
+            seed: Seed to shuffle trials with, to repeat a past session's
+                order, or None for a new one.
+            timings: How long each trial's odor and time between odors last,
+                or None to leave the trials untimed.
             reset:
+
+        Raises:
+            ValueError: The trials can't be shuffled to meet the constraints,
+                or the timings can't be kept by the arduino.
         """
 
         super().__init__()
@@ -72,77 +96,166 @@ class TrialOrderTable(UserControl):
         #: list: Numbers of specific odors to deliver, int in a list
         self.specf_odors = specf_odors
 
+        #: TrialConstraints: Constraints the shuffled order has to meet
+        self.constraints = constraints
+
+        #: str: Latin square or Williams design to order trials by, or None
+        self.design = design
+
+        #: int: The row of the design the session starts at
+        self.design_row = design_row
+
+        #: int: Seed the trials were shuffled with, or None if they weren't
+        self.seed = None
+
+        #: TrialTimings: How long each trial's odor and time between odors
+        # last, or None
+        self.timings = timings
+
+        #: int: Seed the times between odors were jittered with, or None if
+        # the trials aren't timed
+        self.timing_seed = None
+
         # if self.num_trials != "" and self.num_odors != "":
         self.make_nonrandom_trials()
 
-        if self.trial_type != "Single":
+        if self.trial_type != "Single" and self.design is not None:
+            self.make_design_trials()
+
+        elif self.trial_type != "Single":
             if self.num_trials is not None:
                 if self.trial_type == "Multiple" and self.num_odors is not None:
                     if self.randomize is True:
-                        self.randomize_trials(repeat=False)
+                        self.randomize_trials(repeat=False, seed=seed)
 
                 if (
                     self.trial_type == "Limited Multiple"
                     and self.specf_odors is not None
                 ):
                     if self.randomize is True:
-                        self.randomize_trials(repeat=False)
+                        self.randomize_trials(repeat=False, seed=seed)
+
+        if self.seed is None:
+            self.time_trials(seed)
 
-        self.make_trials_df()
         self.display_trial_order()
 
+    @property
+    def trials(self):
+        """list: The entire sequence of odors for every trial."""
+
+        return self.schedule.tolist()
+
+    @trials.setter
+    def trials(self, trials: list):
+        self.schedule = TrialSchedule(trials)
+
     def make_nonrandom_trials(self):
         """Generates trial odor order for non-shuffled experiments."""
 
         if self.trial_type == "Single":
-            #: list: The entire sequence of odors for every trial.
-            self.trials = [self.single_odor]
+            #: TrialSchedule: The odor of every trial, in order
+            self.schedule = TrialSchedule([self.single_odor])
         elif self.trial_type == "Multiple":
-            self.trials = list(range(1, self.num_odors + 1)) * self.num_trials
+            self.schedule = TrialSchedule.repeated(
+                range(1, self.num_odors + 1), self.num_trials
+            )
         elif self.trial_type == "Limited Multiple":
-            self.trials = self.specf_odors * self.num_trials
+            self.schedule = TrialSchedule.repeated(self.specf_odors, self.num_trials)
 
         self.update()
 
-    def randomize_trials(self, repeat: bool, e=None):
-        """Randomizes trials.
+    def make_design_trials(self):
+        """Generates trial odor order from the session's rows of the design,
+        one block of every odor per trial."""
+
+        if self.trial_type == "Multiple":
+            odors = list(range(1, self.num_odors + 1))
+        else:
+            odors = self.specf_odors
+
+        self.schedule = TrialSchedule(
+            counterbalanced_trials(odors, self.num_trials, self.design, self.design_row)
+        )
+
+        self.update()
+
+    def randomize_trials(self, repeat: bool, e=None, seed: int = None):
+        """Randomizes trials so that their order meets the constraints.
 
         Args:
             repeat: Whether this is a repeat from pressing Randomize Again.
             e (event): on_click event from pressing Randomize Again.
+            seed: Seed to shuffle with, or None for a new one.
+
+        Raises:
+            ValueError: The trials can't be shuffled to meet the constraints.
         """
 
-        random.shuffle(self.trials)
+        self.seed = seed if seed is not None else new_seed()
+        self.schedule = TrialSchedule(
+            constrained_order(self.trials, self.constraints, seeded_rng(self.seed))
+        )
+        self.time_trials(self.seed)
 
         if repeat is True:
-            self.make_trials_df()
             self.display_trial_order()
             print("randomize_trials repeat called")
 
         self.update()
 
-    def make_trials_df(self):
-        """Puts odor trials into a DataFrame."""
+    def time_trials(self, seed: int = None):
+        """Sets each trial's odor duration and time between odors.
 
-        #: pd.DataFrame: Trials in a DataFrame.
-        self.trials_df = pd.DataFrame(self.trials)
-        self.trials_df.rename(index=lambda s: s + 1, inplace=True)
+        Args:
+            seed: Seed to jitter the times between odors with, or None for a
+                new one.
+
+        Raises:
+            ValueError: The timings can't be kept by the arduino.
+        """
+
+        if self.timings is None:
+            return
+
+        self.timing_seed = seed if seed is not None else new_seed()
+        self.schedule = self.timings.apply(self.schedule, timing_rng(self.timing_seed))
 
     def display_trial_order(self):
         """Displays the trial order in a table.
 
-        Using simpledt package fixes the page.add(DataTable) issue
+        The table is built from the schedule the way the simpledt package
+        builds it, which fixes the page.add(DataTable) issue
         https://github.com/StanMathers/simple-datatable
         """
 
-        simplet_df = DataFrame(self.trials_df.T)  # simpledt class
-
-        #: simpledt.DataFrame: Displays trials_df correctly on app
-        self.simple_dt = simplet_df.datatable
-
-        # Add Trial/Odor labels to table
-        self.simple_dt.columns.insert(0, ft.DataColumn(ft.Text("Trial")))
-        self.simple_dt.rows[0].cells.insert(0, ft.DataCell(content=Text("Odor")))
+        rows = [("Odor", self.trials)]
+
+        # Timings are only shown when they differ between trials
+        if self.schedule.is_timed():
+            for label, values in [
+                ("Odor (s)", self.schedule.odor_ms),
+                ("Next (s)", self.schedule.btw_ms),
+            ]:
+                if (values != values[0]).any():
+                    rows.append((label, (values / 1000).tolist()))
+
+        #: ft.DataTable: One column per trial with its odor, and its timings
+        # if they vary
+        self.simple_dt = ft.DataTable(
+            columns=[ft.DataColumn(Text("Trial"))]
+            + [
+                ft.DataColumn(Text(trial))
+                for trial in self.schedule.trial_numbers.tolist()
+            ],
+            rows=[
+                ft.DataRow(
+                    [ft.DataCell(content=Text(label))]
+                    + [ft.DataCell(Text(value)) for value in values]
+                )
+                for label, values in rows
+            ],
+        )
 
         self.simple_dt.column_spacing = 20
         self.simple_dt.heading_row_height = 25
@@ -161,6 +274,16 @@ class TrialOrderTable(UserControl):
             controls=[self.simple_dt], scroll="always"
         )
 
+        seed_texts = [
+            Text(f"{label}: {seed}", selectable=True)
+            for label, seed in [("Seed", self.seed), ("Timing seed", self.timing_seed)]
+            if seed is not None
+        ]
+        if seed_texts:
+            self.exp_display_content.content = ft.Column(
+                controls=[self.exp_display_content.content] + seed_texts
+            )
+
         self.update()
 
     def build(self):
@@ -0,0 +1,297 @@
+"""Contains the TrialSchedule class to hold a session's trial order and the
+timing of each trial as numpy arrays, and the TrialTimings class to work
+out that timing from the settings."""
+
+import numpy as np
+import pandas as pd
+
+from components.protocol import BASELINE_MS, TRIGGER_PULSE_MS, TRIGGER_TIME_MS
+
+#: int: Shortest time between odors in ms, which arduino_sketch needs for the
+# microscope trigger pulse, the baseline and the time set aside for the next
+# trigger
+MIN_BTW_MS = TRIGGER_PULSE_MS + BASELINE_MS + TRIGGER_TIME_MS
+
+#: list: Distributions the time between odors can be jittered with
+JITTER_DISTRIBUTIONS = ["Uniform", "Exponential"]
+
+#: int: Largest exponential jitter drawn, in multiples of the jitter
+MAX_EXPONENTIAL_JITTERS = 5
+
+
+class TrialSchedule:
+    """The odor of every trial in the order they are delivered, and once the
+    schedule is timed, each trial's odor duration and time between odors.
+
+    Trials are numbered from 1. Building and shuffling a schedule are numpy
+    operations on small arrays, and the order sorted by odor is an index
+    array, so pandas is only needed to export it.
+    """
+
+    def __init__(self, odors, odor_ms=None, btw_ms=None):
+        """Initializes a schedule from the odor of each trial.
+
+        Args:
+            odors: The odor of each trial, e.g. a list or numpy array.
+            odor_ms: Odor duration of each trial in ms, or None if the
+                schedule isn't timed yet.
+            btw_ms: Time between odors of each trial in ms, or None if the
+                schedule isn't timed yet.
+        """
+
+        #: np.ndarray: The odor of each trial, in delivery order
+        self.odors = np.asarray(odors, dtype=np.int16).reshape(-1)
+
+        #: np.ndarray: Odor duration of each trial in ms, or None
+        self.odor_ms = None
+
+        #: np.ndarray: Time between odors of each trial in ms, or None
+        self.btw_ms = None
+
+        if odor_ms is not None and btw_ms is not None:
+            self.odor_ms = np.broadcast_to(
+                np.asarray(odor_ms, dtype=np.uint32), self.odors.shape
+            ).copy()
+            self.btw_ms = np.broadcast_to(
+                np.asarray(btw_ms, dtype=np.uint32), self.odors.shape
+            ).copy()
+
+    @classmethod
+    def repeated(cls, odor_set: list, num_trials: int):
+        """Builds the unshuffled schedule that delivers every odor in turn.
+
+        Args:
+            odor_set: The odors to deliver, in order.
+            num_trials: Number of times to deliver each odor.
+
+        Returns:
+            The TrialSchedule.
+        """
+
+        return cls(np.tile(np.asarray(odor_set, dtype=np.int16), num_trials))
+
+    def __len__(self):
+        return len(self.odors)
+
+    @property
+    def trial_numbers(self):
+        """np.ndarray: The number of each trial, counting from 1."""
+
+        return np.arange(1, len(self.odors) + 1)
+
+    def tolist(self):
+        """Returns the odor of each trial as a list of ints."""
+
+        return self.odors.tolist()
+
+    def is_timed(self):
+        """Returns whether each trial's odor duration and time between odors
+        are set."""
+
+        return self.odor_ms is not None
+
+    def occurrences(self):
+        """Gets how many trials of the same odor come before each trial.
+
+        Returns:
+            int array, 0 for the first trial of each odor.
+        """
+
+        order = self.by_odor()
+        sorted_odors = self.odors[order]
+
+        # Index in the sorted order where each trial's odor starts
+        new_odor = np.concatenate([[True], sorted_odors[1:] != sorted_odors[:-1]])
+        group_starts = np.maximum.accumulate(
+            np.where(new_odor, np.arange(len(order)), 0)
+        )
+
+        occurrences = np.empty(len(order), dtype=np.int64)
+        occurrences[order] = np.arange(len(order)) - group_starts
+
+        return occurrences
+
+    def by_odor(self):
+        """Gets the order of the trials sorted by odor, with the trials of
+        each odor in delivery order.
+
+        Returns:
+            Indices into odors and trial_numbers.
+        """
+
+        return np.argsort(self.odors, kind="stable")
+
+    def to_dataframe(
+        self, panel_type: str, seed: int = None, timing_seed: int = None
+    ):
+        """Gets the schedule in the layout of the solenoid order csv, sorted
+        by odor.
+
+        Args:
+            panel_type: Whether odor panel is 1% or 10%.
+            seed: Seed the trials were shuffled with, or None.
+            timing_seed: Seed the trials were timed with, or None.
+
+        Returns:
+            DataFrame with one row per trial, with each trial's odor duration
+            and time between odors once the schedule is timed.
+        """
+
+        order = self.by_odor()
+
+        columns = {
+            f"Odor {panel_type}": self.odors[order],
+            "Trial": self.trial_numbers[order],
+            "Seed": seed,
+            "Timing seed": timing_seed,
+        }
+        if self.is_timed():
+            columns["Odor duration (ms)"] = self.odor_ms[order]
+            columns["Time btw odors (ms)"] = self.btw_ms[order]
+
+        return pd.DataFrame(columns)
+
+
+def timing_rng(seed: int):
+    """Gets the generator that jitters a trial order's times between odors.
+
+    Its stream is spawned from the seed apart from the one that shuffles the
+    order, so the same seed can shuffle and jitter a session.
+
+    Args:
+        seed: The order's seed.
+
+    Returns:
+        numpy Generator using PCG64.
+    """
+
+    return np.random.Generator(
+        np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(1,)))
+    )
+
+
+class TrialTimings:
+    """How long each trial's odor is delivered and how long until the next
+    trial starts.
+
+    The time between odors can be jittered around its setting, e.g. so that
+    responses to consecutive odors can be told apart by deconvolution. The
+    odor duration can step through a series, each odor taking the next
+    duration of the series every time it is delivered, as a concentration
+    series.
+    """
+
+    def __init__(
+        self,
+        odor_duration: float,
+        time_btw_odors: float,
+        iti_jitter: float = 0,
+        jitter_distribution: str = "Uniform",
+        duration_series: list = None,
+    ):
+        """Initializes an instance of the TrialTimings class.
+
+        Args:
+            odor_duration: Odor duration in s.
+            time_btw_odors: Mean time between odors in s.
+            iti_jitter: Largest uniform jitter of the time between odors in s,
+                or the mean of the exponential jitter above its shortest
+                value. 0 for no jitter.
+            jitter_distribution: "Uniform" or "Exponential".
+            duration_series: Odor durations in s each odor steps through, or
+                None to always use odor_duration.
+        """
+
+        #: float: Odor duration in s
+        self.odor_duration = odor_duration
+
+        #: float: Mean time between odors in s
+        self.time_btw_odors = time_btw_odors
+
+        #: float: Jitter of the time between odors in s
+        self.iti_jitter = iti_jitter
+
+        #: str: "Uniform" or "Exponential"
+        self.jitter_distribution = jitter_distribution
+
+        #: list: Odor durations in s each odor steps through, or None
+        self.duration_series = duration_series
+
+    def odor_ms(self, schedule: TrialSchedule):
+        """Gets the odor duration of each trial.
+
+        Args:
+            schedule: The trial order.
+
+        Returns:
+            Odor duration of each trial in ms.
+        """
+
+        if not self.duration_series:
+            return np.full(len(schedule), round(self.odor_duration * 1000))
+
+        series_ms = np.round(np.asarray(self.duration_series) * 1000).astype(np.int64)
+
+        return series_ms[schedule.occurrences() % len(series_ms)]
+
+    def btw_ms(self, num_trials: int, rng: np.random.Generator):
+        """Draws the time between odors of each trial.
+
+        Uniform jitter is drawn from time_btw_odors +/- iti_jitter. Exponential
+        jitter starts iti_jitter below time_btw_odors and has a mean of
+        iti_jitter above that, so the mean stays near time_btw_odors, and is
+        capped at MAX_EXPONENTIAL_JITTERS times iti_jitter.
+
+        Args:
+            num_trials: Number of trials.
+            rng: Generator to draw the jitter with.
+
+        Returns:
+            Time between odors of each trial in ms.
+
+        Raises:
+            ValueError: The jitter could make times between odors too short
+                for arduino_sketch.
+        """
+
+        # Both distributions reach down to iti_jitter below the mean
+        if round((self.time_btw_odors - self.iti_jitter) * 1000) < MIN_BTW_MS:
+            raise ValueError(
+                f"The time between odors has to stay above {MIN_BTW_MS} ms, "
+                "so lower the jitter or raise the time between odors"
+            )
+
+        btw_ms = np.full(num_trials, self.time_btw_odors * 1000.0)
+
+        if self.iti_jitter:
+            jitter_ms = self.iti_jitter * 1000.0
+            if self.jitter_distribution == "Uniform":
+                btw_ms += rng.uniform(-jitter_ms, jitter_ms, num_trials)
+            elif self.jitter_distribution == "Exponential":
+                btw_ms += np.minimum(
+                    rng.exponential(jitter_ms, num_trials),
+                    MAX_EXPONENTIAL_JITTERS * jitter_ms,
+                ) - jitter_ms
+            else:
+                raise ValueError(
+                    f"No jitter distribution called {self.jitter_distribution}"
+                )
+
+        return np.round(btw_ms).astype(np.int64)
+
+    def apply(self, schedule: TrialSchedule, rng: np.random.Generator):
+        """Times every trial of a schedule.
+
+        Args:
+            schedule: The trial order.
+            rng: Generator to draw the jitter with.
+
+        Returns:
+            New TrialSchedule with the same order and each trial's timing.
+        """
+
+        return TrialSchedule(
+            schedule.odors,
+            self.odor_ms(schedule),
+            self.btw_ms(len(schedule), rng),
+        )
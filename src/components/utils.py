@@ -13,3 +13,23 @@ def resolve_path(path):
         resolved_path = os.path.abspath(os.path.join(os.getcwd(), path))
 
     return resolved_path
+
+
+def parse_folder_name(folder: str):
+    """Parses an experiment folder name of the form YYMMDD--animal_ROIX.
+
+    Args:
+        folder: Name of the experiment folder, e.g. "231116--123456-7-8_ROI1".
+
+    Returns:
+        The date, animal ID and ROI of the experiment.
+
+    Raises:
+        IndexError: The folder name doesn't follow the convention.
+    """
+
+    date = folder.split("--")[0]
+    animal_id = folder.split("--")[1].split("_")[0]
+    roi = folder.split("_")[1]
+
+    return date, animal_id, roi
@@ -0,0 +1,422 @@
+"""Contains the VirtualArduino class, a Python stand-in for arduino_sketch that
+ArduinoSession can talk to over a pseudo-terminal.
+
+Run it on its own to get a port for the app:
+
+    python -m components.virtual_arduino --speed 100
+
+Pseudo-terminals only exist on Linux and macOS, so the virtual arduino can't
+replace COM7/COM8 on the lab's Windows machine.
+"""
+
+import argparse
+import os
+import pty
+import select
+import struct
+import time
+import tty
+from threading import Thread, Event
+
+from components.protocol import (
+    BASELINE_MS,
+    FIRMWARE_VERSION,
+    MAX_SEQUENCE_TRIALS,
+    TRIAL_FORMAT,
+    TRIGGER_PULSE_MS,
+    FrameParser,
+    delay_after_odor_ms,
+    encode_frame,
+)
+
+
+class VirtualArduino(Thread):
+    """Emulates arduino_sketch: answers hellos and pings, negotiates the baud
+    rate, queues and runs trials, and reports "9", "1", "2" and "3" events
+    timestamped with its own millis().
+
+    Time can run faster than real time, so a full session of long trials
+    finishes in seconds. The host's clock sync then sees the speed-up as
+    clock drift.
+    """
+
+    def __init__(
+        self,
+        speed: float = 1.0,
+        trigger_delay: float = 0.0,
+        max_baud_rate: int = 1000000,
+    ):
+        """Opens a pseudo-terminal for ArduinoSession to connect to.
+
+        Args:
+            speed: How many times faster than real time the arduino's clock
+                runs.
+            trigger_delay: How long in s of arduino time the microscope takes
+                to send its trigger once a trial is waiting for it, or None to
+                wait for set_ttl to be called.
+            max_baud_rate: Fastest baud rate the emulated link accepts, to
+                test the fallback in the baud rate negotiation.
+        """
+
+        super().__init__(daemon=True)
+
+        #: float: How many times faster than real time the clock runs
+        self.speed = speed
+
+        #: float: Arduino time in s before the microscope trigger arrives
+        self.trigger_delay = trigger_delay
+
+        #: int: Fastest baud rate the emulated link accepts
+        self.max_baud_rate = max_baud_rate
+
+        #: float: Host monotonic time in s when the arduino's millis() was 0
+        self.start_time = time.monotonic()
+
+        #: int: File descriptor of the arduino's end of the pseudo-terminal
+        self.fd, port_fd = pty.openpty()
+
+        #: int: File descriptor of the host's end, kept open so the port
+        # exists until the emulator stops, or None once it has
+        self.port_fd = port_fd
+
+        tty.setraw(self.fd)
+        tty.setraw(self.port_fd)
+
+        # A full buffer after the host disconnects must not block the
+        # emulator
+        os.set_blocking(self.fd, False)
+
+        #: str: Path of the port for ArduinoSession to open
+        self.port = os.ttyname(self.port_fd)
+
+        #: Event: Event to stop the emulator
+        self.stop_running = Event()
+
+        #: Event: The simulated TTL input from the microscope
+        self.ttl_input = Event()
+
+        #: FrameParser: Splits bytes from the host into frames
+        self.parser = FrameParser()
+
+        #: int: Sequence number of the next frame sent to the host
+        self.tx_seq = 0
+
+        #: int: Seq of the last command, to ignore resent duplicates
+        self.last_rx_seq = None
+
+        #: int: Baud rate the host last switched to
+        self.baud_rate = 9600
+
+        #: int: Arduino time in ms allowed for silence before a keepalive, set
+        # by the host's hello
+        self.keepalive_interval = 0
+
+        #: int: The arduino's millis() when the last frame was sent
+        self.last_send_millis = 0
+
+        #: int: Number of trials completed since the emulator started
+        self.trials_completed = 0
+
+        #: list: Trials sent with "T" waiting to run, as (solenoid, odor ms,
+        # delay ms)
+        self.trial_queue = []
+
+        #: int: Number of trials the queue holds, as in arduino_sketch
+        self.queue_size = 4
+
+        #: list: Trials of a sequence upload, in the same layout
+        self.schedule = []
+
+        #: int: Number of trials the host says the sequence upload holds
+        self.expected_trials = 0
+
+        #: int: Largest number of trials in an uploaded sequence
+        self.max_trials = MAX_SEQUENCE_TRIALS
+
+        #: int: Number of frames written to the host, by message type
+        self.frames_sent = {}
+
+    def millis(self):
+        """Returns the arduino's clock in ms since the emulator started."""
+
+        return int((time.monotonic() - self.start_time) * 1000 * self.speed)
+
+    def set_ttl(self, high: bool = True):
+        """Sets the simulated microscope trigger input.
+
+        Args:
+            high: Whether the microscope is sending its trigger.
+        """
+
+        if high:
+            self.ttl_input.set()
+        else:
+            self.ttl_input.clear()
+
+    def send_frame(self, msg_type: str, payload: bytes = b""):
+        """Sends one frame to the host.
+
+        Args:
+            msg_type: The single character message type.
+            payload: The message contents.
+        """
+
+        try:
+            os.write(self.fd, encode_frame(msg_type, self.tx_seq, payload))
+        except OSError:
+            # Nobody is reading the port, so the frame is lost as it would be
+            # on a real serial line
+            pass
+
+        self.tx_seq = (self.tx_seq + 1) & 0xFF
+        self.last_send_millis = self.millis()
+        self.frames_sent[msg_type] = self.frames_sent.get(msg_type, 0) + 1
+
+    def send_event(self, msg_type: str):
+        """Sends an event with the arduino's millis().
+
+        Args:
+            msg_type: The event type, "9", "1", "2" or "3".
+        """
+
+        self.send_frame(msg_type, struct.pack("<I", self.millis()))
+
+    def send_status(self):
+        """Sends the number of trials completed."""
+
+        self.send_frame("y", struct.pack("<H", self.trials_completed & 0xFFFF))
+
+    def keep_alive(self):
+        """Sends a status message if nothing has been sent for the keepalive
+        interval."""
+
+        if (
+            self.keepalive_interval
+            and self.millis() - self.last_send_millis >= self.keepalive_interval
+        ):
+            self.send_status()
+
+    def read_trial(self, data: bytes):
+        """Converts a trial from a "T" or "Q" payload as arduino_sketch does.
+
+        Args:
+            data: The trial in TRIAL_FORMAT.
+
+        Returns:
+            The trial as (solenoid pin, odor ms, delay ms).
+        """
+
+        solenoid, odor_ms, btw_ms = struct.unpack(TRIAL_FORMAT, data)
+
+        return solenoid + 1, odor_ms, delay_after_odor_ms(btw_ms)
+
+    def handle_frame(self, msg_type: str, seq: int, payload: bytes):
+        """Acts on a frame from the host.
+
+        Args:
+            msg_type: The single character message type.
+            seq: The frame's sequence number.
+            payload: The message contents.
+        """
+
+        if msg_type == "?":
+            self.send_frame("p", struct.pack("<IB", self.millis(), seq))
+            return
+
+        if msg_type == "H" and len(payload) == 2:
+            self.keepalive_interval = struct.unpack("<H", payload)[0]
+            self.send_frame("r", struct.pack("<HB", FIRMWARE_VERSION, seq))
+            self.send_status()
+            return
+
+        if msg_type == "T" and len(self.trial_queue) >= self.queue_size:
+            return
+
+        self.send_frame("a", bytes([seq]))
+
+        if seq == self.last_rx_seq:
+            return
+        self.last_rx_seq = seq
+
+        trial_size = struct.calcsize(TRIAL_FORMAT)
+
+        if msg_type == "T" and len(payload) == trial_size:
+            self.trial_queue.append(self.read_trial(payload))
+
+        elif msg_type == "C":
+            self.trial_queue.clear()
+            self.schedule.clear()
+            self.expected_trials = 0
+
+        elif msg_type == "B" and len(payload) == 4:
+            baud_rate = struct.unpack("<I", payload)[0]
+            if baud_rate <= self.max_baud_rate:
+                self.baud_rate = baud_rate
+            else:
+                # The host's pings would arrive garbled, so stay silent until
+                # it falls back
+                self.stop_running.wait(1.0)
+                self.parser.buffer.clear()
+
+        elif msg_type == "S" and len(payload) == 2:
+            self.expected_trials = struct.unpack("<H", payload)[0]
+            self.schedule.clear()
+            if self.expected_trials > self.max_trials:
+                # Nothing is stored from the "Q" frames that follow
+                self.expected_trials = 0
+                self.send_frame("8", struct.pack("<H", 0))
+
+        elif msg_type == "Q":
+            for start in range(0, len(payload) - trial_size + 1, trial_size):
+                if len(self.schedule) < min(self.expected_trials, self.max_trials):
+                    self.schedule.append(
+                        self.read_trial(payload[start : start + trial_size])
+                    )
+            if self.schedule and len(self.schedule) == self.expected_trials:
+                self.send_frame("8", struct.pack("<H", len(self.schedule)))
+
+    def service_serial(self, timeout: float = 0):
+        """Handles waiting frames and keepalives.
+
+        Args:
+            timeout: How long in s of host time to wait for bytes.
+        """
+
+        self.keep_alive()
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+
+        try:
+            data = os.read(self.fd, 1024)
+        except OSError:
+            # The host closed its end of the port
+            return
+
+        bad_frames = self.parser.bad_frames
+        frames = self.parser.feed(data)[0]
+
+        # Like arduino_sketch, answer each corrupted frame with "n". The
+        # sketch doesn't look for gaps in seq, so lost frames aren't
+        # answered
+        for _ in range(self.parser.bad_frames - bad_frames):
+            self.send_frame("n")
+
+        for msg_type, seq, payload in frames:
+            self.handle_frame(msg_type, seq, payload)
+
+    def wait(self, duration_ms: float):
+        """Waits for some arduino time while servicing the serial port.
+
+        Args:
+            duration_ms: How long in ms of arduino time to wait.
+        """
+
+        end = self.millis() + duration_ms
+
+        while self.millis() < end and not self.stop_running.is_set():
+            remaining = (end - self.millis()) / 1000 / self.speed
+            self.service_serial(min(max(remaining, 0), 0.005))
+
+    def wait_for_trigger(self):
+        """Waits for the microscope trigger on the simulated TTL input."""
+
+        if self.trigger_delay is not None:
+            self.wait(self.trigger_delay * 1000)
+            return
+
+        while not self.ttl_input.is_set() and not self.stop_running.is_set():
+            self.wait(10)
+
+    def run_trial(self, trial: tuple):
+        """Runs one trial as runTrial in arduino_sketch does.
+
+        Args:
+            trial: The trial as (solenoid pin, odor ms, delay ms).
+        """
+
+        solenoid, odor_ms, delay_ms = trial
+
+        if solenoid <= 1:
+            return
+
+        self.wait_for_trigger()
+        self.send_event("9")
+        self.wait(TRIGGER_PULSE_MS + BASELINE_MS)
+        self.send_event("1")
+        self.wait(odor_ms)
+        self.send_event("2")
+        self.wait(delay_ms)
+        self.send_event("3")
+        self.trials_completed += 1
+
+    def run(self):
+        """Runs trials as they arrive until stopped."""
+
+        while not self.stop_running.is_set():
+            # Like the sketch's loop, only check the port when a trial is
+            # waiting to run, so a queued trial doesn't start late
+            waiting = self.trial_queue or (
+                self.schedule and len(self.schedule) == self.expected_trials
+            )
+            self.service_serial(0 if waiting else 0.05)
+
+            if self.schedule and len(self.schedule) == self.expected_trials:
+                while self.schedule and not self.stop_running.is_set():
+                    self.run_trial(self.schedule.pop(0))
+                self.expected_trials = 0
+
+            if self.trial_queue:
+                self.run_trial(self.trial_queue.pop(0))
+
+    def stop(self):
+        """Stops the emulator and closes both ends of the pseudo-terminal."""
+
+        self.stop_running.set()
+        if self.is_alive():
+            self.join(timeout=1)
+
+        if self.port_fd is not None:
+            os.close(self.fd)
+            os.close(self.port_fd)
+            self.port_fd = None
+
+
+def main():
+    """Runs a virtual arduino until interrupted and prints its port."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="how many times faster than real time the clock runs",
+    )
+    parser.add_argument(
+        "--trigger-delay",
+        type=float,
+        default=0.0,
+        help="s of arduino time before the microscope trigger arrives",
+    )
+    parser.add_argument(
+        "--max-baud",
+        type=int,
+        default=1000000,
+        help="fastest baud rate the emulated link accepts",
+    )
+    args = parser.parse_args()
+
+    arduino = VirtualArduino(args.speed, args.trigger_delay, args.max_baud)
+    arduino.start()
+    print(f"Virtual arduino listening on {arduino.port}")
+
+    try:
+        while arduino.is_alive():
+            arduino.join(timeout=1)
+    except KeyboardInterrupt:
+        arduino.stop()
+
+
+if __name__ == "__main__":
+    main()
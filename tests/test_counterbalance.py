@@ -0,0 +1,62 @@
+"""Tests for the Latin square and Williams designs."""
+
+import numpy as np
+import pytest
+
+from components.counterbalance import counterbalanced_trials, design_rows
+
+
+def carryover_counts(rows: np.ndarray):
+    """Counts how often each odor directly follows each other odor."""
+
+    num_odors = rows.shape[1]
+    counts = np.zeros((num_odors, num_odors), dtype=int)
+    for row in rows:
+        for first, second in zip(row[:-1], row[1:]):
+            counts[first, second] += 1
+
+    return counts
+
+
+@pytest.mark.parametrize("design", ["Latin square", "Williams"])
+@pytest.mark.parametrize("num_odors", [2, 3, 4, 5, 8])
+def test_every_odor_takes_every_position(design, num_odors):
+    rows = design_rows(design, num_odors)
+
+    for row in rows:
+        assert sorted(row) == list(range(num_odors))
+    for column in rows.T:
+        counts = np.bincount(column, minlength=num_odors)
+        assert (counts == counts[0]).all()
+
+
+@pytest.mark.parametrize("num_odors", [2, 3, 4, 5, 8])
+def test_williams_balances_carryover(num_odors):
+    rows = design_rows("Williams", num_odors)
+    counts = carryover_counts(rows)
+    off_diagonal = counts[~np.eye(num_odors, dtype=bool)]
+
+    assert len(rows) == (2 * num_odors if num_odors % 2 else num_odors)
+    assert (np.diag(counts) == 0).all()
+    assert (off_diagonal == off_diagonal[0]).all()
+
+
+def test_rows_are_shared_read_only():
+    rows = design_rows("Latin square", 4)
+
+    assert design_rows("Latin square", 4) is rows
+    with pytest.raises(ValueError):
+        rows[0, 0] = 1
+
+
+def test_unknown_design_raises():
+    with pytest.raises(ValueError):
+        design_rows("Graeco-Latin", 4)
+
+
+def test_counterbalanced_trials_wrap_around_the_design():
+    odors = [2, 4, 6]
+    trials = counterbalanced_trials(odors, 4, "Latin square", 2)
+    rows = design_rows("Latin square", 3)
+
+    assert trials == [odors[index] for row in [2, 0, 1, 2] for index in rows[row]]
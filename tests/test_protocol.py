@@ -0,0 +1,82 @@
+"""Tests for the framing between the app and arduino_sketch."""
+
+from components.protocol import (
+    SYNC,
+    FrameParser,
+    crc8,
+    decode_payload,
+    encode_frame,
+    encode_trial,
+)
+
+
+def test_crc8_check_value():
+    # The standard check value of CRC-8 with polynomial 0x07
+    assert crc8(b"123456789") == 0xF4
+
+
+def test_frames_split_across_reads():
+    parser = FrameParser()
+    data = encode_frame("T", 0, encode_trial(3, 1000, 5000)) + encode_frame("C", 1)
+
+    frames = []
+    for byte in data:
+        frames += parser.feed(bytes([byte]))[0]
+
+    assert frames == [("T", 0, encode_trial(3, 1000, 5000)), ("C", 1, b"")]
+    assert parser.bad_frames == 0
+    assert parser.lost_frames == 0
+
+
+def test_corrupted_frame_is_dropped_and_parser_resyncs():
+    parser = FrameParser()
+    corrupted = bytearray(encode_frame("2", 0, (1234).to_bytes(4, "little")))
+    corrupted[5] ^= 0xFF
+
+    frames, errors = parser.feed(
+        b"\x00\x13" + bytes(corrupted) + encode_frame("3", 1, b"\x01\x00\x00\x00")
+    )
+
+    assert frames == [("3", 1, b"\x01\x00\x00\x00")]
+    assert errors == 1
+    assert parser.bad_frames == 1
+    assert parser.buffer == b""
+
+
+def test_sync_byte_inside_a_payload_is_not_a_frame_start():
+    parser = FrameParser()
+    payload = bytes([SYNC, 0, 0, 0])
+
+    frames, errors = parser.feed(encode_frame("9", 0, payload))
+
+    assert frames == [("9", 0, payload)]
+    assert errors == 0
+
+
+def test_oversized_length_is_treated_as_corrupted():
+    parser = FrameParser(max_payload=5)
+
+    frames, errors = parser.feed(
+        bytes([SYNC, ord("9"), 0, 200]) + encode_frame("y", 1, b"\x02\x00")
+    )
+
+    assert frames == [("y", 1, b"\x02\x00")]
+    assert errors == 1
+
+
+def test_skipped_seqs_count_as_lost_frames():
+    parser = FrameParser()
+    parser.feed(encode_frame("a", 254, b"\x00"))
+
+    frames, errors = parser.feed(encode_frame("a", 1, b"\x00"))
+
+    assert [seq for _, seq, _ in frames] == [1]
+    assert errors == 2
+    assert parser.lost_frames == 2
+
+
+def test_decode_payload():
+    assert decode_payload("9", (5000).to_bytes(4, "little")) == (5000, None)
+    assert decode_payload("p", (5000).to_bytes(4, "little") + b"\x07") == (5000, 7)
+    assert decode_payload("a", b"\x07") == (None, 7)
+    assert decode_payload("9", b"\x00") == (None, None)
@@ -0,0 +1,68 @@
+"""Tests for shuffling trials under order constraints."""
+
+from collections import Counter
+
+import pytest
+
+from components.trial_constraints import (
+    TrialConstraints,
+    constrained_order,
+    seeded_rng,
+)
+
+#: list: Five trials of each of four odors
+TRIALS = [odor for odor in range(1, 5) for _ in range(5)]
+
+
+@pytest.mark.parametrize(
+    "constraints",
+    [
+        TrialConstraints(),
+        TrialConstraints(no_repeats=True),
+        TrialConstraints(max_run=2),
+        TrialConstraints(min_gap=2),
+        TrialConstraints(balanced_blocks=True),
+        TrialConstraints(no_repeats=True, balanced_blocks=True),
+    ],
+)
+def test_order_meets_constraints(constraints):
+    for seed in range(20):
+        order = constrained_order(TRIALS, constraints, seeded_rng(seed))
+
+        assert Counter(order) == Counter(TRIALS)
+        assert constraints.is_met(order)
+
+
+def test_gap_and_run_limits_hold():
+    for seed in range(20):
+        order = constrained_order(TRIALS, TrialConstraints(min_gap=2), seeded_rng(seed))
+        for position, odor in enumerate(order):
+            assert odor not in order[position + 1 : position + 3]
+
+        order = constrained_order(TRIALS, TrialConstraints(max_run=2), seeded_rng(seed))
+        assert all(
+            len(set(order[position : position + 3])) > 1
+            for position in range(len(order) - 2)
+        )
+
+
+def test_same_seed_gives_same_order():
+    constraints = TrialConstraints(no_repeats=True)
+
+    first = constrained_order(TRIALS, constraints, seeded_rng(1234))
+    again = constrained_order(list(reversed(TRIALS)), constraints, seeded_rng(1234))
+    other = constrained_order(TRIALS, constraints, seeded_rng(1235))
+
+    assert first == again
+    assert first != other
+
+
+def test_impossible_constraints_raise():
+    with pytest.raises(ValueError):
+        constrained_order([1, 1, 1, 2], TrialConstraints(no_repeats=True))
+
+    with pytest.raises(ValueError):
+        constrained_order([1, 1, 2, 2, 3], TrialConstraints(balanced_blocks=True))
+
+    with pytest.raises(ValueError):
+        constrained_order(TRIALS, TrialConstraints(max_run=0))
@@ -0,0 +1,86 @@
+"""Runs whole sessions against VirtualArduino on both serial engines."""
+
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("pty", reason="VirtualArduino needs a pseudo-terminal")
+
+from components.arduino_functions import ArduinoSession
+from components.virtual_arduino import VirtualArduino
+
+#: int: Number of trials in each session
+NUM_TRIALS = 6
+
+
+class FakePage:
+    """Stands in for the flet page the session reports to."""
+
+    class snack_bar:
+        class content:
+            value = ""
+
+        open = False
+
+    def update(self):
+        pass
+
+
+@pytest.fixture
+def arduino():
+    """A VirtualArduino running 1000 times faster than real time."""
+
+    virtual_arduino = VirtualArduino(speed=1000)
+    virtual_arduino.start()
+    yield virtual_arduino
+    virtual_arduino.stop()
+
+
+@pytest.mark.parametrize("sequence_upload", [False, True])
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_session_delivers_every_trial(
+    arduino, tmp_path, monkeypatch, engine, sequence_upload
+):
+    # The session isn't added to a page, so there is nothing to redraw
+    monkeypatch.setattr(ArduinoSession, "update", lambda self: None)
+
+    settings = {
+        "date": "231116",
+        "mouse": "123",
+        "roi": "ROI1",
+        "dir_path": str(tmp_path),
+        "odor_duration": 1,
+        "time_btw_odors": 3,
+    }
+    odor_sequence = [trial % 8 + 1 for trial in range(NUM_TRIALS)]
+
+    session = ArduinoSession(
+        "1%",
+        "120000",
+        FakePage(),
+        settings,
+        odor_sequence,
+        engine=engine,
+        sequence_upload=sequence_upload,
+        port=arduino.port,
+    )
+
+    if engine == "asyncio":
+        asyncio.run(session.run_async())
+    else:
+        session.run()
+
+    assert session.sequence_complete
+    assert arduino.trials_completed == NUM_TRIALS
+    assert all(session.event_store.has(trial, "2") for trial in range(NUM_TRIALS))
+
+    timings_path = os.path.join(
+        str(tmp_path), "231116_123_ROI1_solenoid_timings_120000.csv"
+    )
+    with open(timings_path) as timings_file:
+        rows = timings_file.read().splitlines()[1:]
+
+    assert [row.split(",")[1] for row in rows] == [
+        str(odor) for odor in odor_sequence
+    ]